@@ -1,9 +1,47 @@
 import tables
 import numbers
+import threading
 import numpy as np
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
+# Serializes creating the per file read locks
+_file_locks_lock = threading.Lock()
 
-def add_memory_swapper(earray, mem_size):
+
+def _file_io_lock(hdf5_file):
+    """ One lock per open hdf5 file, shared by every swapper reading it """
+    with _file_locks_lock:
+        if not hasattr(hdf5_file, "_swapper_io_lock"):
+            hdf5_file._swapper_io_lock = threading.Lock()
+        return hdf5_file._swapper_io_lock
+
+
+def add_memory_swapper(earray, mem_size, n_chunks=8, prefetch=True):
+    """
+    Cache reads from an hdf5 EArray in memory, in chunks along axis 0
+
+    Rows are loaded in fixed size chunks, and up to n_chunks chunks are kept
+    with least recently used eviction, using at most mem_size bytes. When
+    reads move sequentially into a new chunk, the following chunk is read
+    in a background thread - with n_chunks=1, only once the read reaches
+    the end of the current chunk. The thread exits when it has no queued
+    reads, and stop_memory_swapper stops prefetching before closing the
+    file. All reads hold a lock shared by every swapped array in the same
+    file, since hdf5 is not thread safe.
+
+    Integers, slices, integer or boolean index arrays along axis 0, and
+    tuples of these followed by indices for the other axes are supported.
+    Index arrays may be unsorted - they are grouped by chunk, and runs of
+    consecutive chunks which are not cached are loaded with one read.
+    Requests touching more than n_chunks chunks bypass the cache and read
+    directly from the file, one read per chunk for index arrays.
+
+    Hit and miss counts are available from memory_swapper_stats.
+    """
     class _cEArray(tables.EArray):
         pass
 
@@ -12,90 +50,425 @@ def add_memory_swapper(earray, mem_size):
 
     earray._in_mem_size = int(float(mem_size))
     assert earray._in_mem_size >= 1E6  # don't use for smaller than 1MB
-    earray._in_mem_slice = np.empty([1] * len(earray.shape)).astype("float32")
-    earray._in_mem_limits = [np.inf, -np.inf]
+    n_bytes_per_sample = earray.dtype.itemsize * int(np.prod(earray.shape[1:]))
+    chunk_size = int(earray._in_mem_size /
+                     float(n_chunks * n_bytes_per_sample))
+    if chunk_size < 1:
+        raise ValueError("mem_size %i too small for %i chunks of samples with "
+                         "%i bytes" % (earray._in_mem_size, n_chunks,
+                                       n_bytes_per_sample))
+    earray._swapper_chunk_size = chunk_size
+    earray._swapper_n_chunks = n_chunks
+    earray._swapper_chunks = OrderedDict()
+    earray._swapper_stats = {"hits": 0, "misses": 0, "prefetches": 0,
+                             "prefetch_hits": 0, "evictions": 0,
+                             "passthrough_reads": 0}
+    earray._swapper_prefetched = set()
+    earray._swapper_last_chunk = None
+    earray._swapper_prefetch = prefetch
+    # Guards the chunk cache, stats and prefetch thread
+    cache_lock = threading.Lock()
+    # Guards every read from the file
+    io_lock = _file_io_lock(earray._v_file)
+    earray._swapper_io_lock = io_lock
+    prefetch_queue = queue.Queue()
+    earray._swapper_queue = prefetch_queue
 
     old_getter = earray.__getitem__
 
-    def _check_in_mem(earray, start, stop):
-        lower = earray._in_mem_limits[0]
-        upper = earray._in_mem_limits[1]
-        if start < lower or stop > upper:
-            return False
+    def _cache_chunk(c, chunk):
+        with cache_lock:
+            earray._swapper_chunks[c] = chunk
+            while len(earray._swapper_chunks) > n_chunks:
+                evicted, _ = earray._swapper_chunks.popitem(last=False)
+                earray._swapper_prefetched.discard(evicted)
+                earray._swapper_stats["evictions"] += 1
+
+    def _read_chunks(first_chunk, last_chunk):
+        # One read for a run of consecutive chunks
+        start = first_chunk * chunk_size
+        stop = min((last_chunk + 1) * chunk_size, earray.nrows)
+        with io_lock:
+            rows = old_getter(slice(start, stop, 1))
+        chunks = {}
+        for c in range(first_chunk, last_chunk + 1):
+            lower = (c - first_chunk) * chunk_size
+            chunks[c] = rows[lower:lower + chunk_size]
+            _cache_chunk(c, chunks[c])
+        return chunks
+
+    def _read_chunk(c):
+        with cache_lock:
+            if c in earray._swapper_chunks:
+                return
+        with io_lock:
+            with cache_lock:
+                if c in earray._swapper_chunks:
+                    # Loaded while waiting for the file
+                    return
+            start = c * chunk_size
+            chunk = old_getter(slice(start, start + chunk_size, 1))
+        _cache_chunk(c, chunk)
+
+    def _prefetch_worker():
+        # Exits once the queue is empty, so no idle thread keeps the file
+        # node alive
+        while True:
+            with cache_lock:
+                if prefetch_queue.empty():
+                    earray._swapper_thread = None
+                    return
+                c = prefetch_queue.get()
+            try:
+                _read_chunk(c)
+            except Exception:
+                # File closed or shrunk, reads in the main thread will report
+                # any real problems
+                pass
+            finally:
+                prefetch_queue.task_done()
+
+    def _get_chunks(chunk_ids):
+        # Returns dict of chunk id -> rows, so later evictions during this
+        # lookup don't matter
+        chunks = {}
+        missing = []
+        with cache_lock:
+            for c in chunk_ids:
+                if c in earray._swapper_chunks:
+                    earray._swapper_chunks[c] = earray._swapper_chunks.pop(c)
+                    chunks[c] = earray._swapper_chunks[c]
+                    earray._swapper_stats["hits"] += 1
+                    if c in earray._swapper_prefetched:
+                        earray._swapper_prefetched.discard(c)
+                        earray._swapper_stats["prefetch_hits"] += 1
+                else:
+                    missing.append(c)
+                    earray._swapper_stats["misses"] += 1
+        # Coalesce runs of consecutive missing chunks into single reads
+        run_start = 0
+        for i in range(1, len(missing) + 1):
+            if i == len(missing) or missing[i] != missing[i - 1] + 1:
+                chunks.update(_read_chunks(missing[run_start],
+                                           missing[i - 1]))
+                run_start = i
+        with cache_lock:
+            earray._swapper_prefetched.difference_update(missing)
+        return chunks
+
+    def _maybe_prefetch(first_chunk, last_chunk, stop):
+        previous = earray._swapper_last_chunk
+        earray._swapper_last_chunk = last_chunk
+        if not earray._swapper_prefetch or previous is None:
+            return
+        if not (previous <= first_chunk <= previous + 1):
+            return
+        next_chunk = last_chunk + 1
+        if n_chunks == 1 and stop < next_chunk * chunk_size:
+            # The next chunk would evict the one still being read
+            return
+        if next_chunk * chunk_size >= earray.nrows:
+            return
+        with cache_lock:
+            if (next_chunk in earray._swapper_chunks or
+                    next_chunk in earray._swapper_prefetched):
+                return
+            earray._swapper_prefetched.add(next_chunk)
+            earray._swapper_stats["prefetches"] += 1
+            prefetch_queue.put(next_chunk)
+            if earray._swapper_thread is None:
+                earray._swapper_thread = threading.Thread(
+                    target=_prefetch_worker)
+                earray._swapper_thread.daemon = True
+                earray._swapper_thread.start()
+
+    earray._swapper_thread = None
+
+    def _passthrough(key):
+        earray._swapper_stats["passthrough_reads"] += 1
+        with io_lock:
+            return old_getter(key)
+
+    def _get_rows(start, stop, step):
+        if stop <= start:
+            return old_getter(slice(start, stop, step))
+        first_chunk = start // chunk_size
+        last_chunk = (stop - 1) // chunk_size
+        if last_chunk - first_chunk + 1 > n_chunks:
+            # Larger than the cache, read directly
+            return _passthrough(slice(start, stop, step))
+        chunks = _get_chunks(list(range(first_chunk, last_chunk + 1)))
+        pieces = []
+        for c in range(first_chunk, last_chunk + 1):
+            lower = c * chunk_size
+            pieces.append(chunks[c][max(start - lower, 0):stop - lower])
+        _maybe_prefetch(first_chunk, last_chunk, stop)
+        if len(pieces) == 1:
+            rows = pieces[0]
+        else:
+            rows = np.concatenate(pieces, axis=0)
+        if step != 1:
+            rows = rows[::step]
+        return rows
+
+    def _get_indices(indices):
+        indices = np.asarray(indices)
+        if indices.dtype == np.bool_:
+            if len(indices) != earray.nrows:
+                raise IndexError("Boolean index of length %i for %i rows" % (
+                    len(indices), earray.nrows))
+            indices = np.flatnonzero(indices)
+        if indices.ndim != 1 or not np.issubdtype(indices.dtype, np.integer):
+            raise ValueError("Index arrays must be 1D integers or booleans")
+        if len(indices) == 0:
+            return old_getter(slice(0, 0, 1))
+        n = earray.nrows
+        indices = np.where(indices < 0, indices + n, indices)
+        if indices.min() < 0 or indices.max() >= n:
+            raise IndexError("Index array out of range for %i rows" % n)
+        is_sorted = np.all(indices[1:] >= indices[:-1])
+        if is_sorted:
+            sorted_indices = indices
         else:
-            return True
-
-    def _load_in_mem(earray, start, stop):
-        # start and stop are slice indices desired - we calculate different
-        # sizes to put in memory
-        n_bytes_per_entry = earray._in_mem_slice.dtype.itemsize
-        n_entries = earray._in_mem_size / float(n_bytes_per_entry)
-        n_samples = earray.shape[0]
-        n_other = earray.shape[1:]
-        n_samples_that_fit = int(n_entries / np.prod(n_other))
-        assert n_samples_that_fit > 0
-        # handle - index case later
-        assert start >= 0
-        assert stop >= 0
-        assert stop >= start
-        slice_size = stop - start
-        if slice_size > n_samples_that_fit:
-            err_str = "Slice from [%i:%i] (size %i) too large! " % (
-                start, stop, slice_size)
-            err_str += "Max slice size %i" % n_samples_that_fit
-            raise ValueError(err_str)
-        slice_limit = [start, stop]
-        earray._in_mem_limits = slice_limit
-        if earray._in_mem_slice.shape[0] == 1:
-            # allocate memory
-            print("Allocating %f gigabytes of memory for EArray swap buffer" %
-                  (earray._in_mem_size / float(1E9)))
-            earray._in_mem_slice = np.empty((n_samples_that_fit,) + n_other,
-                                            dtype=earray.dtype)
-        # handle edge case when last chunk is smaller than what slice will
-        # return
-        limit = min([slice_limit[1] - slice_limit[0],
-                     n_samples - slice_limit[0]])
-        earray._in_mem_slice[:limit] = old_getter(
-            slice(slice_limit[0], slice_limit[1], 1))
+            order = np.argsort(indices, kind="mergesort")
+            sorted_indices = indices[order]
+        chunk_ids = sorted_indices // chunk_size
+        bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+        starts = np.concatenate(([0], bounds))
+        stops = np.concatenate((bounds, [len(sorted_indices)]))
+        unique_chunks = [int(c) for c in chunk_ids[starts]]
+        pieces = []
+        if len(unique_chunks) > n_chunks:
+            # Larger than the cache, read the span within each chunk directly
+            for start, stop in zip(starts, stops):
+                lower = sorted_indices[start]
+                upper = sorted_indices[stop - 1] + 1
+                block = _passthrough(slice(lower, upper, 1))
+                pieces.append(block[sorted_indices[start:stop] - lower])
+        else:
+            chunks = _get_chunks(unique_chunks)
+            for c, start, stop in zip(unique_chunks, starts, stops):
+                pieces.append(chunks[c][sorted_indices[start:stop] -
+                                        c * chunk_size])
+            _maybe_prefetch(unique_chunks[0], unique_chunks[-1],
+                            sorted_indices[-1] + 1)
+        sorted_rows = np.concatenate(pieces, axis=0)
+        if is_sorted:
+            return sorted_rows
+        rows = np.empty_like(sorted_rows)
+        rows[order] = sorted_rows
+        return rows
 
     def getter(self, key):
+        if isinstance(key, tuple) and len(key) > 1:
+            # Index with extra axes like [1:100, :] or [[1, 5], 2:4]
+            rows = getter(self, key[0])
+            if isinstance(key[0], (numbers.Integral, np.integer)):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        elif isinstance(key, tuple):
+            key = key[0]
         if isinstance(key, numbers.Integral) or isinstance(key, np.integer):
-            start, stop, step = self._processRange(key, key, 1)
+            n = self.nrows
             if key < 0:
-                key = start
-            if _check_in_mem(self, key, key):
-                lower = self._in_mem_limits[0]
-            else:
-                # slice into memory...
-                _load_in_mem(self, key, key)
-                lower = self._in_mem_limits[0]
-            return self._in_mem_slice[key - lower]
+                key += n
+            if key < 0 or key >= n:
+                raise IndexError("Index %i out of range for %i rows" % (
+                    key, n))
+            return _get_rows(key, key + 1, 1)[0]
         elif isinstance(key, slice):
-            start, stop, step = self._processRange(
-                key.start, key.stop, key.step)
-            if _check_in_mem(self, start, stop):
-                lower = self._in_mem_limits[0]
-            else:
-                # slice into memory...
-                _load_in_mem(self, start, stop)
-                lower = self._in_mem_limits[0]
-            return self._in_mem_slice[start - lower:stop - lower:step]
-        elif len(key) == 2:
-            # Slice with extra axes like [1:100, :]
-            key = key[0]
-            start, stop, step = self._processRange(
-                key.start, key.stop, key.step)
-            if _check_in_mem(self, start, stop):
-                lower = self._in_mem_limits[0]
-            else:
-                # slice into memory...
-                _load_in_mem(self, start, stop)
-                lower = self._in_mem_limits[0]
-            return self._in_mem_slice[start - lower:stop - lower:step]
+            start, stop, step = key.indices(self.nrows)
+            if step < 0:
+                raise ValueError("Negative steps are not supported")
+            return _get_rows(start, stop, step)
+        elif isinstance(key, (list, np.ndarray)):
+            return _get_indices(key)
         else:
-            raise ValueError("Must index with a slice object or single value"
-                             "along 0 axis!")
+            raise ValueError("Must index with an integer, slice or index "
+                             "array along 0 axis!")
     # This line is critical...
     _cEArray.__getitem__ = getter
     return earray
+
+
+def stop_memory_swapper(earray):
+    """ Stop background reads for an EArray from add_memory_swapper
+
+    Waits for queued reads, so the file can be closed afterwards. Cached
+    chunks are still used.
+    """
+    earray._swapper_prefetch = False
+    earray._swapper_queue.join()
+
+
+def memory_swapper_stats(earray):
+    """ Copy of cache statistics for an EArray from add_memory_swapper
+
+    hits and misses count chunk lookups. prefetches counts chunks queued for
+    background reads, and prefetch_hits those that were used afterwards.
+    passthrough_reads counts file reads made for requests too large to cache.
+    """
+    stats = dict(earray._swapper_stats)
+    stats["cached_chunks"] = len(earray._swapper_chunks)
+    stats["chunk_size"] = earray._swapper_chunk_size
+    return stats
+
+
+def _make_filters(complib="blosc", complevel=5):
+    """ tables.Filters for complib, falling back to zlib without blosc """
+    if complib is None or complevel == 0:
+        return tables.Filters(complevel=0)
+    if complib.split(":")[0] == "blosc" and tables.which_lib_version(
+            "blosc") is None:
+        complib = "zlib"
+    return tables.Filters(complevel=complevel, complib=complib, shuffle=True)
+
+
+def create_chunked_earray(hdf5_file, name, sample_shape, dtype="float32",
+                          chunk_rows=None, complib="blosc", complevel=5,
+                          expectedrows=None):
+    """
+    Create an empty, compressed EArray extendable along axis 0
+
+    Parameters
+    ----------
+    hdf5_file : tables.File
+        Open, writable hdf5 file. The array is added under the root node.
+
+    name : str
+        Name for the array
+
+    sample_shape : tuple
+        Shape of a single sample, the array has shape (0,) + sample_shape
+
+    dtype : optional, default "float32"
+
+    chunk_rows : int, optional
+        Number of samples in each hdf5 chunk, which is the unit of compression
+        and of disk reads. Defaults to about 1MB per chunk.
+
+    complib : optional, default "blosc"
+        Compression library for tables.Filters, such as "blosc", "blosc:lz4",
+        "zlib" or None. blosc falls back to zlib when it is not available.
+
+    complevel : optional, default 5
+
+    expectedrows : int, optional
+        Expected final number of samples, used by pytables for tuning
+
+    Returns
+    -------
+    earray : tables.EArray
+    """
+    sample_shape = tuple(sample_shape)
+    atom = tables.Atom.from_dtype(np.dtype(dtype))
+    if chunk_rows is None:
+        n_bytes_per_sample = atom.itemsize * int(np.prod(sample_shape))
+        chunk_rows = max(1, int(1E6 / n_bytes_per_sample))
+    kwargs = {}
+    if expectedrows is not None:
+        kwargs["expectedrows"] = expectedrows
+    return hdf5_file.create_earray(hdf5_file.root, name, atom,
+                                   shape=(0,) + sample_shape,
+                                   filters=_make_filters(complib, complevel),
+                                   chunkshape=(chunk_rows,) + sample_shape,
+                                   **kwargs)
+
+
+def append_from_generator(earray, sample_generator):
+    """
+    Append samples from a generator to an EArray, one chunk at a time
+
+    sample_generator can yield single samples of shape earray.shape[1:], or
+    blocks of samples with shape (n,) + earray.shape[1:], in any mix.
+    Samples are buffered and written a chunk at a time, so memory use is
+    bounded by the chunk size plus the largest yielded block.
+
+    Returns the number of samples appended.
+    """
+    sample_shape = tuple(earray.shape[1:])
+    chunk_rows = earray.chunkshape[0]
+    buf = np.empty((chunk_rows,) + sample_shape, dtype=earray.dtype)
+    n_buf = 0
+    n_written = 0
+    for sample in sample_generator:
+        sample = np.asarray(sample)
+        if sample.shape == sample_shape:
+            sample = sample[None]
+        elif sample.shape[1:] != sample_shape:
+            raise ValueError("Sample shape %s does not match EArray sample "
+                             "shape %s" % (sample.shape, sample_shape))
+        if n_buf == 0 and len(sample) >= chunk_rows:
+            # Large blocks skip the buffer
+            earray.append(sample)
+            n_written += len(sample)
+            continue
+        start = 0
+        while start < len(sample):
+            n = min(chunk_rows - n_buf, len(sample) - start)
+            buf[n_buf:n_buf + n] = sample[start:start + n]
+            n_buf += n
+            start += n
+            if n_buf == chunk_rows:
+                earray.append(buf)
+                n_written += n_buf
+                n_buf = 0
+    if n_buf > 0:
+        earray.append(buf[:n_buf])
+        n_written += n_buf
+    earray.flush()
+    return n_written
+
+
+def write_dataset_to_hdf5(dataset, hdf5_path, chunk_rows=None,
+                          complib="blosc", complevel=5):
+    """
+    Write a dataset dict of arrays, such as from fetch_mnist, to hdf5
+
+    Every array in dataset is stored as a chunked EArray with the same name,
+    and copied chunk_rows samples at a time. Arrays loaded with mmap_mode
+    (the dataset caches) are never fully read into memory. Non array values
+    are skipped.
+
+    Use open_hdf5_dataset to read the result.
+    """
+    hdf5_file = tables.open_file(hdf5_path, "w")
+    try:
+        for k, v in dataset.items():
+            if not isinstance(v, np.ndarray) or v.ndim == 0:
+                continue
+            earray = create_chunked_earray(hdf5_file, k, v.shape[1:],
+                                           dtype=v.dtype,
+                                           chunk_rows=chunk_rows,
+                                           complib=complib,
+                                           complevel=complevel,
+                                           expectedrows=len(v))
+            step = earray.chunkshape[0]
+            append_from_generator(
+                earray, (v[i:i + step] for i in range(0, len(v), step)))
+    finally:
+        hdf5_file.close()
+    return hdf5_path
+
+
+def open_hdf5_dataset(hdf5_path, mem_size=None, n_chunks=8):
+    """
+    Open an hdf5 file of arrays, such as from write_dataset_to_hdf5
+
+    Returns the open tables.File and a dict of the arrays under its root,
+    keyed by name. If mem_size is given, EArrays larger than mem_size bytes
+    are wrapped with add_memory_swapper, and other arrays are read into
+    memory as numpy arrays.
+    """
+    hdf5_file = tables.open_file(hdf5_path, "r")
+    dataset = {}
+    for node in hdf5_file.list_nodes(hdf5_file.root):
+        if mem_size is None:
+            dataset[node.name] = node
+        elif (isinstance(node, tables.EArray) and
+              node.size_in_memory > mem_size):
+            dataset[node.name] = add_memory_swapper(node, mem_size,
+                                                    n_chunks=n_chunks)
+        else:
+            dataset[node.name] = node.read()
+    return hdf5_file, dataset
@@ -5,23 +5,48 @@
 import numpy as np
 from collections import Counter
 from scipy.io import loadmat
-from scipy.linalg import svd
-from functools import reduce
-from ..utils import whitespace_tokenizer
+from .dataset_utils import create_chunked_earray, append_from_generator
+from ..utils.training_utils import _word_punct_re
 import string
 import tarfile
+import tables
 import theano
 import zipfile
 import gzip
 import os
 import re
 import csv
+import json
+import shutil
+import hashlib
+import threading
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import urllib.request as urllib_request
+    from urllib.error import HTTPError
+except ImportError:
+    import urllib2 as urllib_request
+    from urllib2 import HTTPError
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
 
 regex = re.compile('[%s]' % re.escape(string.punctuation))
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Bump to invalidate every converted dataset cache
+DATASET_CACHE_VERSION = 1
 
 
 def get_dataset_dir(dataset_name, data_dir=None, folder=None, create_dir=True):
@@ -38,43 +63,291 @@ def get_dataset_dir(dataset_name, data_dir=None, folder=None, create_dir=True):
     return data_dir
 
 
-def download(url, server_fname, local_fname=None, progress_update_percentage=5):
+def _file_sha256(path, block_size=int(1E7)):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _source_signature(source_path):
+    stat = os.stat(source_path)
+    return {"path": os.path.abspath(source_path), "size": stat.st_size,
+            "mtime": int(stat.st_mtime)}
+
+
+def _cache_is_valid(manifest, source_paths, version):
+    """ Check a manifest, updating mtimes of sources with unchanged hash """
+    if manifest.get("version") != [DATASET_CACHE_VERSION, version]:
+        return False
+    if manifest.get("floatX") != theano.config.floatX:
+        return False
+    if len(manifest.get("sources", [])) != len(source_paths):
+        return False
+    for cached, source_path in zip(manifest["sources"], source_paths):
+        if not os.path.exists(source_path):
+            return False
+        current = _source_signature(source_path)
+        if cached["size"] != current["size"]:
+            return False
+        if cached["mtime"] != current["mtime"]:
+            # Touched or copied - only the content hash can tell
+            if cached["sha256"] != _file_sha256(source_path):
+                return False
+            cached["mtime"] = current["mtime"]
+    return True
+
+
+def _cached_dataset(dataset_name, cache_name, source_paths, convert_function,
+                    version=1):
+    """
+    Convert a dataset once to .npy files, memory mapping them on later calls
+
+    convert_function() should return a dictionary of numpy arrays. The result
+    is saved under get_dataset_dir(dataset_name)/cache_name along with a
+    manifest of DATASET_CACHE_VERSION, the converter version,
+    theano.config.floatX and the size, mtime and sha256 of each source file.
+    The cache is rebuilt if any of these change. Bump version when the
+    conversion in convert_function changes.
+
+    Arrays are loaded with mmap_mode="c", so they can be modified in memory
+    without changing the cache.
+    """
+    cache_dir = os.path.join(get_dataset_dir(dataset_name), cache_name)
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        mtimes = [c.get("mtime") for c in manifest.get("sources", [])]
+        if _cache_is_valid(manifest, source_paths, version):
+            if mtimes != [c["mtime"] for c in manifest["sources"]]:
+                # Store new mtimes so later calls skip hashing again
+                with open(manifest_path, "w") as f:
+                    json.dump(manifest, f)
+            return {k: np.load(os.path.join(cache_dir, "%s.npy" % k),
+                               mmap_mode="c")
+                    for k in manifest["keys"]}
+        print("Cached %s is out of date, converting again" % cache_name)
+    dataset = convert_function()
+    for k, v in dataset.items():
+        if not isinstance(v, np.ndarray):
+            raise ValueError("Only numpy arrays can be cached, got %s for "
+                             "key %s" % (type(v), k))
+    # Write the manifest last so partial caches are never loaded
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+    for k, v in dataset.items():
+        np.save(os.path.join(cache_dir, "%s.npy" % k), v)
+    sources = []
+    for source_path in source_paths:
+        signature = _source_signature(source_path)
+        signature["sha256"] = _file_sha256(source_path)
+        sources.append(signature)
+    manifest = {"version": [DATASET_CACHE_VERSION, version],
+                "floatX": theano.config.floatX,
+                "sources": sources,
+                "keys": sorted(dataset.keys())}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return dataset
+
+
+def _read_sha256_sidecar(full_path):
+    sidecar = full_path + ".sha256"
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, "r") as f:
+        return f.read().split()[0]
+
+
+def _fetch_verified(url, full_path, force=False, progress_update_percentage=5):
+    """ Download url to full_path unless a verified copy is already there
+
+    An existing file is checked against its .sha256 sidecar, and downloaded
+    again if it does not match. force=True always downloads.
     """
-    An internet download utility modified from
-    http://stackoverflow.com/questions/22676/
-    how-do-i-download-a-file-over-http-using-python/22776#22776
+    if not force and os.path.exists(full_path):
+        sha256 = _read_sha256_sidecar(full_path)
+        if sha256 is None or _file_sha256(full_path) == sha256:
+            return full_path
+        print("%s does not match its saved SHA-256, downloading again" %
+              full_path)
+    return download(url, full_path, force=force,
+                    progress_update_percentage=progress_update_percentage)
+
+
+def _download_to_part(url, part_path, block_size, progress_update_percentage):
+    """ Download url into part_path, resuming from any existing partial file
+
+    Returns the expected total size in bytes, or None if the server does not
+    report it.
     """
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+    request = urllib_request.Request(url)
+    if offset > 0:
+        request.add_header("Range", "bytes=%i-" % offset)
     try:
-        import urllib
-        urllib.urlretrieve('http://google.com')
-    except AttributeError:
-        import urllib.request as urllib
-    u = urllib.urlopen(url)
+        u = urllib_request.urlopen(request)
+    except HTTPError as e:
+        if e.code == 416 and offset > 0:
+            # Range not satisfiable - the partial file is already complete
+            return offset
+        raise
+    try:
+        meta = u.info()
+        content_range = meta.get("Content-Range")
+        content_length = meta.get("Content-Length")
+        if offset > 0 and u.getcode() == 206:
+            if content_range is not None:
+                file_size = int(content_range.split("/")[-1])
+            elif content_length:
+                file_size = offset + int(content_length)
+            else:
+                file_size = None
+            mode = "ab"
+            print("Resuming download at %i bytes" % offset)
+        else:
+            # Server ignored the Range header, start over
+            offset = 0
+            file_size = int(content_length) if content_length else None
+            mode = "wb"
+        file_size_dl = offset
+        p = 0
+        with open(part_path, mode) as f:
+            while True:
+                buf = u.read(block_size)
+                if not buf:
+                    break
+                file_size_dl += len(buf)
+                f.write(buf)
+                if file_size is None:
+                    continue
+                if (file_size_dl * 100. / file_size) > p:
+                    status = r"%10d  [%3.2f%%]" % (
+                        file_size_dl, file_size_dl * 100. / file_size)
+                    print(status)
+                    p += progress_update_percentage
+    finally:
+        u.close()
+    return file_size
+
+
+def download(url, server_fname, local_fname=None, progress_update_percentage=5,
+             sha256=None, block_size=int(1E6), n_retries=3, force=False):
+    """
+    Download url to local_fname, resuming and verifying the file
+
+    Data is written to local_fname + ".part", which is renamed to local_fname
+    only once it is complete and verified - so a file at local_fname is
+    never truncated. If the download is interrupted, the next call (or one of
+    n_retries retries) resumes from the partial file with an HTTP Range
+    request.
+
+    The SHA-256 of the finished file is checked against sha256, or else
+    against the hash saved in local_fname + ".sha256" by an earlier
+    download. The hash is saved there after the first successful download.
+    A mismatch deletes the partial file and raises ValueError.
+
+    force=True starts over without any partial file, ignores the saved hash
+    and replaces it after the download - use it when the upstream file
+    changed and the saved hash is stale.
+
+    Returns the path of the downloaded file.
+    """
     if local_fname is None:
         local_fname = server_fname
     full_path = local_fname
-    meta = u.info()
-    with open(full_path, 'wb') as f:
+    part_path = full_path + ".part"
+    if force and os.path.exists(part_path):
+        os.remove(part_path)
+    from_sidecar = False
+    if sha256 is None and not force:
+        sha256 = _read_sha256_sidecar(full_path)
+        from_sidecar = sha256 is not None
+    print("Downloading: %s" % server_fname)
+    for attempt in range(n_retries + 1):
         try:
-            file_size = int(meta.get("Content-Length"))
-        except TypeError:
-            print("WARNING: Cannot get file size, displaying bytes instead!")
-            file_size = 100
-        print("Downloading: %s Bytes: %s" % (server_fname, file_size))
-        file_size_dl = 0
-        block_sz = int(1E7)
-        p = 0
+            file_size = _download_to_part(url, part_path, block_size,
+                                          progress_update_percentage)
+        except (IOError, OSError, httplib.HTTPException) as e:
+            # Dropped connections - keep the partial file and resume
+            if attempt == n_retries:
+                raise
+            print("Download of %s failed (%s), retrying" % (url, e))
+            continue
+        size_dl = os.path.getsize(part_path)
+        if file_size is None or size_dl == file_size:
+            break
+        if attempt == n_retries:
+            raise ValueError("Download of %s incomplete, got %i of %i bytes. "
+                             "Call again to resume." % (url, size_dl,
+                                                        file_size))
+        print("Download of %s incomplete, retrying" % url)
+    file_sha256 = _file_sha256(part_path)
+    if sha256 is not None and file_sha256 != sha256:
+        os.remove(part_path)
+        message = "SHA-256 mismatch for %s, expected %s got %s" % (
+            url, sha256, file_sha256)
+        if from_sidecar:
+            message += (". If the file changed upstream, call again with "
+                        "force=True to replace %s.sha256" % full_path)
+        raise ValueError(message)
+    if os.path.exists(full_path):
+        os.remove(full_path)
+    os.rename(part_path, full_path)
+    if force or not os.path.exists(full_path + ".sha256"):
+        with open(full_path + ".sha256", "w") as f:
+            f.write("%s  %s\n" % (file_sha256, os.path.basename(full_path)))
+    return full_path
+
+
+def download_many(list_of_urls, list_of_local_fnames, list_of_sha256=None,
+                  n_threads=4, progress_update_percentage=5, force=False):
+    """
+    Download several files concurrently with download
+
+    Uses up to n_threads threads. All downloads are attempted, then the
+    first error, if any, is raised. Returns the list of local paths.
+    """
+    if len(list_of_urls) != len(list_of_local_fnames):
+        raise ValueError("list_of_urls and list_of_local_fnames must be the "
+                         "same length")
+    if list_of_sha256 is None:
+        list_of_sha256 = [None] * len(list_of_urls)
+    jobs = queue.Queue()
+    for job in zip(list_of_urls, list_of_local_fnames, list_of_sha256):
+        jobs.put(job)
+    errors = []
+
+    def worker():
         while True:
-            buffer = u.read(block_sz)
-            if not buffer:
-                break
-            file_size_dl += len(buffer)
-            f.write(buffer)
-            if (file_size_dl * 100. / file_size) > p:
-                status = r"%10d  [%3.2f%%]" % (file_size_dl, file_size_dl *
-                                               100. / file_size)
-                print(status)
-                p += progress_update_percentage
+            try:
+                url, local_fname, sha256 = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                download(url, local_fname, progress_update_percentage=(
+                    progress_update_percentage), sha256=sha256, force=force)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for n in range(min(n_threads, len(list_of_urls)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return list_of_local_fnames
 
 
 def check_fetch_uci_words():
@@ -89,21 +362,21 @@ def check_fetch_uci_words():
         # Download all 5 vocabularies and zip them into a file
         all_vocabs = ['vocab.enron.txt', 'vocab.kos.txt', 'vocab.nips.txt',
                       'vocab.nytimes.txt', 'vocab.pubmed.txt']
-        for vocab in all_vocabs:
-            dl_url = url + vocab
-            download(dl_url, os.path.join(partial_path, vocab),
-                     progress_update_percentage=1)
-
-            def zipdir(path, zipf):
-                # zipf is zipfile handle
-                for root, dirs, files in os.walk(path):
-                    for f in files:
-                        if "vocab" in f:
-                            zipf.write(os.path.join(root, f))
-
-            zipf = zipfile.ZipFile(full_path, 'w')
-            zipdir(partial_path, zipf)
-            zipf.close()
+        download_many([url + vocab for vocab in all_vocabs],
+                      [os.path.join(partial_path, vocab)
+                       for vocab in all_vocabs],
+                      progress_update_percentage=1)
+
+        def zipdir(path, zipf):
+            # zipf is zipfile handle
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    if "vocab" in f and not f.endswith(".sha256"):
+                        zipf.write(os.path.join(root, f))
+
+        zipf = zipfile.ZipFile(full_path, 'w')
+        zipdir(partial_path, zipf)
+        zipf.close()
     return full_path
 
 
@@ -123,78 +396,119 @@ def fetch_uci_words():
     return list(set(all_data))
 
 
-def _parse_stories(lines, only_supporting=False):
-    """ Preprocessing code modified from Keras and Stephen Merity
-    http://smerity.com/articles/2015/keras_qa.html
-    https://github.com/fchollet/keras/blob/master/examples/babi_rnn.py
+BABI_TASKS = ["qa1_single-supporting-fact", "qa2_two-supporting-facts",
+              "qa3_three-supporting-facts", "qa4_two-arg-relations",
+              "qa5_three-arg-relations", "qa6_yes-no-questions",
+              "qa7_counting", "qa8_lists-sets", "qa9_simple-negation",
+              "qa10_indefinite-knowledge", "qa11_basic-coreference",
+              "qa12_conjunction", "qa13_compound-coreference",
+              "qa14_time-reasoning", "qa15_basic-deduction",
+              "qa16_basic-induction", "qa17_positional-reasoning",
+              "qa18_size-reasoning", "qa19_path-finding",
+              "qa20_agents-motivations"]
 
-    Parse stories provided in the bAbi tasks format
 
-    If only_supporting is true, only the sentences that support the answer are
-    kept.
-    """
-    data = []
-    story = []
-    for line in lines:
-        line = line.decode('utf-8').strip()
-        nid, line = line.split(' ', 1)
-        nid = int(nid)
-        if nid == 1:
-            story = []
-        if '\t' in line:
-            q, a, supporting = line.split('\t')
-            q = whitespace_tokenizer(q)
-            substory = None
-            if only_supporting:
-                # Only select the related substory
-                supporting = map(int, supporting.split())
-                substory = [story[i - 1] for i in supporting]
-            else:
-                # Provide all the substories
-                substory = [x for x in story if x]
-            data.append((substory, q, a))
-            story.append('')
-        else:
-            sent = whitespace_tokenizer(line)
-            story.append(sent)
-    return data
+def _ragged_from_flat(flat, offsets):
+    """ Object array of views flat[offsets[i]:offsets[i + 1]] """
+    ragged = np.empty((len(offsets) - 1,), dtype=object)
+    for i in range(len(ragged)):
+        ragged[i] = flat[offsets[i]:offsets[i + 1]]
+    return ragged
 
 
-def _get_stories(f, only_supporting=False, max_length=None):
-    """ Preprocessing code modified from Keras and Stephen Merity
+def _parse_babi(lines, word_idx):
+    """ Parse bAbI tasks format lines in one pass
+
+    Preprocessing follows Keras and Stephen Merity
     http://smerity.com/articles/2015/keras_qa.html
     https://github.com/fchollet/keras/blob/master/examples/babi_rnn.py
 
-    Given a file name, read the file, retrieve the stories, and then convert
-    the sentences into a single story.
+    Each question gets every statement of its story so far as a single
+    flattened story. word_idx maps words to ids, and new words are added
+    with the next free id.
 
-    If max_length is supplied, any stories longer than max_length tokens will be
-    discarded.
+    Returns int32 arrays stories, story_offsets, queries, query_offsets and
+    answers. stories[story_offsets[i]:story_offsets[i + 1]] is the flattened
+    story for question i.
     """
-    data = _parse_stories(f.readlines(), only_supporting=only_supporting)
-    flatten = lambda data: reduce(lambda x, y: x + y, data)
-    data = [(flatten(story), q, answer) for story, q, answer in data
-            if not max_length or len(flatten(story)) < max_length]
-    return data
-
-
-def _vectorize_stories(data, vocab_size, word_idx):
-    """ Preprocessing code modified from Keras and Stephen Merity
-    http://smerity.com/articles/2015/keras_qa.html
-    https://github.com/fchollet/keras/blob/master/examples/babi_rnn.py
-    """
-    X = []
-    Xq = []
-    y = []
-    for story, query, answer in data:
-        x = [word_idx[w] for w in story]
-        xq = [word_idx[w] for w in query]
-        yi = np.zeros(vocab_size)
-        yi[word_idx[answer]] = 1
-        X.append(x)
-        Xq.append(xq)
-        y.append(yi)
-    return X, Xq, np.array(y)
+    def ids(text):
+        r = []
+        for w in _word_punct_re.findall(text):
+            if w not in word_idx:
+                word_idx[w] = len(word_idx) + 1
+            r.append(word_idx[w])
+        return r
+
+    # Statements of all stories, back to back. The story for a question is
+    # then a contiguous range of this stream, so no lists are concatenated.
+    statement_ids = []
+    story_start = 0
+    story_bounds = []
+    query_ids = []
+    query_lengths = []
+    answers = []
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if line == "":
+            continue
+        nid, line = line.split(" ", 1)
+        if int(nid) == 1:
+            story_start = len(statement_ids)
+        if "\t" in line:
+            q, a, supporting = line.split("\t")
+            q = ids(q)
+            query_ids.extend(q)
+            query_lengths.append(len(q))
+            if a not in word_idx:
+                word_idx[a] = len(word_idx) + 1
+            answers.append(word_idx[a])
+            story_bounds.append((story_start, len(statement_ids)))
+        else:
+            statement_ids.extend(ids(line))
+
+    statement_ids = np.array(statement_ids, dtype="int32")
+    story_bounds = np.array(story_bounds, dtype="int64").reshape(-1, 2)
+    story_lengths = story_bounds[:, 1] - story_bounds[:, 0]
+    story_offsets = np.zeros((len(story_lengths) + 1,), dtype="int32")
+    np.cumsum(story_lengths, out=story_offsets[1:])
+    # Gather every story from the statement stream into one buffer
+    stories = np.empty((story_offsets[-1],), dtype="int32")
+    position = np.arange(story_offsets[-1]) - np.repeat(
+        story_offsets[:-1], story_lengths)
+    stories[:] = statement_ids[np.repeat(story_bounds[:, 0], story_lengths) +
+                               position]
+    query_offsets = np.zeros((len(query_lengths) + 1,), dtype="int32")
+    np.cumsum(query_lengths, out=query_offsets[1:])
+    return (stories, story_offsets, np.array(query_ids, dtype="int32"),
+            query_offsets, np.array(answers, dtype="int32"))
+
+
+def _convert_babi(data_path, task_number):
+    tar = tarfile.open(data_path)
+    challenge = "tasks_1-20_v1-2/en/%s_%%s.txt" % BABI_TASKS[task_number - 1]
+    word_idx = {}
+    train = _parse_babi(tar.extractfile(challenge % "train"), word_idx)
+    test = _parse_babi(tar.extractfile(challenge % "test"), word_idx)
+    tar.close()
+    # Renumber by sorted word, 0 is reserved for masking
+    vocabulary = sorted(word_idx.keys())
+    remap = np.zeros((len(word_idx) + 1,), dtype="int32")
+    for i, w in enumerate(vocabulary):
+        remap[word_idx[w]] = i + 1
+    n_train = len(train[4])
+    n_test = len(test[4])
+    return {"stories": remap[np.concatenate((train[0], test[0]))],
+            "story_offsets": np.concatenate(
+                (train[1], test[1][1:] + train[1][-1])),
+            "queries": remap[np.concatenate((train[2], test[2]))],
+            "query_offsets": np.concatenate(
+                (train[3], test[3][1:] + train[3][-1])),
+            "answers": remap[np.concatenate((train[4], test[4]))],
+            "train_indices": np.arange(n_train),
+            "valid_indices": np.arange(n_train, n_train + n_test),
+            "vocabulary": np.array(vocabulary)}
 
 
 def check_fetch_babi():
@@ -224,6 +538,9 @@ def fetch_babi(task_number=2):
     http://smerity.com/articles/2015/keras_qa.html
     https://github.com/fchollet/keras/blob/master/examples/babi_rnn.py
 
+    task_number is 1 - 20, see BABI_TASKS. The parsed task is cached on
+    disk, and later calls only load the cache.
+
     n_samples : 1000 - 10000 (task dependent)
 
     Returns
@@ -231,14 +548,15 @@ def fetch_babi(task_number=2):
     summary : dict
         A dictionary cantaining data
 
-        summary["stories"] : list
-            List of list of ints
+        summary["stories"] : array of int32 arrays
+            Flattened story token ids for each question, views into one
+            int32 buffer
 
-        summary["queries"] : list
-            List of list of ints
+        summary["queries"] : array of int32 arrays
+            Question token ids
 
-        summary["target"] : list
-            List of list of int
+        summary["target"] : array, shape (n_samples, vocabulary_size)
+            One hot answers, in floatX
 
         summary["train_indices"] : array
             Indices for training samples
@@ -246,41 +564,32 @@ def fetch_babi(task_number=2):
         summary["valid_indices"] : array
             Indices for validation samples
 
+        summary["vocabulary"] : list
+            Words for ids 1 to vocabulary_size - 1, id 0 is the mask
+
         summary["vocabulary_size"] : int
             Total vocabulary size
     """
-
+    if task_number < 1 or task_number > len(BABI_TASKS):
+        raise ValueError("task_number must be between 1 and %i, got %i" % (
+            len(BABI_TASKS), task_number))
     data_path = check_fetch_babi()
-    tar = tarfile.open(data_path)
-    if task_number == 2:
-        challenge = 'tasks_1-20_v1-2/en/qa2_two-supporting-facts_{}.txt'
-    else:
-        raise ValueError("No other supported tasks at this time")
-    # QA2 with 1000 samples
-    train = _get_stories(tar.extractfile(challenge.format('train')))
-    test = _get_stories(tar.extractfile(challenge.format('test')))
-
-    vocab = sorted(reduce(lambda x, y: x | y, (
-        set(story + q + [answer]) for story, q, answer in train + test)))
-    # Reserve 0 for masking via pad_sequences
-    vocab_size = len(vocab) + 1
-    word_idx = dict((c, i + 1) for i, c in enumerate(vocab))
-    # story_maxlen = max(map(len, (x for x, _, _ in train + test)))
-    # query_maxlen = max(map(len, (x for _, x, _ in train + test)))
-
-    X_story, X_query, y_answer = _vectorize_stories(train, vocab_size, word_idx)
-    valid_X_story, valid_X_query, valid_y_answer = _vectorize_stories(
-        test, vocab_size, word_idx)
-    train_indices = np.arange(len(y_answer))
-    valid_indices = np.arange(len(valid_y_answer)) + len(y_answer)
-
-    X_story, X_query, y_answer = _vectorize_stories(train + test, vocab_size,
-                                                    word_idx)
-    return {"stories": X_story,
-            "queries": X_query,
+    babi = _cached_dataset("babi", "babi_%s" % BABI_TASKS[task_number - 1],
+                           [data_path],
+                           lambda: _convert_babi(data_path, task_number))
+    vocabulary = list(babi["vocabulary"])
+    vocab_size = len(vocabulary) + 1
+    answers = babi["answers"]
+    y_answer = np.zeros((len(answers), vocab_size), dtype=theano.config.floatX)
+    y_answer[np.arange(len(answers)), answers] = 1.
+    return {"stories": _ragged_from_flat(babi["stories"],
+                                         babi["story_offsets"]),
+            "queries": _ragged_from_flat(babi["queries"],
+                                         babi["query_offsets"]),
             "target": y_answer,
-            "train_indices": train_indices,
-            "valid_indices": valid_indices,
+            "train_indices": babi["train_indices"],
+            "valid_indices": babi["valid_indices"],
+            "vocabulary": vocabulary,
             "vocabulary_size": vocab_size}
 
 
@@ -368,6 +677,237 @@ def load_mountains():
             "words": all_words.keys()}
 
 
+class _CorpusLines(object):
+    """ Lazy list of int32 token id arrays for each line of a corpus index
+
+    Indexing with an integer returns a view of the memory mapped ids, and
+    slices or index arrays return lists of views, so this can be passed to
+    make_embedding_minibatch like a list of lists.
+    """
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        elif isinstance(key, (list, np.ndarray)):
+            return [self[i] for i in key]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("Line %i out of range for %i lines" % (
+                key, len(self)))
+        return self.ids[self.offsets[key]:self.offsets[key + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """ Number of tokens in each line, including EOS """
+        return np.diff(self.offsets)
+
+
+def _char_ids_for_lines(lines, codepoint_ids, mapper):
+    """ Vectorized char ids for a batch of lines, with EOS (1) after each
+
+    codepoint_ids is a lookup table from unicode codepoint to id, -1 for
+    unseen characters, which get the next free ids in mapper.
+
+    Returns the ids and the number of ids in each line, including EOS.
+    """
+    lengths = np.array([len(l) for l in lines])
+    text = "".join(lines)
+    codepoints = np.frombuffer(text.encode("utf-32-le"), dtype="uint32")
+    ids = codepoint_ids[codepoints]
+    unseen = codepoints[ids < 0]
+    if len(unseen) > 0:
+        # Assign new ids in order of first appearance
+        new, first = np.unique(unseen, return_index=True)
+        for c in new[np.argsort(first)]:
+            codepoint_ids[c] = len(mapper)
+            mapper[unichr(c)] = len(mapper)
+        ids = codepoint_ids[codepoints]
+    out = np.ones((len(ids) + len(lines),), dtype="int32")
+    # Shift each line's ids past the EOS tokens of previous lines
+    out[np.arange(len(ids)) + np.repeat(np.arange(len(lines)), lengths)] = ids
+    return out, lengths + 1
+
+
+def _word_ids_for_lines(lines, mapper):
+    """ Word ids for a batch of lines and the number of ids in each line """
+    out = []
+    lengths = []
+    for l in lines:
+        words = _word_punct_re.findall(l)
+        for w in words:
+            if w not in mapper:
+                mapper[w] = len(mapper)
+            out.append(mapper[w])
+        out.append(1)
+        lengths.append(len(words) + 1)
+    return np.array(out, dtype="int32"), np.array(lengths, dtype="int64")
+
+
+def build_corpus_index(lines, save_dir, level="char", lowercase=False,
+                       batch_size=10000):
+    """
+    Stream text lines into memory mapped token ids and a vocabulary
+
+    Lines are stripped, empty lines skipped, and lines are tokenized
+    batch_size at a time into characters (level="char") or words and
+    punctuation (level="word"). Ids follow make_character_level_from_text -
+    0 is UNK, 1 is EOS (appended to every line) and tokens get increasing
+    ids in order of first appearance. Only the current batch and the
+    vocabulary are kept in memory.
+
+    save_dir gets ids.bin (int32 ids of all lines back to back),
+    offsets.bin (int64 start of each line, plus the end) and vocabulary.json
+    with the mapping and token counts, written last.
+
+    Returns load_corpus_index(save_dir).
+    """
+    if level not in ["char", "word"]:
+        raise ValueError("level must be 'char' or 'word', got %s" % level)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    mapper = {"UNK": 0, "EOS": 1}
+    if level == "char":
+        # Lookup table over every unicode codepoint
+        codepoint_ids = np.zeros((0x110000,), dtype="int32") - 1
+    counts = np.zeros((0,), dtype="int64")
+    n_tokens = 0
+    n_lines = 0
+    manifest_path = os.path.join(save_dir, "vocabulary.json")
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    def batches():
+        batch = []
+        for line in lines:
+            if not isinstance(line, str):
+                line = line.decode("utf-8")
+            line = line.strip()
+            if lowercase:
+                line = line.lower()
+            if line == "":
+                continue
+            batch.append(line)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    with open(os.path.join(save_dir, "ids.bin"), "wb") as f_ids, \
+            open(os.path.join(save_dir, "offsets.bin"), "wb") as f_offsets:
+        np.zeros((1,), dtype="int64").tofile(f_offsets)
+        for batch in batches():
+            if level == "char":
+                ids, lengths = _char_ids_for_lines(batch, codepoint_ids,
+                                                   mapper)
+            else:
+                ids, lengths = _word_ids_for_lines(batch, mapper)
+            ids.tofile(f_ids)
+            # Line ends come from the lengths, a literal "EOS" word is
+            # also id 1
+            ends = np.cumsum(lengths) + n_tokens
+            ends.astype("int64").tofile(f_offsets)
+            n_tokens += len(ids)
+            n_lines += len(batch)
+            batch_counts = np.bincount(ids, minlength=len(mapper))
+            counts = np.concatenate((counts, np.zeros(
+                (len(batch_counts) - len(counts),), dtype="int64")))
+            counts += batch_counts
+    manifest = {"level": level,
+                "lowercase": lowercase,
+                "n_tokens": n_tokens,
+                "n_lines": n_lines,
+                "mapper": mapper,
+                "counts": counts.tolist()}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return load_corpus_index(save_dir)
+
+
+def load_corpus_index(save_dir):
+    """
+    Load a corpus index written by build_corpus_index
+
+    Returns
+    -------
+    summary : dict
+        summary["data"] : _CorpusLines
+            Lazy list of int32 token id arrays, one per line and ending in
+            EOS, for use with make_embedding_minibatch
+
+        summary["ids"] : memmap, shape (n_tokens,)
+            int32 ids of all lines back to back
+
+        summary["offsets"] : memmap, shape (n_lines + 1,)
+            Start of each line in ids, followed by n_tokens
+
+        summary["mapper"] : dict
+            Token -> id, including "UNK" (0) and "EOS" (1)
+
+        summary["counts"] : array, shape (vocabulary_size,)
+            Occurrences of each id
+
+        summary["vocabulary_size"] : int
+    """
+    manifest_path = os.path.join(save_dir, "vocabulary.json")
+    if not os.path.exists(manifest_path):
+        raise ValueError("No complete corpus index in %s" % save_dir)
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest["n_tokens"] > 0:
+        ids = np.memmap(os.path.join(save_dir, "ids.bin"), dtype="int32",
+                        mode="r", shape=(manifest["n_tokens"],))
+    else:
+        ids = np.zeros((0,), dtype="int32")
+    offsets = np.memmap(os.path.join(save_dir, "offsets.bin"), dtype="int64",
+                        mode="r", shape=(manifest["n_lines"] + 1,))
+    counts = np.zeros((len(manifest["mapper"]),), dtype="int64")
+    counts[:len(manifest["counts"])] = manifest["counts"]
+    return {"data": _CorpusLines(ids, offsets),
+            "ids": ids,
+            "offsets": offsets,
+            "mapper": manifest["mapper"],
+            "counts": counts,
+            "vocabulary_size": len(manifest["mapper"])}
+
+
+def fetch_lovecraft_index(level="char"):
+    """
+    Lovecraft fiction as a memory mapped corpus index
+
+    The zip is streamed line by line into build_corpus_index on the first
+    call, and later calls load the saved index. See load_corpus_index for
+    the returned dict.
+    """
+    data_path = check_fetch_lovecraft()
+    save_dir = os.path.join(get_dataset_dir("lovecraft"),
+                            "%s_index" % level)
+    if os.path.exists(os.path.join(save_dir, "vocabulary.json")):
+        return load_corpus_index(save_dir)
+
+    def lines():
+        with zipfile.ZipFile(data_path, "r") as f:
+            for name in f.namelist():
+                if ".txt" not in name:
+                    # Skip README
+                    continue
+                with f.open(name) as text_f:
+                    for line in text_f:
+                        yield line
+
+    return build_corpus_index(lines(), save_dir, level=level)
+
+
 def check_fetch_fer():
     """ Check that fer faces are downloaded """
     url = 'https://dl.dropboxusercontent.com/u/15378192/fer2013.tar.gz'
@@ -380,7 +920,105 @@ def check_fetch_fer():
     return full_path
 
 
-def fetch_fer():
+def randomized_pca(X, n_components, indices=None, mean=None,
+                   n_oversamples=10, n_iter=4, block_size=2000,
+                   random_state=None):
+    """
+    Top principal components by randomized subspace iteration
+
+    Only rows of X are read, block_size at a time, so X can be a memmap or
+    hdf5 array larger than memory. Each power iteration is one pass over
+    the data multiplying a (n_features, n_components + n_oversamples)
+    basis by the covariance, plus one pass at the end for the small
+    eigenproblem. Memory use is O(n_features * (n_components +
+    n_oversamples) + block_size * n_features), instead of the full
+    matrices of a dense svd.
+
+    Parameters
+    ----------
+    X : array-like, shape (n_samples, n_features)
+
+    n_components : int
+
+    indices : array-like or None, default None
+        Rows of X to use, defaults to all rows.
+
+    mean : array, shape (n_features,) or None, default None
+        Mean to center rows by. Computed with an extra pass if None.
+
+    n_oversamples : int, default 10
+        Extra basis vectors, improves accuracy of the last components.
+
+    n_iter : int, default 4
+        Number of power iterations. More passes give better separation
+        of components with similar variance.
+
+    block_size : int, default 2000
+
+    random_state : RandomState or None, default None
+
+    Returns
+    -------
+    components : array, shape (n_components, n_features)
+        Principal axes sorted by explained variance, in the same layout as
+        V from svd(X - mean, full_matrices=False).
+
+    explained_variance : array, shape (n_components,)
+        Variance of the centered data along each component.
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(1999)
+    if indices is None:
+        indices = np.arange(X.shape[0])
+    else:
+        # Sorted indices keep reads from disk backed arrays sequential
+        indices = np.sort(np.asarray(indices))
+    n_samples = len(indices)
+    n_features = X.shape[1]
+    n_basis = min(n_components + n_oversamples, n_features)
+    if n_components > n_features:
+        raise ValueError("n_components %i > n_features %i" % (n_components,
+                                                              n_features))
+    contiguous = np.all(np.diff(indices) == 1)
+
+    def blocks():
+        for i in range(0, n_samples, block_size):
+            block_indices = indices[i:i + block_size]
+            if contiguous:
+                block = X[block_indices[0]:block_indices[-1] + 1]
+            else:
+                block = X[block_indices]
+            # Always a copy, blocks are centered in place
+            yield np.array(block, dtype="float64")
+
+    if mean is None:
+        mean = np.zeros((n_features,))
+        for block in blocks():
+            mean += block.sum(axis=0)
+        mean /= n_samples
+    mean = np.asarray(mean, dtype="float64")
+
+    Q = random_state.randn(n_features, n_basis)
+    Q, _ = np.linalg.qr(Q)
+    for i in range(n_iter):
+        Y = np.zeros_like(Q)
+        for block in blocks():
+            block -= mean
+            Y += np.dot(block.T, np.dot(block, Q))
+        Q, _ = np.linalg.qr(Y)
+    B = np.zeros((n_basis, n_basis))
+    for block in blocks():
+        block -= mean
+        Z = np.dot(block, Q)
+        B += np.dot(Z.T, Z)
+    eigenvalues, eigenvectors = np.linalg.eigh(B)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    components = np.dot(Q, eigenvectors[:, order]).T
+    explained_variance = eigenvalues[order] / n_samples
+    return components, explained_variance
+
+
+def fetch_fer(n_pca_components=512):
     """
     Flattened 48x48 fer faces with pixel values in [0 - 1]
 
@@ -394,41 +1032,151 @@ def fetch_fer():
 
         summary["data"] : array, shape (35888, 2304)
             The flattened data for FER
+        summary["pca_matrix"] : array, shape (n_pca_components, 2304)
+            Top principal components of the training data, from
+            randomized_pca
 
     """
     data_path = check_fetch_fer()
+    fer = _cached_dataset("fer", "fer_cache", [data_path],
+                          lambda: _convert_fer(data_path), version=2)
+
+    def convert_pca():
+        print("Saved PCA not found for FER, computing...")
+        components, _ = randomized_pca(fer["data"], n_pca_components,
+                                       indices=fer["train_indices"],
+                                       mean=fer["mean0"])
+        return {"pca_matrix": components.astype(theano.config.floatX)}
+
+    pca = _cached_dataset("fer", "fer_pca_%i" % n_pca_components,
+                          [data_path], convert_pca)
+    fer["pca_matrix"] = pca["pca_matrix"]
+    return fer
+
+
+def _iter_fer_csv(f, n_features=48 * 48, chunk_size=2000):
+    """
+    Yield (target, data) blocks of up to chunk_size rows from a FER csv
+
+    Lines are "emotion,pixels,usage" after a header line. Pixel strings are
+    joined and converted a block at a time with np.fromstring instead of per
+    value python floats, and scaled to [0 - 1] as float32.
+    """
+    def convert_chunk(targets, pixels):
+        # Pixels are integers, which parse much faster than floats. Divide
+        # in float64 to exactly match float(pixel) / 255.
+        chunk = np.fromstring(" ".join(pixels), dtype="int64", sep=" ")
+        chunk = chunk.reshape(len(targets), n_features)
+        return (np.array(targets, dtype="int32"),
+                (chunk.astype("float64") / 255.).astype("float32"))
+
+    targets = []
+    pixels = []
+    for n, line in enumerate(f):
+        if n == 0:
+            # header
+            continue
+        if not isinstance(line, str):
+            line = line.decode("ascii")
+        row = line.split(",")
+        targets.append(int(row[0]))
+        pixels.append(row[1])
+        if len(targets) == chunk_size:
+            yield convert_chunk(targets, pixels)
+            targets = []
+            pixels = []
+    if len(targets) > 0:
+        yield convert_chunk(targets, pixels)
+
+
+def _parse_fer_csv(f, n_samples=35888, n_features=48 * 48,
+                   chunk_size=2000):
+    """
+    Parse FER csv lines of "emotion,pixels,usage" into data and target
+
+    Row n of the file goes to index n of the outputs, so index 0 (the
+    header) stays zero.
+    """
+    data = np.zeros((n_samples, n_features), dtype="float32")
+    target = np.zeros((n_samples,), dtype="int32")
+    start = 1
+    for chunk_target, chunk_data in _iter_fer_csv(f, n_features, chunk_size):
+        stop = start + len(chunk_target)
+        if stop > n_samples:
+            raise ValueError("FER csv has more than %i rows" % n_samples)
+        print("Reading sample %i" % start)
+        target[start:stop] = chunk_target
+        data[start:stop] = chunk_data
+        start = stop
+    return data, target
+
+
+def _convert_fer(data_path):
     t = tarfile.open(data_path, 'r')
     f = t.extractfile(t.getnames()[0])
-    reader = csv.reader(f)
-    valid_indices = 2 * 3859
-    data = np.zeros((35888, 48 * 48), dtype="float32")
-    target = np.zeros((35888,), dtype="int32")
-    header = None
-    for n, row in enumerate(reader):
-        if n % 1000 == 0:
-            print("Reading sample %i" % n)
-        if n == 0:
-            header = row
-        else:
-            target[n] = int(row[0])
-            data[n] = np.array(map(float, row[1].split(" "))) / 255.
+    data, target = _parse_fer_csv(f)
     train_indices = np.arange(23709)
     valid_indices = np.arange(23709, len(data))
     train_mean0 = data[train_indices].mean(axis=0)
-    saved_pca_path = os.path.join(get_dataset_dir("fer"), "FER_PCA.npy")
-    if not os.path.exists(saved_pca_path):
-        print("Saved PCA not found for FER, computing...")
-        U, S, V = svd(data[train_indices] - train_mean0, full_matrices=False)
-        train_pca = V
-        np.save(saved_pca_path, train_pca)
-    else:
-        train_pca = np.load(saved_pca_path)
     return {"data": data,
             "target": target,
             "train_indices": train_indices,
             "valid_indices": valid_indices,
-            "mean0": train_mean0,
-            "pca_matrix": train_pca}
+            "mean0": train_mean0}
+
+
+def convert_fer_to_hdf5(hdf5_path=None, chunk_rows=None, complib="blosc",
+                        complevel=5):
+    """
+    Stream FER into a compressed hdf5 file, for use with add_memory_swapper
+
+    The csv is parsed and written a block at a time, so the full dataset is
+    never in memory. The file has the same arrays as fetch_fer except
+    pca_matrix - data, target, train_indices, valid_indices and mean0 - and
+    can be read with open_hdf5_dataset.
+
+    Returns the path to the hdf5 file, by default fer.hdf5 in the FER
+    dataset directory.
+    """
+    data_path = check_fetch_fer()
+    if hdf5_path is None:
+        hdf5_path = os.path.join(get_dataset_dir("fer"), "fer.hdf5")
+    n_samples = 35888
+    n_features = 48 * 48
+    n_train = 23709
+    t = tarfile.open(data_path, 'r')
+    f = t.extractfile(t.getnames()[0])
+    hdf5_file = tables.open_file(hdf5_path, "w")
+    try:
+        data = create_chunked_earray(hdf5_file, "data", (n_features,),
+                                     chunk_rows=chunk_rows, complib=complib,
+                                     complevel=complevel,
+                                     expectedrows=n_samples)
+        target = create_chunked_earray(hdf5_file, "target", (), dtype="int32",
+                                       complib=complib, complevel=complevel,
+                                       expectedrows=n_samples)
+        train_sum = np.zeros((n_features,), dtype="float64")
+        # Row 0 is the csv header, kept as zeros to match fetch_fer
+        data.append(np.zeros((1, n_features), dtype="float32"))
+        target.append(np.zeros((1,), dtype="int32"))
+        start = 1
+        for chunk_target, chunk_data in _iter_fer_csv(f, n_features):
+            print("Writing sample %i" % start)
+            n_train_chunk = max(0, min(len(chunk_data), n_train - start))
+            train_sum += chunk_data[:n_train_chunk].sum(axis=0)
+            append_from_generator(data, [chunk_data])
+            append_from_generator(target, [chunk_target])
+            start += len(chunk_data)
+        hdf5_file.create_array(hdf5_file.root, "train_indices",
+                               np.arange(n_train))
+        hdf5_file.create_array(hdf5_file.root, "valid_indices",
+                               np.arange(n_train, start))
+        hdf5_file.create_array(hdf5_file.root, "mean0",
+                               (train_sum / n_train).astype("float32"))
+    finally:
+        hdf5_file.close()
+        t.close()
+    return hdf5_path
 
 
 def check_fetch_tfd():
@@ -442,7 +1190,7 @@ def check_fetch_tfd():
     return full_path
 
 
-def fetch_tfd():
+def fetch_tfd(n_pca_components=512):
     """
     Flattened 48x48 TFD faces with pixel values in [0 - 1]
 
@@ -456,9 +1204,29 @@ def fetch_tfd():
 
         summary["data"] : array, shape (102236, 2304)
             The flattened data for TFD
+        summary["pca_matrix"] : array, shape (n_pca_components, 2304)
+            Top principal components of the training data, from
+            randomized_pca
 
     """
     data_path = check_fetch_tfd()
+    tfd = _cached_dataset("tfd", "tfd_cache", [data_path],
+                          lambda: _convert_tfd(data_path), version=2)
+
+    def convert_pca():
+        print("Saved PCA not found for TFD, computing...")
+        components, _ = randomized_pca(tfd["data"], n_pca_components,
+                                       indices=tfd["train_indices"],
+                                       mean=tfd["mean0"])
+        return {"pca_matrix": components.astype(theano.config.floatX)}
+
+    pca = _cached_dataset("tfd", "tfd_pca_%i" % n_pca_components,
+                          [data_path], convert_pca)
+    tfd["pca_matrix"] = pca["pca_matrix"]
+    return tfd
+
+
+def _convert_tfd(data_path):
     matfile = loadmat(data_path)
     all_data = matfile['images'].reshape(len(matfile['images']), -1) / 255.
     all_data = all_data.astype(theano.config.floatX)
@@ -467,23 +1235,56 @@ def fetch_tfd():
     test_indices = np.arange(valid_indices[-1] + 1, len(all_data))
     train_data = all_data[train_indices]
     train_mean0 = train_data.mean(axis=0)
-    random_state = np.random.RandomState(1999)
-    subset_indices = random_state.choice(train_indices, 25000, replace=False)
-    saved_pca_path = os.path.join(get_dataset_dir("tfd"), "TFD_PCA.npy")
-    if not os.path.exists(saved_pca_path):
-        print("Saved PCA not found for TFD, computing...")
-        U, S, V = svd(train_data[subset_indices] - train_mean0,
-                      full_matrices=False)
-        train_pca = V
-        np.save(saved_pca_path, train_pca)
-    else:
-        train_pca = np.load(saved_pca_path)
     return {"data": all_data,
             "train_indices": train_indices,
             "valid_indices": valid_indices,
             "test_indices": test_indices,
-            "mean0": train_mean0,
-            "pca_matrix": train_pca}
+            "mean0": train_mean0}
+
+
+def convert_tfd_to_hdf5(hdf5_path=None, chunk_rows=None, complib="blosc",
+                        complevel=5):
+    """
+    Write TFD into a compressed hdf5 file, for use with add_memory_swapper
+
+    The .mat file can only be read whole, but the raw uint8 images are
+    scaled to floatX and written chunk_rows at a time, so peak memory is a
+    quarter of fetch_tfd's. The file has the same arrays as fetch_tfd except
+    pca_matrix, and can be read with open_hdf5_dataset.
+
+    Returns the path to the hdf5 file, by default tfd.hdf5 in the TFD
+    dataset directory.
+    """
+    data_path = check_fetch_tfd()
+    if hdf5_path is None:
+        hdf5_path = os.path.join(get_dataset_dir("tfd"), "tfd.hdf5")
+    images = loadmat(data_path)["images"]
+    images = images.reshape(len(images), -1)
+    train_indices = np.arange(0, 90000)
+    valid_indices = np.arange(0, 10000) + len(train_indices) + 1
+    test_indices = np.arange(valid_indices[-1] + 1, len(images))
+    hdf5_file = tables.open_file(hdf5_path, "w")
+    try:
+        data = create_chunked_earray(hdf5_file, "data", images.shape[1:],
+                                     dtype=theano.config.floatX,
+                                     chunk_rows=chunk_rows, complib=complib,
+                                     complevel=complevel,
+                                     expectedrows=len(images))
+        step = data.chunkshape[0]
+        train_sum = np.zeros((images.shape[1],), dtype="float64")
+        for i in range(0, len(images), step):
+            chunk = (images[i:i + step] / 255.).astype(theano.config.floatX)
+            train_sum += chunk[:max(0, len(train_indices) - i)].sum(axis=0)
+            append_from_generator(data, [chunk])
+        hdf5_file.create_array(hdf5_file.root, "train_indices", train_indices)
+        hdf5_file.create_array(hdf5_file.root, "valid_indices", valid_indices)
+        hdf5_file.create_array(hdf5_file.root, "test_indices", test_indices)
+        mean0 = train_sum / len(train_indices)
+        hdf5_file.create_array(hdf5_file.root, "mean0",
+                               mean0.astype(theano.config.floatX))
+    finally:
+        hdf5_file.close()
+    return hdf5_path
 
 
 def check_fetch_frey():
@@ -522,23 +1323,28 @@ def fetch_frey():
             "var0": all_data.var(axis=0)}
 
 
-def check_fetch_mnist():
-    """ Check that mnist is downloaded. May need fixing for py3 compat """
+def check_fetch_mnist(force=False):
+    """ Check that mnist is downloaded. May need fixing for py3 compat
+
+    An existing file is checked against its saved SHA-256 and downloaded
+    again on mismatch. force=True downloads it again and replaces the hash.
+    """
     # py3k version is available at mnist_py3k.pkl.gz ... might need to fix
     url = 'http://www.iro.umontreal.ca/~lisa/deep/data/mnist/mnist.pkl.gz'
     partial_path = get_dataset_dir("mnist")
     full_path = os.path.join(partial_path, "mnist.pkl.gz")
     if not os.path.exists(partial_path):
         os.makedirs(partial_path)
-    if not os.path.exists(full_path):
-        download(url, full_path, progress_update_percentage=1)
-    return full_path
+    return _fetch_verified(url, full_path, force=force,
+                           progress_update_percentage=1)
 
 
-def fetch_mnist():
+def fetch_mnist(force=False):
     """
     Flattened 28x28 mnist digits with pixel values in [0 - 1]
 
+    force=True downloads the source file again, see check_fetch_mnist
+
     n_samples : 70000
     n_feature : 784
 
@@ -554,7 +1360,12 @@ def fetch_mnist():
         summary["test_indices"] : array, shape (10000,)
 
     """
-    data_path = check_fetch_mnist()
+    data_path = check_fetch_mnist(force=force)
+    return _cached_dataset("mnist", "mnist_cache", [data_path],
+                           lambda: _convert_mnist(data_path))
+
+
+def _convert_mnist(data_path):
     f = gzip.open(data_path, 'rb')
     try:
         train_set, valid_set, test_set = pickle.load(f, encoding="latin1")
@@ -599,11 +1410,13 @@ def check_fetch_binarized_mnist():
     """
 
 
-def fetch_binarized_mnist():
+def fetch_binarized_mnist(force=False):
     """
     Flattened 28x28 mnist digits with pixel of either 0 or 1, sampled from
     binomial distribution defined by the original MNIST values
 
+    force=True downloads the source file again, see check_fetch_mnist
+
     n_samples : 70000
     n_features : 784
 
@@ -619,6 +1432,12 @@ def fetch_binarized_mnist():
         summary["test_indices"] : array, shape (10000,)
 
     """
+    data_path = check_fetch_mnist(force=force)
+    return _cached_dataset("mnist", "binarized_mnist_cache", [data_path],
+                           _convert_binarized_mnist)
+
+
+def _convert_binarized_mnist():
     mnist = fetch_mnist()
     random_state = np.random.RandomState(1999)
 
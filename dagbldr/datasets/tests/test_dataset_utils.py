@@ -1,6 +1,15 @@
 from dagbldr.datasets.dataset_utils import add_memory_swapper
+from dagbldr.datasets.dataset_utils import memory_swapper_stats
+from dagbldr.datasets.dataset_utils import stop_memory_swapper
+from dagbldr.datasets.dataset_utils import create_chunked_earray
+from dagbldr.datasets.dataset_utils import append_from_generator
+from dagbldr.datasets.dataset_utils import write_dataset_to_hdf5
+from dagbldr.datasets.dataset_utils import open_hdf5_dataset
 from numpy.testing import assert_raises, assert_array_equal
 import time
+import os
+import shutil
+import tempfile
 import tables
 import numpy as np
 
@@ -16,10 +25,10 @@ def test_add_memory_swapper():
     # though times will be faster
     hdf5_file = tables.open_file("fake.hdf5", "w", driver="H5FD_CORE",
                                  driver_core_backing_store=0)
-    data = hdf5_file.createEArray(hdf5_file.root, 'data',
-                                  tables.Float32Atom(),
-                                  shape=(0, n_features0, n_features1),
-                                  expectedrows=n_samples)
+    data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                   tables.Float32Atom(),
+                                   shape=(0, n_features0, n_features1),
+                                   expectedrows=n_samples)
     random_state = np.random.RandomState(1999)
     r = random_state.rand(n_samples, n_features0,
                           n_features1).astype("float32")
@@ -27,7 +36,7 @@ def test_add_memory_swapper():
         data.append(r[n][None])
 
     # 9 MB storage
-    data = add_memory_swapper(data, mem_size=9E6)
+    data = add_memory_swapper(data, mem_size=9E6, prefetch=False)
 
     old_getter = data.__getitem__
 
@@ -53,7 +62,9 @@ def test_add_memory_swapper():
     assert np.all(data[-1] == old_getter(-1))
     assert np.all(data[-10:None] == old_getter(slice(-10, None, 1)))
     assert np.all(data[-20:-10] == old_getter(slice(-20, -10, 1)))
-    assert_raises(ValueError, lambda: data[:])
+    # Too large to cache, read directly
+    assert_array_equal(data[:], r)
+    assert memory_swapper_stats(data)["passthrough_reads"] == 1
     hdf5_file.close()
 
     # Should be fast to read things already in memory
@@ -69,10 +80,10 @@ def test_add_memory_swapper():
     # though times will be faster
     hdf5_file = tables.open_file("fake.hdf5", "w", driver="H5FD_CORE",
                                  driver_core_backing_store=0)
-    data = hdf5_file.createEArray(hdf5_file.root, 'data',
-                                  tables.Float32Atom(),
-                                  shape=(0, n_features),
-                                  expectedrows=n_samples)
+    data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                   tables.Float32Atom(),
+                                   shape=(0, n_features),
+                                   expectedrows=n_samples)
     random_state = np.random.RandomState(1999)
     r = random_state.rand(n_samples, n_features).astype("float32")
     for n in range(len(r)):
@@ -80,7 +91,7 @@ def test_add_memory_swapper():
     old_getter = data.__getitem__
 
     # 11 MB storage
-    data = add_memory_swapper(data, mem_size=11E6)
+    data = add_memory_swapper(data, mem_size=11E6, prefetch=False)
     t1 = time.time()
     assert np.all(data[:] == old_getter(slice(0, None, 1)))
     t2 = time.time()
@@ -89,5 +100,181 @@ def test_add_memory_swapper():
     assert (t3 - t2) < (t2 - t1)
     hdf5_file.close()
 
+
+def test_memory_swapper_lru_prefetch():
+    n_samples = 1000
+    n_features = 250
+    hdf5_file = tables.open_file("fake.hdf5", "w", driver="H5FD_CORE",
+                                 driver_core_backing_store=0)
+    data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                   tables.Float32Atom(),
+                                   shape=(0, n_features),
+                                   expectedrows=n_samples)
+    random_state = np.random.RandomState(1999)
+    r = random_state.rand(n_samples, n_features).astype("float32")
+    data.append(r)
+
+    # 4 chunks of 250 rows each
+    data = add_memory_swapper(data, mem_size=1E6, n_chunks=4, prefetch=False)
+    stats = memory_swapper_stats(data)
+    assert stats["chunk_size"] == 250
+    assert_array_equal(data[240:260], r[240:260])
+    assert_array_equal(data[3], r[3])
+    assert_array_equal(data[-1], r[-1])
+    assert_array_equal(data[100:900:7, 2:5], r[100:900:7, 2:5])
+    stats = memory_swapper_stats(data)
+    assert stats["misses"] == 4
+    assert stats["hits"] == 4
+    assert stats["cached_chunks"] == 4
+    hdf5_file.close()
+
+    hdf5_file = tables.open_file("fake.hdf5", "w", driver="H5FD_CORE",
+                                 driver_core_backing_store=0)
+    data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                   tables.Float32Atom(),
+                                   shape=(0, n_features),
+                                   expectedrows=n_samples)
+    data.append(r)
+    # 2 chunks of 500 rows each, chunk 0 is evicted after reading chunk 2
+    data = add_memory_swapper(data, mem_size=1E6, n_chunks=2, prefetch=True)
+    for i in range(0, n_samples, 50):
+        assert_array_equal(data[i:i + 50], r[i:i + 50])
+        # Avoid reading from the file in two threads at once in the test
+        data._swapper_queue.join()
+    stats = memory_swapper_stats(data)
+    assert stats["prefetches"] == 1
+    assert stats["prefetch_hits"] == 1
+    assert stats["misses"] == 1
+    hdf5_file.close()
+
+    # A single chunk, like the original one window swapper. Each prefetch
+    # evicts the chunk being read, so reads must still come back right
+    n_features = 2500
+    r = random_state.rand(n_samples, n_features).astype("float32")
+    hdf5_file = tables.open_file("fake.hdf5", "w", driver="H5FD_CORE",
+                                 driver_core_backing_store=0)
+    data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                   tables.Float32Atom(),
+                                   shape=(0, n_features),
+                                   expectedrows=n_samples)
+    data.append(r)
+    # 1 chunk of 100 rows
+    data = add_memory_swapper(data, mem_size=1E6, n_chunks=1, prefetch=True)
+    for i in range(0, n_samples, 50):
+        assert_array_equal(data[i:i + 50], r[i:i + 50])
+        data._swapper_queue.join()
+    stats = memory_swapper_stats(data)
+    assert stats["chunk_size"] == 100
+    assert stats["misses"] == 1
+    assert stats["prefetches"] == 9
+    assert stats["prefetch_hits"] == 9
+    assert stats["cached_chunks"] == 1
+    # The idle prefetch thread exits, and stopping ends prefetching
+    stop_memory_swapper(data)
+    for i in range(100):
+        if data._swapper_thread is None:
+            break
+        time.sleep(.01)
+    assert data._swapper_thread is None
+    data[:50]
+    data[50:100]
+    assert memory_swapper_stats(data)["prefetches"] == 9
+
+    # Arrays in one file share a read lock
+    other = hdf5_file.create_earray(hdf5_file.root, 'other',
+                                    tables.Float32Atom(),
+                                    shape=(0, n_features),
+                                    expectedrows=n_samples)
+    other.append(r)
+    other = add_memory_swapper(other, mem_size=1E6, n_chunks=1)
+    assert other._swapper_io_lock is data._swapper_io_lock
+    hdf5_file.close()
+
+
+def test_memory_swapper_fancy_index():
+    n_samples = 1000
+    n_features = 500
+    hdf5_file = tables.open_file("fake.hdf5", "w", driver="H5FD_CORE",
+                                 driver_core_backing_store=0)
+    data = hdf5_file.create_earray(hdf5_file.root, 'data',
+                                   tables.Float32Atom(),
+                                   shape=(0, n_features),
+                                   expectedrows=n_samples)
+    random_state = np.random.RandomState(1999)
+    r = random_state.rand(n_samples, n_features).astype("float32")
+    data.append(r)
+
+    # 10 chunks of 50 rows each
+    data = add_memory_swapper(data, mem_size=1E6, n_chunks=10,
+                              prefetch=False)
+    sorted_indices = np.array([3, 7, 51, 52, 140, 399])
+    assert_array_equal(data[sorted_indices], r[sorted_indices])
+    stats = memory_swapper_stats(data)
+    # chunks 0 to 2 are read together, then 7
+    assert stats["misses"] == 4
+    assert stats["passthrough_reads"] == 0
+
+    unsorted_indices = np.array([399, 3, -1, 51, 3, 140])
+    assert_array_equal(data[unsorted_indices], r[unsorted_indices])
+    assert_array_equal(data[list(unsorted_indices), 5:9],
+                       r[unsorted_indices, 5:9])
+    assert_array_equal(data[r[:, 0] > .9], r[r[:, 0] > .9])
+    assert_raises(IndexError, lambda: data[[0, n_samples]])
+
+    # Spread over every chunk, too large to cache
+    shuffled = random_state.permutation(n_samples)[:100]
+    passthrough_reads = memory_swapper_stats(data)["passthrough_reads"]
+    assert_array_equal(data[shuffled], r[shuffled])
+    n_chunks_touched = len(np.unique(shuffled // 50))
+    assert (memory_swapper_stats(data)["passthrough_reads"] -
+            passthrough_reads) == n_chunks_touched
+    hdf5_file.close()
+
+
+def test_write_dataset_to_hdf5():
+    random_state = np.random.RandomState(1999)
+    r = random_state.rand(1000, 500).astype("float32")
+    target = random_state.randint(0, 10, size=(1000,)).astype("int32")
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        hdf5_path = os.path.join(tmp_dir, "generated.hdf5")
+        hdf5_file = tables.open_file(hdf5_path, "w")
+        data = create_chunked_earray(hdf5_file, "data", (500,),
+                                     chunk_rows=64, complib="zlib",
+                                     complevel=1)
+        assert data.chunkshape == (64, 500)
+        assert data.filters.complib == "zlib"
+
+        def gen():
+            # Mix of single samples and blocks
+            for i in range(10):
+                yield r[i]
+            for i in range(10, 1000, 99):
+                yield r[i:i + 99]
+        n_written = append_from_generator(data, gen())
+        assert n_written == 1000
+        assert_raises(ValueError, append_from_generator, data,
+                      [np.zeros((2, 3))])
+        hdf5_file.close()
+        hdf5_file = tables.open_file(hdf5_path, "r")
+        assert_array_equal(hdf5_file.root.data[:], r)
+        hdf5_file.close()
+
+        hdf5_path = os.path.join(tmp_dir, "dataset.hdf5")
+        write_dataset_to_hdf5({"data": r, "target": target,
+                               "name": "random"}, hdf5_path, chunk_rows=100)
+        hdf5_file, dataset = open_hdf5_dataset(hdf5_path, mem_size=1E6)
+        assert sorted(dataset.keys()) == ["data", "target"]
+        assert isinstance(dataset["target"], np.ndarray)
+        assert_array_equal(dataset["target"], target)
+        assert_array_equal(dataset["data"][100:300], r[100:300])
+        assert memory_swapper_stats(dataset["data"])["misses"] > 0
+        hdf5_file.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
 if __name__ == "__main__":
     test_add_memory_swapper()
+    test_memory_swapper_lru_prefetch()
+    test_memory_swapper_fancy_index()
+    test_write_dataset_to_hdf5()
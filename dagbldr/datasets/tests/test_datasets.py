@@ -1,6 +1,29 @@
 from dagbldr.datasets import load_digits
 from dagbldr.datasets import load_iris
-from nose.tools import assert_equal
+from dagbldr.datasets.datasets import _cached_dataset
+from dagbldr.datasets.datasets import _parse_fer_csv
+from dagbldr.datasets.datasets import _parse_babi, _ragged_from_flat
+from dagbldr.datasets.datasets import _fetch_verified
+from dagbldr.datasets import randomized_pca
+from dagbldr.datasets import download, download_many
+from dagbldr.datasets import load_mountains
+from dagbldr.datasets import build_corpus_index, load_corpus_index
+from dagbldr.utils import make_embedding_minibatch
+from nose.tools import assert_equal, assert_raises
+from numpy.testing import assert_array_equal, assert_allclose
+from scipy.linalg import svd
+import numpy as np
+import tempfile
+import json
+import shutil
+import os
+import io
+import hashlib
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 
 def test_digits():
@@ -11,3 +34,292 @@ def test_digits():
 def test_iris():
     iris = load_iris()
     assert_equal(len(iris["data"]), len(iris["target"]))
+
+
+def test_cached_dataset():
+    tmp_dir = tempfile.mkdtemp()
+    old_data_dir = os.environ.get("DAGBLDR_DATA")
+    os.environ["DAGBLDR_DATA"] = tmp_dir
+    try:
+        source_path = os.path.join(tmp_dir, "source.txt")
+        with open(source_path, "w") as f:
+            f.write("1 2 3")
+        n_converts = []
+
+        def convert():
+            n_converts.append(1)
+            with open(source_path, "r") as f:
+                data = np.array([float(v) for v in f.read().split(" ")])
+            return {"data": data, "target": np.arange(3, dtype="int32")}
+
+        d1 = _cached_dataset("fake", "fake_cache", [source_path], convert)
+        d2 = _cached_dataset("fake", "fake_cache", [source_path], convert)
+        assert len(n_converts) == 1
+        assert isinstance(d2["data"], np.memmap)
+        assert_array_equal(d1["data"], d2["data"])
+        assert d2["target"].dtype == np.int32
+        # Copy on write, the cache is unchanged
+        d2["data"][0] = 10.
+        d3 = _cached_dataset("fake", "fake_cache", [source_path], convert)
+        assert d3["data"][0] == 1.
+        assert len(n_converts) == 1
+
+        # Same size, new content and mtime
+        with open(source_path, "w") as f:
+            f.write("4 5 6")
+        os.utime(source_path, (0, 0))
+        d4 = _cached_dataset("fake", "fake_cache", [source_path], convert)
+        assert len(n_converts) == 2
+        assert_array_equal(d4["data"], [4., 5., 6.])
+
+        # Only the mtime changed, the manifest gets the new one
+        os.utime(source_path, (1, 1))
+        _cached_dataset("fake", "fake_cache", [source_path], convert)
+        assert len(n_converts) == 2
+        manifest_path = os.path.join(tmp_dir, "fake", "fake_cache",
+                                     "manifest.json")
+        with open(manifest_path, "r") as f:
+            assert json.load(f)["sources"][0]["mtime"] == 1
+
+        _cached_dataset("fake", "fake_cache", [source_path], convert,
+                        version=2)
+        assert len(n_converts) == 3
+    finally:
+        if old_data_dir is None:
+            del os.environ["DAGBLDR_DATA"]
+        else:
+            os.environ["DAGBLDR_DATA"] = old_data_dir
+        shutil.rmtree(tmp_dir)
+
+
+def test_parse_fer_csv():
+    random_state = np.random.RandomState(1999)
+    n_rows = 7
+    n_features = 5
+    pixels = random_state.randint(0, 256, (n_rows, n_features))
+    targets = random_state.randint(0, 7, n_rows)
+    lines = ["emotion,pixels,Usage"]
+    for t, p in zip(targets, pixels):
+        lines.append("%i,%s,Training" % (t, " ".join([str(v) for v in p])))
+    csv_bytes = ("\n".join(lines) + "\n").encode("ascii")
+
+    # Row by row reference, as fetch_fer originally parsed
+    ref_data = np.zeros((n_rows + 1, n_features), dtype="float32")
+    ref_target = np.zeros((n_rows + 1,), dtype="int32")
+    for n, line in enumerate(lines[1:]):
+        row = line.split(",")
+        ref_target[n + 1] = int(row[0])
+        ref_data[n + 1] = np.array(
+            list(map(float, row[1].split(" ")))) / 255.
+
+    data, target = _parse_fer_csv(io.BytesIO(csv_bytes),
+                                  n_samples=n_rows + 1,
+                                  n_features=n_features, chunk_size=3)
+    assert data.dtype == np.float32
+    assert target.dtype == np.int32
+    assert_array_equal(data, ref_data)
+    assert_array_equal(target, ref_target)
+    assert_raises(ValueError, _parse_fer_csv, io.BytesIO(csv_bytes),
+                  n_samples=n_rows, n_features=n_features)
+
+
+def test_randomized_pca():
+    random_state = np.random.RandomState(1999)
+    n_samples = 500
+    n_features = 40
+    # Low rank structure with decaying variance plus noise
+    scales = 10. / np.arange(1, 6)
+    basis = np.linalg.qr(random_state.randn(n_features, 5))[0].T
+    X = np.dot(random_state.randn(n_samples, 5) * scales, basis)
+    X += .01 * random_state.randn(n_samples, n_features) + 3.
+
+    mean = X.mean(axis=0)
+    U, S, V = svd(X - mean, full_matrices=False)
+    X_copy = X.copy()
+    components, explained_variance = randomized_pca(X, 3, block_size=64)
+    assert_array_equal(X, X_copy)
+    assert components.shape == (3, n_features)
+    # Same subspace, up to sign
+    assert_allclose(np.abs(np.sum(components * V[:3], axis=1)), 1.,
+                    rtol=1E-4)
+    assert_allclose(explained_variance, S[:3] ** 2 / n_samples, rtol=1E-4)
+
+    # Streaming from disk over a subset of rows
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "X.npy")
+        np.save(path, X)
+        X_mmap = np.load(path, mmap_mode="r")
+        indices = random_state.permutation(n_samples)[:300]
+        sub_mean = X[indices].mean(axis=0)
+        U, S, V = svd(X[indices] - sub_mean, full_matrices=False)
+        components, _ = randomized_pca(X_mmap, 3, indices=indices,
+                                       mean=sub_mean, block_size=64)
+        assert_allclose(np.abs(np.sum(components * V[:3], axis=1)), 1.,
+                        rtol=1E-4)
+        del X_mmap
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_parse_babi():
+    lines = [b"1 Mary moved to the bathroom.\n",
+             b"2 John went to the hallway.\n",
+             b"3 Where is Mary? \tbathroom\t1\n",
+             b"4 Daniel went back to the hallway.\n",
+             b"5 Where is Daniel? \thallway\t4\n",
+             b"1 Sandra journeyed to the garden.\n",
+             b"2 Where is Sandra? \tgarden\t1\n"]
+    word_idx = {}
+    r = _parse_babi(lines, word_idx)
+    stories, story_offsets, queries, query_offsets, answers = r
+    assert stories.dtype == np.int32
+    inverse = dict((v, k) for k, v in word_idx.items())
+    stories = _ragged_from_flat(stories, story_offsets)
+    queries = _ragged_from_flat(queries, query_offsets)
+    assert len(stories) == len(queries) == len(answers) == 3
+    assert_equal(" ".join(inverse[i] for i in stories[1]),
+                 "Mary moved to the bathroom . John went to the hallway . "
+                 "Daniel went back to the hallway .")
+    assert_equal(" ".join(inverse[i] for i in stories[2]),
+                 "Sandra journeyed to the garden .")
+    assert_equal(" ".join(inverse[i] for i in queries[0]), "Where is Mary ?")
+    assert_equal([inverse[i] for i in answers],
+                 ["bathroom", "hallway", "garden"])
+
+
+def test_corpus_index():
+    lines = load_mountains()["data"]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        char_dir = os.path.join(tmp_dir, "char")
+        corpus = build_corpus_index(iter(lines), char_dir, batch_size=1000)
+        data = corpus["data"]
+        assert len(data) == len(lines)
+        assert corpus["ids"].dtype == np.int32
+        assert corpus["counts"].sum() == len(corpus["ids"])
+        assert corpus["counts"][1] == len(lines)
+        inverse = dict((v, k) for k, v in corpus["mapper"].items())
+        for i in [0, 1, 999, 1000, len(lines) - 1]:
+            assert data[i][-1] == 1
+            assert_equal("".join(inverse[c] for c in data[i][:-1]),
+                         lines[i])
+        assert_equal(sorted(corpus["mapper"].keys()),
+                     sorted(set("".join(lines)) | set(["UNK", "EOS"])))
+        mb, mask = make_embedding_minibatch(data, slice(10, 20))
+        assert len(mb) == 10
+        assert_array_equal(mask.sum(axis=0), corpus["data"].lengths()[10:20])
+
+        reloaded = load_corpus_index(char_dir)
+        assert_array_equal(reloaded["data"][5], data[5])
+
+        word_dir = os.path.join(tmp_dir, "word")
+        corpus = build_corpus_index(lines[:10], word_dir, level="word")
+        inverse = dict((v, k) for k, v in corpus["mapper"].items())
+        assert_equal(" ".join(inverse[w] for w in corpus["data"][0][:-1]),
+                     " ".join(lines[0].replace(",", " ,").replace(
+                         ".", " .").split()))
+
+        # A literal EOS word is id 1 but does not end its line
+        eos_dir = os.path.join(tmp_dir, "eos")
+        eos_lines = ["the EOS token here", "a b", "EOS"]
+        corpus = build_corpus_index(eos_lines, eos_dir, level="word")
+        assert len(corpus["data"]) == 3
+        assert_array_equal(corpus["data"].lengths(), [5, 3, 2])
+        assert_array_equal(corpus["data"][0][1], 1)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    # Serves files from the server's contents dict, honouring Range headers.
+    # Paths in the server's truncate set stop halfway the first time.
+    def do_GET(self):
+        body = self.server.contents[self.path]
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header is not None:
+            start = int(range_header.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (
+                start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        if self.path in self.server.truncate:
+            self.server.truncate.remove(self.path)
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download():
+    random_state = np.random.RandomState(1999)
+    contents = {"/a.bin": random_state.bytes(100000),
+                "/b.bin": random_state.bytes(5000),
+                "/c.bin": random_state.bytes(20000)}
+    server = HTTPServer(("127.0.0.1", 0), _RangeHandler)
+    server.contents = contents
+    server.truncate = set(["/a.bin"])
+    server.requests = []
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    url = "http://127.0.0.1:%i" % server.server_address[1]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # First response is cut short, the retry resumes with a Range request
+        a_path = os.path.join(tmp_dir, "a.bin")
+        download(url + "/a.bin", a_path, block_size=4096)
+        with open(a_path, "rb") as f:
+            assert f.read() == contents["/a.bin"]
+        assert server.requests[-1] == ("/a.bin", "bytes=50000-")
+        assert not os.path.exists(a_path + ".part")
+        with open(a_path + ".sha256") as f:
+            assert f.read().split()[0] == hashlib.sha256(
+                contents["/a.bin"]).hexdigest()
+
+        # A changed file no longer matches the saved hash
+        os.remove(a_path)
+        contents["/a.bin"] = contents["/c.bin"]
+        assert_raises(ValueError, download, url + "/a.bin", a_path)
+        assert not os.path.exists(a_path)
+        assert not os.path.exists(a_path + ".part")
+        # force replaces the stale hash
+        download(url + "/a.bin", a_path, force=True)
+        with open(a_path + ".sha256") as f:
+            assert f.read().split()[0] == hashlib.sha256(
+                contents["/c.bin"]).hexdigest()
+
+        # A corrupted local copy is fetched again, a good one is kept
+        with open(a_path, "wb") as f:
+            f.write(b"corrupt")
+        n_requests = len(server.requests)
+        _fetch_verified(url + "/a.bin", a_path)
+        with open(a_path, "rb") as f:
+            assert f.read() == contents["/c.bin"]
+        assert len(server.requests) == n_requests + 1
+        _fetch_verified(url + "/a.bin", a_path)
+        assert len(server.requests) == n_requests + 1
+
+        paths = [os.path.join(tmp_dir, f) for f in ["b.bin", "c.bin"]]
+        download_many([url + "/b.bin", url + "/c.bin"], paths,
+                      list_of_sha256=[
+                          hashlib.sha256(contents["/b.bin"]).hexdigest(),
+                          None])
+        for path, key in zip(paths, ["/b.bin", "/c.bin"]):
+            with open(path, "rb") as f:
+                assert f.read() == contents[key]
+        assert_raises(ValueError, download_many, [url + "/b.bin"],
+                      [os.path.join(tmp_dir, "b2.bin")], ["0" * 64])
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir)
@@ -9,6 +9,8 @@ from ..utils import concatenate
 from ..utils import calc_expected_dims, names_in_graph, add_arrays_to_graph
 from ..utils import add_fixed_to_graph
 from ..utils import fetch_from_graph, add_random_to_graph
+from ..utils import fetch_random_stream_from_graph, get_graph_mode
+from ..utils import add_inference_replacements_to_graph, add_layer_to_graph
 
 
 def np_zeros(shape):
@@ -64,44 +66,135 @@ def softmax(X):
     return out
 
 
+def _activation_name(func):
+    """ Name of a projection_layer func, None if it cannot be exported """
+    activations = [(None, "linear"), (linear, "linear"), (relu, "relu"),
+                   (softplus, "softplus"), (softmax, "softmax"),
+                   (tensor.nnet.sigmoid, "sigmoid"), (tensor.tanh, "tanh"),
+                   (tensor.exp, "exp")]
+    for f, activation_name in activations:
+        if func is f:
+            return activation_name
+    return None
+
+
+def _dropout_mask(X, theano_rng, p):
+    """ Binomial keep mask for X, prescaled by 1 / (1 - p) """
+    retain_prob = 1 - p
+    if X.ndim == 2:
+        shape = X.shape
+    elif X.ndim == 3:
+        # Dropout for recurrent - don't drop over time!
+        # Leading axis of length 1 keeps fake shape inference consistent
+        shape = (1, X.shape[1], X.shape[2])
+    else:
+        raise ValueError("Unsupported tensor with ndim %s" % str(X.ndim))
+    mask = theano_rng.binomial(shape, p=retain_prob, dtype=X.dtype)
+    return mask / np.cast[X.dtype](retain_prob)
+
+
 def dropout(X, random_state, on_off_switch, p=0.):
+    """
+    Dropout where on_off_switch selects the mask at runtime
+
+    random_state can be a numpy RandomState or an MRG_RandomStreams.
+    The mask is still drawn when the switch is off, see dropout_layer
+    for an evaluation path with no random number generation.
+    """
     if p > 0:
-        theano_seed = random_state.randint(-2147462579, 2147462579)
-        # Super edge case...
-        if theano_seed == 0:
-            print("WARNING: prior layer got 0 seed. Reseeding...")
-            theano_seed = random_state.randint(-2**32, 2**32)
-        theano_rng = MRG_RandomStreams(seed=theano_seed)
+        if isinstance(random_state, MRG_RandomStreams):
+            theano_rng = random_state
+        else:
+            theano_seed = random_state.randint(-2147462579, 2147462579)
+            # Super edge case...
+            if theano_seed == 0:
+                print("WARNING: prior layer got 0 seed. Reseeding...")
+                theano_seed = random_state.randint(-2**32, 2**32)
+            theano_rng = MRG_RandomStreams(seed=theano_seed)
         retain_prob = 1 - p
+        # Only rescale when dropping, so switch off is the plain input
+        scale = tensor.cast(retain_prob ** on_off_switch, X.dtype)
         if X.ndim == 2:
             X *= theano_rng.binomial(
                 X.shape, p=retain_prob,
                 dtype=theano.config.floatX) ** on_off_switch
-            X /= retain_prob
+            X /= scale
         elif X.ndim == 3:
             # Dropout for recurrent - don't drop over time!
             X *= theano_rng.binomial((
                 X.shape[1], X.shape[2]), p=retain_prob,
                 dtype=theano.config.floatX) ** on_off_switch
-            X /= retain_prob
+            X /= scale
         else:
             raise ValueError("Unsupported tensor with ndim %s" % str(X.ndim))
     return X
 
 
-def dropout_layer(list_of_inputs, graph, name, on_off_switch, dropout_prob=0.5,
-                  random_state=None):
-    theano_seed = random_state.randint(-2147462579, 2147462579)
-    # Super edge case...
-    if theano_seed == 0:
-        print("WARNING: prior layer got 0 seed. Reseeding...")
-        theano_seed = random_state.randint(-2**32, 2**32)
+def dropout_layer(list_of_inputs, graph, name, on_off_switch=None,
+                  dropout_prob=0.5, random_state=None):
+    """
+    Dropout using the random stream shared by the graph
+
+    If on_off_switch is None the output always drops. Either way the
+    undropped input is registered in the graph, so functions compiled
+    with compile_inference_function have no mask, RNG or switch input.
+    In an inference mode graph the input is returned unchanged.
+    3D inputs share one mask over time for each sequence.
+    """
     conc_input = concatenate(list_of_inputs, graph, name,
                              axis=list_of_inputs[0].ndim - 1)
-    dropped = dropout(conc_input, random_state, on_off_switch, p=dropout_prob)
+    if get_graph_mode(graph) == "inference" or dropout_prob <= 0:
+        add_layer_to_graph("dropout", name, {"inputs": list_of_inputs},
+                           [conc_input], {}, graph)
+        return conc_input
+    theano_rng = fetch_random_stream_from_graph(graph, random_state)
+    if on_off_switch is not None:
+        dropped = dropout(conc_input, theano_rng, on_off_switch,
+                          p=dropout_prob)
+        # Tag it so shape inference for later layers never needs the switch
+        shape = calc_expected_dims(graph, conc_input)
+        add_random_to_graph([dropped], [shape], [name + "_dropout"], graph)
+        add_inference_replacements_to_graph([dropped], [conc_input], graph)
+        add_layer_to_graph("dropout", name, {"inputs": list_of_inputs},
+                           [dropped], {}, graph)
+        return dropped
+    mask = _dropout_mask(conc_input, theano_rng, dropout_prob)
+    shape = calc_expected_dims(graph, conc_input)
+    if conc_input.ndim == 3:
+        shape = (1,) + tuple(shape[1:])
+    add_random_to_graph([mask], [shape], [name + "_dropout_mask"], graph)
+    if conc_input.ndim == 3:
+        mask = tensor.addbroadcast(mask, 0)
+    dropped = conc_input * mask
+    add_inference_replacements_to_graph([dropped], [conc_input], graph)
+    add_layer_to_graph("dropout", name, {"inputs": list_of_inputs},
+                       [dropped], {}, graph)
     return dropped
 
 
+def _recurrent_dropout_mask(conc_input, hidden_dim, graph, name,
+                            dropout_prob, random_state):
+    """
+    Variational mask for hidden to hidden connections, one per sequence
+
+    Sampled once outside of scan and reused at every step. Replaced by
+    ones in outputs from make_inference_outputs.
+    """
+    theano_rng = fetch_random_stream_from_graph(graph, random_state)
+    retain_prob = 1 - dropout_prob
+    batch_size = conc_input.shape[1]
+    # Sampled as (1, batch, hidden), fake shape inference changes axis 0
+    mask = theano_rng.binomial((1, batch_size, hidden_dim), p=retain_prob,
+                               dtype=theano.config.floatX)
+    mask = mask / np.cast[theano.config.floatX](retain_prob)
+    shape = (1, calc_expected_dims(graph, conc_input)[1], hidden_dim)
+    add_random_to_graph([mask], [shape], [name + "_dropout_mask"], graph)
+    mask = mask[0]
+    ones = tensor.ones((batch_size, hidden_dim), dtype=theano.config.floatX)
+    add_inference_replacements_to_graph([mask], [ones], graph)
+    return mask
+
+
 def fixed_projection_layer(list_of_inputs, transform, graph, name,
                            pre=None, post=None, strict=True):
     conc_input = concatenate(list_of_inputs, graph, name,
@@ -167,7 +260,10 @@ def embedding_layer(list_of_index_inputs, max_index, proj_dim, graph, name,
     # could sum instead?
     output = concatenate(embeddings, graph, name, axis=embedding_W.ndim - 1)
     n_lists = len(list_of_index_inputs)
-    return output.reshape((-1, n_lists, proj_dim))
+    final = output.reshape((-1, n_lists, proj_dim))
+    add_layer_to_graph("embedding", name, {"inputs": list_of_index_inputs},
+                       [final], {"W": embedding_W_name}, graph)
+    return final
 
 
 def projection_layer(list_of_inputs, graph, name, proj_dim=None,
@@ -197,6 +293,9 @@ def projection_layer(list_of_inputs, graph, name, proj_dim=None,
         final = func(output)
     else:
         final = output
+    add_layer_to_graph("projection", name, {"inputs": list_of_inputs},
+                       [final], {"W": W_name, "b": b_name}, graph,
+                       activation=_activation_name(func))
     return final
 
 
@@ -259,16 +358,25 @@ def softmax_layer(list_of_inputs, graph, name, proj_dim=None, random_state=None,
 
 def softmax_sample_layer(list_of_multinomial_inputs, graph, name,
                          random_state=None):
-    theano_seed = random_state.randint(-2147462579, 2147462579)
-    # Super edge case...
-    if theano_seed == 0:
-        print("WARNING: prior layer got 0 seed. Reseeding...")
-        theano_seed = random_state.randint(-2**32, 2**32)
-    theano_rng = MRG_RandomStreams(seed=theano_seed)
+    """
+    One hot multinomial sample, or the most probable class for inference
+    """
     conc_multinomial = concatenate(list_of_multinomial_inputs, graph,
                                    name,
                                    axis=list_of_multinomial_inputs[0].ndim - 1)
     conc_multinomial /= len(list_of_multinomial_inputs)
+    # One hot argmax, so ties still give a single class. Same type as the
+    # sample so it can stand in for it
+    argmax = tensor.argmax(conc_multinomial, axis=-1)
+    mode = tensor.cast(tensor.eq(
+        argmax.dimshuffle(list(range(argmax.ndim)) + ["x"]),
+        tensor.arange(conc_multinomial.shape[-1])), "int32")
+    if get_graph_mode(graph) == "inference":
+        add_layer_to_graph("softmax_sample", name,
+                           {"inputs": list_of_multinomial_inputs}, [mode], {},
+                           graph)
+        return mode
+    theano_rng = fetch_random_stream_from_graph(graph, random_state)
     samp = theano_rng.multinomial(pvals=conc_multinomial,
                                   dtype="int32")
     # We know shape of conc_multinomial == shape of random sample
@@ -277,21 +385,27 @@ def softmax_sample_layer(list_of_multinomial_inputs, graph, name,
     list_of_names = [name + "_random", ]
     list_of_shapes = [shape, ]
     add_random_to_graph(list_of_random, list_of_shapes, list_of_names, graph)
+    add_inference_replacements_to_graph([samp], [mode], graph)
+    add_layer_to_graph("softmax_sample", name,
+                       {"inputs": list_of_multinomial_inputs}, [samp], {},
+                       graph)
     return samp
 
 
 def gaussian_sample_layer(list_of_mu_inputs, list_of_sigma_inputs,
                           graph, name, random_state=None):
-    theano_seed = random_state.randint(-2147462579, 2147462579)
-    # Super edge case...
-    if theano_seed == 0:
-        print("WARNING: prior layer got 0 seed. Reseeding...")
-        theano_seed = random_state.randint(-2**32, 2**32)
-    theano_rng = MRG_RandomStreams(seed=theano_seed)
+    """ Returns the mean for inference """
     conc_mu = concatenate(list_of_mu_inputs, graph, name,
                           axis=list_of_mu_inputs[0].ndim - 1)
     conc_sigma = concatenate(list_of_sigma_inputs, graph, name,
                              axis=list_of_sigma_inputs[0].ndim - 1)
+    if get_graph_mode(graph) == "inference":
+        add_layer_to_graph("gaussian_sample", name,
+                           {"mu": list_of_mu_inputs,
+                            "sigma": list_of_sigma_inputs}, [conc_mu], {},
+                           graph)
+        return conc_mu
+    theano_rng = fetch_random_stream_from_graph(graph, random_state)
     e = theano_rng.normal(size=(conc_sigma.shape[0],
                                 conc_sigma.shape[1]),
                           dtype=conc_sigma.dtype)
@@ -302,22 +416,31 @@ def gaussian_sample_layer(list_of_mu_inputs, list_of_sigma_inputs,
     list_of_shapes = [shape, ]
     add_random_to_graph(list_of_random, list_of_shapes, list_of_names, graph)
     samp = conc_mu + conc_sigma * e
+    add_inference_replacements_to_graph([samp], [conc_mu], graph)
+    add_layer_to_graph("gaussian_sample", name,
+                       {"mu": list_of_mu_inputs,
+                        "sigma": list_of_sigma_inputs}, [samp], {}, graph)
     return samp
 
 
 def gaussian_log_sample_layer(list_of_mu_inputs, list_of_log_sigma_inputs,
                               graph, name, random_state=None):
-    """ log_sigma_inputs should be from a linear_layer """
-    theano_seed = random_state.randint(-2147462579, 2147462579)
-    # Super edge case...
-    if theano_seed == 0:
-        print("WARNING: prior layer got 0 seed. Reseeding...")
-        theano_seed = random_state.randint(-2**32, 2**32)
-    theano_rng = MRG_RandomStreams(seed=theano_seed)
+    """
+    log_sigma_inputs should be from a linear_layer
+
+    Returns the mean for inference
+    """
     conc_mu = concatenate(list_of_mu_inputs, graph, name,
                           axis=list_of_mu_inputs[0].ndim - 1)
     conc_log_sigma = concatenate(list_of_log_sigma_inputs, graph, name,
                                  axis=list_of_log_sigma_inputs[0].ndim - 1)
+    if get_graph_mode(graph) == "inference":
+        add_layer_to_graph("gaussian_sample", name,
+                           {"mu": list_of_mu_inputs,
+                            "log_sigma": list_of_log_sigma_inputs},
+                           [conc_mu], {}, graph)
+        return conc_mu
+    theano_rng = fetch_random_stream_from_graph(graph, random_state)
     e = theano_rng.normal(size=(conc_log_sigma.shape[0],
                                 conc_log_sigma.shape[1]),
                           dtype=conc_log_sigma.dtype)
@@ -328,6 +451,11 @@ def gaussian_log_sample_layer(list_of_mu_inputs, list_of_log_sigma_inputs,
     list_of_shapes = [shape, ]
     add_random_to_graph(list_of_random, list_of_shapes, list_of_names, graph)
     samp = conc_mu + tensor.exp(0.5 * conc_log_sigma) * e
+    add_inference_replacements_to_graph([samp], [conc_mu], graph)
+    add_layer_to_graph("gaussian_sample", name,
+                       {"mu": list_of_mu_inputs,
+                        "log_sigma": list_of_log_sigma_inputs}, [samp], {},
+                       graph)
     return samp
 
 
@@ -382,7 +510,11 @@ def tanh_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
 
 
 def gru_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
-                        random_state, strict=True):
+                        random_state, strict=True, recurrent_dropout_prob=0.):
+    """
+    recurrent_dropout_prob > 0 applies a variational (per-sequence) dropout
+    mask to the hidden state feeding the recurrent weights.
+    """
     ndim = [len(calc_expected_dims(graph, inp)) for inp in list_of_inputs]
     check = [n for n in ndim if n != 3]
     if len(check) > 0:
@@ -394,7 +526,8 @@ def gru_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
     shape = calc_expected_dims(graph, conc_input)
     h0 = np_zeros((shape[1], hidden_dim))
     list_of_names = [name + '_h0']
-    add_arrays_to_graph([h0], list_of_names, graph)
+    add_arrays_to_graph([h0], list_of_names, graph,
+                        strict=strict)
     h0_sym, = fetch_from_graph(list_of_names, graph)
 
     W_name = name + '_gru_rec_step_W'
@@ -423,21 +556,33 @@ def gru_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
 
     W, b, Urz, U = fetch_from_graph(list_of_names, graph)
     projected_input = tensor.dot(conc_input, W) + b
+    if recurrent_dropout_prob > 0 and get_graph_mode(graph) != "inference":
+        h_mask = _recurrent_dropout_mask(conc_input, hidden_dim, graph, name,
+                                         recurrent_dropout_prob, random_state)
+        # Pass explicitly, a closure would be resampled inside scan
+        non_sequences = [U, h_mask]
+    else:
+        non_sequences = [U]
 
     def _slice(arr, n):
         # First slice is tensor_dim - 1 sometimes with scan...
         # need to be *very* careful and test with strict=False and reusing stuff
         # since shape is redefined in if not names_in_graph...
-        dim = shape[1]
+        dim = hidden_dim
         if arr.ndim == 3:
             return arr[:, :, n * dim:(n + 1) * dim]
         return arr[:, n * dim:(n + 1) * dim]
 
-    def step(x_t, m_t, h_tm1, U):
-        projected_gates = tensor.dot(h_tm1, Urz)
+    def step(x_t, m_t, h_tm1, U, h_mask=None):
+        if h_mask is not None:
+            h_tm1_d = h_tm1 * h_mask
+        else:
+            h_tm1_d = h_tm1
+        projected_gates = tensor.dot(h_tm1_d, Urz)
         r = tensor.nnet.sigmoid(_slice(x_t, 0) + _slice(projected_gates, 0))
         z = tensor.nnet.sigmoid(_slice(x_t, 1) + _slice(projected_gates, 1))
-        candidate_h_t = tensor.tanh(_slice(x_t, 2) + tensor.dot(r * h_tm1, U))
+        candidate_h_t = tensor.tanh(_slice(x_t, 2) + tensor.dot(r * h_tm1_d,
+                                                                U))
         h_ti = z * h_tm1 + (1. - z) * candidate_h_t
         h_t = m_t[:, None] * h_ti + (1 - m_t)[:, None] * h_tm1
         return h_t
@@ -445,19 +590,34 @@ def gru_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
     h, updates = theano.scan(step, name=name + '_gru_recurrent_scan',
                              sequences=[projected_input, mask],
                              outputs_info=[h0_sym],
-                             non_sequences=[U])
+                             non_sequences=non_sequences)
+    add_layer_to_graph("gru_recurrent", name,
+                       {"inputs": list_of_inputs, "mask": [mask]}, [h],
+                       {"W": W_name, "b": b_name, "Urz": Urz_name,
+                        "U": U_name, "h0": name + "_h0"}, graph)
     return h
 
 
 def bidirectional_gru_recurrent_layer(list_of_inputs, mask, hidden_dim, graph,
-                                      name, random_state, strict=True):
+                                      name, random_state, strict=True,
+                                      recurrent_dropout_prob=0.):
     h_f = gru_recurrent_layer(list_of_inputs, mask, hidden_dim, graph,
-                              name + "_f", random_state, strict=strict)
+                              name + "_f", random_state, strict=strict,
+                              recurrent_dropout_prob=recurrent_dropout_prob)
     h_r = gru_recurrent_layer([i[::-1] for i in list_of_inputs], mask[::-1],
                               hidden_dim, graph, name + "_r", random_state,
-                              strict=strict)
+                              strict=strict,
+                              recurrent_dropout_prob=recurrent_dropout_prob)
     h = concatenate([h_f, h_r[::-1]], graph, name=name + "_conc",
                     axis=h_f.ndim - 1)
+    params = {}
+    for d in ["f", "r"]:
+        for p in ["W", "b", "Urz", "U"]:
+            params[d + "_" + p] = name + "_" + d + "_gru_rec_step_" + p
+        params[d + "_h0"] = name + "_" + d + "_h0"
+    add_layer_to_graph("bidirectional_gru_recurrent", name,
+                       {"inputs": list_of_inputs, "mask": [mask]}, [h],
+                       params, graph)
     return h
 
 
@@ -544,7 +704,7 @@ def conditional_gru_recurrent_layer(list_of_outputs, list_of_hiddens,
         # First slice is tensor_dim - 1 sometimes with scan...
         # need to be *very* careful and test with strict=False and reusing stuff
         # since shape is redefined in if not names_in_graph...
-        dim = shape[1]
+        dim = hidden_dim
         if arr.ndim == 3:
             return arr[:, :, n * dim:(n + 1) * dim]
         return arr[:, n * dim:(n + 1) * dim]
@@ -565,6 +725,15 @@ def conditional_gru_recurrent_layer(list_of_outputs, list_of_hiddens,
                              non_sequences=[U, projected_context_to_gates,
                                             projected_context_to_hidden])
     final_context = context.dimshuffle('x', 0, 1) * tensor.ones_like(h)
+    add_layer_to_graph("conditional_gru_recurrent", name,
+                       {"outputs": list_of_outputs,
+                        "hiddens": list_of_hiddens,
+                        "mask": [output_mask]}, [h, final_context],
+                       {"W": W_name, "b": b_name, "Urz": Urz_name,
+                        "U": U_name, "Wg": Wg_name, "bg": bg_name,
+                        "Wh": Wh_name, "bh": bh_name,
+                        "h0_W": name + "_h0_proj_W",
+                        "h0_b": name + "_h0_proj_b"}, graph)
     return h, final_context
 
 
@@ -730,7 +899,11 @@ def conditional_attention_gru_recurrent_layer(list_of_outputs, list_of_hiddens,
 
 
 def lstm_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
-                         random_state, strict=True):
+                         random_state, strict=True, recurrent_dropout_prob=0.):
+    """
+    recurrent_dropout_prob > 0 applies a variational (per-sequence) dropout
+    mask to the hidden state feeding the recurrent weights.
+    """
     ndim = [len(calc_expected_dims(graph, inp)) for inp in list_of_inputs]
     check = [n for n in ndim if n != 3]
     if len(check) > 0:
@@ -743,7 +916,8 @@ def lstm_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
     h0 = np_zeros((shape[1], hidden_dim))
     c0 = np_zeros((shape[1], hidden_dim))
     list_of_names = [name + '_h0', name + '_c0']
-    add_arrays_to_graph([h0, c0], list_of_names, graph)
+    add_arrays_to_graph([h0, c0], list_of_names, graph,
+                        strict=strict)
     h0_sym, c0_sym = fetch_from_graph(list_of_names, graph)
 
     W_name = name + '_lstm_rec_step_W'
@@ -773,18 +947,28 @@ def lstm_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
 
     W, b, U = fetch_from_graph(list_of_names, graph)
     projected_input = tensor.dot(conc_input, W) + b
+    if recurrent_dropout_prob > 0 and get_graph_mode(graph) != "inference":
+        h_mask = _recurrent_dropout_mask(conc_input, hidden_dim, graph, name,
+                                         recurrent_dropout_prob, random_state)
+        # Pass explicitly, a closure would be resampled inside scan
+        non_sequences = [U, h_mask]
+    else:
+        non_sequences = [U]
 
     def _slice(arr, n):
         # First slice is tensor_dim - 1 sometimes with scan...
         # need to be *very* careful and test with strict=False and reusing stuff
         # since shape is redefined in if not names_in_graph...
-        dim = shape[1]
+        dim = hidden_dim
         if arr.ndim == 3:
             return arr[:, :, n * dim:(n + 1) * dim]
         return arr[:, n * dim:(n + 1) * dim]
 
-    def step(x_t, m_t, h_tm1, c_tm1, U):
-        projected_gates = tensor.dot(h_tm1, U) + x_t
+    def step(x_t, m_t, h_tm1, c_tm1, U, h_mask=None):
+        if h_mask is not None:
+            projected_gates = tensor.dot(h_tm1 * h_mask, U) + x_t
+        else:
+            projected_gates = tensor.dot(h_tm1, U) + x_t
         i = tensor.nnet.sigmoid(_slice(projected_gates, 0))
         o = tensor.nnet.sigmoid(_slice(projected_gates, 1))
         f = tensor.nnet.sigmoid(_slice(projected_gates, 2))
@@ -799,5 +983,9 @@ def lstm_recurrent_layer(list_of_inputs, mask, hidden_dim, graph, name,
     (h, c), updates = theano.scan(step, name=name + '_lstm_recurrent_scan',
                                   sequences=[projected_input, mask],
                                   outputs_info=[h0_sym, c0_sym],
-                                  non_sequences=[U])
+                                  non_sequences=non_sequences)
+    add_layer_to_graph("lstm_recurrent", name,
+                       {"inputs": list_of_inputs, "mask": [mask]}, [h],
+                       {"W": W_name, "b": b_name, "U": U_name,
+                        "h0": name + "_h0", "c0": name + "_c0"}, graph)
     return h
@@ -10,12 +10,15 @@ from dagbldr.optimizers import sgd
 from dagbldr.utils import add_embedding_datasets_to_graph, convert_to_one_hot
 from dagbldr.utils import add_datasets_to_graph
 from dagbldr.utils import get_params_and_grads, make_embedding_minibatch
+from dagbldr.utils import make_inference_outputs, compile_inference_function
+from dagbldr.utils import set_graph_mode
 from dagbldr.nodes import fixed_projection_layer, embedding_layer
 from dagbldr.nodes import projection_layer, linear_layer, softmax_layer
 from dagbldr.nodes import sigmoid_layer, tanh_layer, softplus_layer
 from dagbldr.nodes import exp_layer, relu_layer, dropout_layer
 from dagbldr.nodes import softmax_sample_layer, gaussian_sample_layer
 from dagbldr.nodes import gaussian_log_sample_layer
+from dagbldr.nodes import gru_recurrent_layer, lstm_recurrent_layer
 
 # Common between tests
 digits = load_digits()
@@ -56,8 +59,113 @@ def test_dropout_layer():
     f = theano.function([X_sym, on_off], [dropped], mode="FAST_COMPILE")
     drop = f(np.ones_like(X), 1)[0]
     full = f(np.ones_like(X), 0)[0]
-    # Make sure drop switch works
-    assert_almost_equal((full.sum() / 2) / drop.sum(), 1., decimal=2)
+    # Make sure drop switch works, dropping keeps the expected sum
+    assert_almost_equal(full.sum() / drop.sum(), 1., decimal=2)
+    # Switched off is the same as the inference function
+    f_inf, _ = compile_inference_function([X_sym], [dropped], graph,
+                                          mode="FAST_COMPILE")
+    assert_almost_equal(full, f_inf(np.ones_like(X))[0])
+    assert_almost_equal(full, np.ones_like(X))
+
+
+def _has_rng_op(f):
+    return any(["mrg_uniform" in str(node.op).lower()
+                for node in f.maker.fgraph.apply_nodes])
+
+
+def test_dropout_layer_strip():
+    random_state = np.random.RandomState(42)
+    graph = OrderedDict()
+    X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], graph)
+    d1 = dropout_layer([X_sym], graph, 'd1', random_state=random_state)
+    l1 = linear_layer([d1], graph, 'l1', proj_dim=20,
+                      random_state=random_state)
+    d2 = dropout_layer([l1], graph, 'd2', dropout_prob=0.2)
+    train_f = theano.function([X_sym], [d1, d2], mode="FAST_COMPILE")
+    eval_d1, eval_d2 = make_inference_outputs([d1, d2], graph)
+    eval_f = theano.function([X_sym], [eval_d1, eval_d2],
+                             mode="FAST_COMPILE")
+    assert _has_rng_op(train_f)
+    assert not _has_rng_op(eval_f)
+    drop, _ = train_f(np.ones_like(X))
+    full, _ = eval_f(np.ones_like(X))
+    assert_almost_equal(full, np.ones_like(X))
+    assert_almost_equal(drop.mean(), 1., decimal=1)
+    # Random stream and dropout bookkeeping are not parameters
+    params, grads = get_params_and_grads(graph, d2.sum())
+    assert len(params) == 2
+
+
+def test_recurrent_dropout():
+    random_state = np.random.RandomState(1999)
+    X_r = random_state.randn(5, 4, 3).astype(theano.config.floatX)
+    mask = np.ones((5, 4)).astype(theano.config.floatX)
+    for layer in [gru_recurrent_layer, lstm_recurrent_layer]:
+        graph = OrderedDict()
+        X_sym, mask_sym = add_datasets_to_graph([X_r, mask], ["X", "mask"],
+                                                graph)
+        h = layer([X_sym], mask_sym, 6, graph, 'rec', random_state)
+        h_drop = layer([X_sym], mask_sym, 6, graph, 'rec', random_state,
+                       strict=False, recurrent_dropout_prob=0.5)
+        h_eval, = make_inference_outputs([h_drop], graph)
+        f = theano.function([X_sym, mask_sym], [h, h_drop],
+                            mode="FAST_COMPILE")
+        eval_f = theano.function([X_sym, mask_sym], [h_eval],
+                                 mode="FAST_COMPILE")
+        assert not _has_rng_op(eval_f)
+        h_out, h_drop_out = f(X_r, mask)
+        h_eval_out, = eval_f(X_r, mask)
+        assert_almost_equal(h_out, h_eval_out, decimal=5)
+        assert np.abs(h_out - h_drop_out).max() > 1E-3
+
+
+def test_inference_function():
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+    X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], graph)
+    on_off = tensor.iscalar()
+    d1 = dropout_layer([X_sym], graph, 'd1', on_off,
+                       random_state=random_state)
+    mu = linear_layer([d1], graph, 'mu', proj_dim=8,
+                      random_state=random_state)
+    log_sigma = linear_layer([d1], graph, 'log_sigma', proj_dim=8,
+                             random_state=random_state)
+    samp = gaussian_log_sample_layer([mu], [log_sigma], graph, 'samp',
+                                     random_state=random_state)
+    soft = softmax_layer([samp], graph, 'soft', proj_dim=n_classes,
+                         random_state=random_state)
+    cat = softmax_sample_layer([soft], graph, 'cat',
+                               random_state=random_state)
+    f, used = compile_inference_function([X_sym, on_off], [soft, cat],
+                                         graph, mode="FAST_COMPILE")
+    # The switch and all noise are gone
+    assert len(used) == 1
+    assert not _has_rng_op(f)
+    soft_out, cat_out = f(X)
+    assert cat_out.dtype == np.int32
+    assert np.all(cat_out.argmax(axis=1) == soft_out.argmax(axis=1))
+    assert_almost_equal(soft_out, f(X)[0])
+    # Intermediate inputs are kept as inputs
+    decode, used = compile_inference_function([samp], [soft], graph,
+                                              mode="FAST_COMPILE")
+    assert used[0] is samp
+
+    # Same result from a graph built in inference mode
+    inf_graph = OrderedDict()
+    X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], inf_graph)
+    set_graph_mode(inf_graph, "inference")
+    for k in ["mu_W", "mu_b", "log_sigma_W", "log_sigma_b", "soft_W",
+              "soft_b"]:
+        inf_graph[k] = graph[k]
+    d1 = dropout_layer([X_sym], inf_graph, 'd1')
+    mu = linear_layer([d1], inf_graph, 'mu', strict=False)
+    log_sigma = linear_layer([d1], inf_graph, 'log_sigma', strict=False)
+    samp = gaussian_log_sample_layer([mu], [log_sigma], inf_graph, 'samp')
+    soft = softmax_layer([samp], inf_graph, 'soft', strict=False)
+    f_inf = theano.function([X_sym], [soft], mode="FAST_COMPILE")
+    assert not _has_rng_op(f_inf)
+    assert_almost_equal(soft_out, f_inf(X)[0])
+    assert_raises(ValueError, set_graph_mode, inf_graph, "eval")
 
 
 def test_embedding_layer():
@@ -166,6 +274,17 @@ def test_softmax_sample_layer():
                        random_state=random_state)
     f = theano.function([X_sym], [out], mode="FAST_COMPILE")
 
+    # Inference mode is one hot even when probabilities tie
+    tie_graph = OrderedDict()
+    p_sym = tensor.fmatrix()
+    set_graph_mode(tie_graph, "inference")
+    mode = softmax_sample_layer([p_sym], tie_graph, 'tied')
+    f_mode = theano.function([p_sym], [mode], mode="FAST_COMPILE")
+    pvals = np.array([[.4, .4, .2], [.1, .2, .7]], dtype="float32")
+    result = f_mode(pvals)[0]
+    assert result.dtype == np.int32
+    assert_almost_equal(result, [[1, 0, 0], [0, 0, 1]])
+
 
 def test_gaussian_sample_layer():
     random_state = np.random.RandomState(42)
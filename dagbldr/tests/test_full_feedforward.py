@@ -5,6 +5,7 @@ import theano
 from dagbldr.utils import add_datasets_to_graph, convert_to_one_hot
 from dagbldr.utils import get_params_and_grads
 from dagbldr.utils import early_stopping_trainer
+from dagbldr.utils import shared_dataset_givens, make_index_minibatch
 from dagbldr.nodes import linear_layer, softmax_layer
 from dagbldr.nodes import categorical_crossentropy
 from dagbldr.optimizers import sgd
@@ -87,3 +88,51 @@ def test_feedforward_theano_mix():
                            fit_function_output_names=["cost"],
                            cost_function_output_name="valid_cost",
                            n_epochs=1)
+
+
+def test_feedforward_shared_dataset():
+    minibatch_size = 100
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+
+    X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], graph)
+
+    l1_o = linear_layer([X_sym], graph, 'l1', proj_dim=20,
+                        random_state=random_state)
+    y_pred = softmax_layer([l1_o], graph, 'pred', n_classes,
+                           random_state=random_state)
+
+    cost = categorical_crossentropy(y_pred, y_sym).mean()
+    params, grads = get_params_and_grads(graph, cost)
+    learning_rate = 0.001
+    opt = sgd(params)
+    updates = opt.updates(params, grads, learning_rate)
+
+    index_syms, givens = shared_dataset_givens([X_sym, y_sym], [X, y])
+    fit_function = theano.function(index_syms, [cost], updates=updates,
+                                   givens=givens, mode="FAST_COMPILE")
+    cost_function = theano.function(index_syms, [cost], givens=givens,
+                                    mode="FAST_COMPILE")
+    direct_cost_function = theano.function([X_sym, y_sym], [cost],
+                                           mode="FAST_COMPILE")
+    start, stop, indices = make_index_minibatch(X, slice(100, 200))
+    assert (start, stop, len(indices)) == (100, 200, 0)
+    assert indices.dtype == "int32"
+    np.testing.assert_allclose(cost_function(start, stop, indices),
+                               direct_cost_function(X[100:200], y[100:200]),
+                               rtol=1E-5)
+    shuffled = np.arange(100, 200)[::-1]
+    np.testing.assert_allclose(
+        cost_function(*make_index_minibatch(X, shuffled)),
+        direct_cost_function(X[shuffled], y[shuffled]), rtol=1E-5)
+
+    checkpoint_dict = {}
+    train_indices = np.arange(1000)
+    valid_indices = np.arange(1000, len(X))
+    early_stopping_trainer(fit_function, cost_function, checkpoint_dict, [X],
+                           minibatch_size,
+                           train_indices, valid_indices,
+                           list_of_minibatch_functions=[make_index_minibatch],
+                           fit_function_output_names=["cost"],
+                           cost_function_output_name="valid_cost",
+                           n_epochs=1)
@@ -4,3 +4,8 @@ __version__ = '.'.join(__version_info__)
 from .utils import *
 from .plot_utils import *
 from .training_utils import *
+from .parallel_utils import *
+from .inference_runtime import *
+from .quantization_utils import *
+from .export_utils import *
+from .serving_utils import *
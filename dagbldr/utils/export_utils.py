@@ -0,0 +1,128 @@
+# Author: Kyle Kastner
+# License: BSD 3-clause
+import os
+import json
+import shutil
+import numpy as np
+from collections import OrderedDict
+
+from .utils import LAYERS_ID, TAG_ID, expression_name
+from .quantization_utils import get_quantized_params
+from . import inference_runtime
+from .inference_runtime import MANIFEST_NAME, WEIGHTS_NAME, RUNTIME_NAME
+from .inference_runtime import FORMAT_VERSION
+
+
+def _input_name(expression, n):
+    if expression.name is not None and TAG_ID in expression.name:
+        return expression_name(expression)
+    if expression.name is not None:
+        return expression.name
+    return "input_%i" % n
+
+
+def export_graph(list_of_inputs, list_of_outputs, graph, save_dir):
+    """
+    Write the layers needed for list_of_outputs as NumPy weights and JSON
+
+    Only layers recorded by the standard nodes (projection family,
+    embedding, dropout, sample layers, gru / lstm / bidirectional gru /
+    conditional gru) can be exported, and every layer input must be one
+    of list_of_inputs or the output of another recorded layer. Dropout is
+    dropped and sample layers return their mean, as for
+    compile_inference_function.
+
+    save_dir receives manifest.json, weights.npz and dagbldr_runtime.py,
+    a copy of the NumPy only runtime. Load with load_inference_model.
+    Parameters quantized with quantize_graph_params are written as int8
+    with their scales, and dequantized on the fly by the runtime.
+
+    Parameters
+    ----------
+    list_of_inputs : list of theano variables
+    list_of_outputs : list of theano variables
+    graph : OrderedDict
+    save_dir : str
+
+    Returns
+    -------
+    manifest : dict
+    """
+    if LAYERS_ID not in graph.keys():
+        raise ValueError("No exportable layers found in graph!")
+    layers = graph[LAYERS_ID]
+    # Later registrations win, matching reuse with strict=False
+    producer = {}
+    for n, layer in enumerate(layers):
+        for k, out in enumerate(layer["outputs"]):
+            producer[id(out)] = (n, k)
+    input_index = dict((id(inp), n) for n, inp in enumerate(list_of_inputs))
+
+    needed = set()
+    stack = list(list_of_outputs)
+    while len(stack) > 0:
+        expression = stack.pop()
+        if id(expression) in input_index:
+            continue
+        if id(expression) not in producer:
+            raise ValueError("Expression %s is not an input or the output "
+                             "of an exportable layer" % str(expression))
+        n, k = producer[id(expression)]
+        if n in needed:
+            continue
+        needed.add(n)
+        for role, inputs in layers[n]["inputs"].items():
+            stack.extend(inputs)
+
+    order = sorted(needed)
+    position = dict((n, i) for i, n in enumerate(order))
+
+    def ref(expression):
+        if id(expression) in input_index:
+            return ["input", input_index[id(expression)]]
+        n, k = producer[id(expression)]
+        return ["layer", position[n], k]
+
+    manifest_layers = []
+    weights = OrderedDict()
+    quantized_params = get_quantized_params(graph)
+    quantized = OrderedDict()
+    for n in order:
+        layer = layers[n]
+        if layer["type"] == "projection":
+            if layer["options"]["activation"] is None:
+                raise ValueError("Layer %s uses an activation that cannot "
+                                 "be exported" % layer["name"])
+        for param_name in layer["params"].values():
+            if param_name in quantized_params:
+                scale_name = param_name + "_scale"
+                weights[param_name], weights[scale_name] = quantized_params[
+                    param_name]
+                quantized[param_name] = scale_name
+            else:
+                weights[param_name] = graph[param_name].get_value()
+        manifest_layers.append(OrderedDict([
+            ("type", layer["type"]), ("name", layer["name"]),
+            ("inputs", OrderedDict((role, [ref(i) for i in inputs])
+                                   for role, inputs
+                                   in layer["inputs"].items())),
+            ("params", layer["params"]), ("options", layer["options"])]))
+
+    manifest = OrderedDict([
+        ("format_version", FORMAT_VERSION),
+        ("inputs", [OrderedDict([("name", _input_name(inp, n)),
+                                 ("dtype", inp.dtype),
+                                 ("ndim", inp.ndim)])
+                    for n, inp in enumerate(list_of_inputs)]),
+        ("outputs", [ref(out) for out in list_of_outputs]),
+        ("layers", manifest_layers),
+        ("quantized", quantized)])
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    with open(os.path.join(save_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    np.savez(os.path.join(save_dir, WEIGHTS_NAME), **weights)
+    runtime_path = os.path.splitext(inference_runtime.__file__)[0] + ".py"
+    shutil.copy(runtime_path, os.path.join(save_dir, RUNTIME_NAME))
+    return manifest
@@ -0,0 +1,367 @@
+# Author: Kyle Kastner
+# License: BSD 3-clause
+"""
+NumPy only forward passes for models written by export_graph.
+
+This file is copied next to the exported weights, so it must not import
+theano or anything else from dagbldr. Load an export with
+
+    from dagbldr_runtime import load_inference_model
+    model = load_inference_model(export_dir)
+    out, = model(X)
+"""
+import os
+import json
+import numpy as np
+
+MANIFEST_NAME = "manifest.json"
+WEIGHTS_NAME = "weights.npz"
+RUNTIME_NAME = "dagbldr_runtime.py"
+# Version 2 adds int8 parameters listed under "quantized"
+FORMAT_VERSION = 2
+
+
+def _sigmoid(x):
+    # In place 1 / (1 + exp(-x))
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    np.reciprocal(x, out=x)
+    return x
+
+
+def _tanh(x):
+    return np.tanh(x, out=x)
+
+
+def _relu(x):
+    return np.maximum(x, 0., out=x)
+
+
+def _softplus(x):
+    np.logaddexp(0., x, out=x)
+    x += 1E-4
+    return x
+
+
+def _exp(x):
+    return np.exp(x, out=x)
+
+
+def _softmax(x):
+    x -= x.max(axis=-1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=-1, keepdims=True)
+    return x
+
+
+def _linear(x):
+    return x
+
+
+_activations = {"linear": _linear, "sigmoid": _sigmoid, "tanh": _tanh,
+                "relu": _relu, "softplus": _softplus, "exp": _exp,
+                "softmax": _softmax}
+
+
+def _concat(list_of_arrays, dtype):
+    if len(list_of_arrays) == 1:
+        return np.asarray(list_of_arrays[0], dtype=dtype)
+    return np.concatenate([np.asarray(a, dtype=dtype)
+                           for a in list_of_arrays], axis=-1)
+
+
+class InferenceModel(object):
+    """
+    Runs the layers of an exported dagbldr graph with NumPy
+
+    Intermediate results are written into buffers which are allocated
+    once per layer and input shape, then reused by every later call with
+    the same shapes. Returned outputs are copies, so they stay valid.
+
+    int8 projection weights are used as they are and their per column
+    scales are applied to the product, (x . W) * scale. NumPy has no int8
+    matrix product, so np.dot still converts W to float internally on
+    every call - int8 exports are about 4x smaller on disk and in memory,
+    but no faster than float32 ones, and slower for small batches.
+    Embedding rows are dequantized as they
+    are looked up, and other int8 parameters into a reused buffer.
+
+    Parameters
+    ----------
+    manifest : dict
+        Parsed manifest.json
+    weights : dict
+        Mapping from graph parameter name to array
+    """
+    def __init__(self, manifest, weights):
+        if manifest.get("format_version") not in (1, FORMAT_VERSION):
+            raise ValueError("Unsupported export format version %s" %
+                             str(manifest.get("format_version")))
+        self.manifest = manifest
+        self.weights = weights
+        self.quantized = manifest.get("quantized", {})
+        self.input_names = [i["name"] for i in manifest["inputs"]]
+        self._buffers = {}
+        self._runners = {"projection": self._run_projection,
+                         "embedding": self._run_embedding,
+                         "dropout": self._run_dropout,
+                         "gaussian_sample": self._run_gaussian_sample,
+                         "softmax_sample": self._run_softmax_sample,
+                         "gru_recurrent": self._run_gru,
+                         "lstm_recurrent": self._run_lstm,
+                         "bidirectional_gru_recurrent":
+                         self._run_bidirectional_gru,
+                         "conditional_gru_recurrent":
+                         self._run_conditional_gru}
+        for layer in manifest["layers"]:
+            if layer["type"] not in self._runners:
+                raise ValueError("Unknown layer type %s for layer %s" % (
+                    layer["type"], layer["name"]))
+        float_names = sorted([k for k in weights.keys()
+                              if k not in self.quantized])
+        if len(float_names) > 0:
+            self.dtype = weights[float_names[0]].dtype
+        else:
+            self.dtype = np.dtype("float32")
+
+    def _buffer(self, key, shape, dtype=None):
+        if dtype is None:
+            dtype = self.dtype
+        full_key = (key, tuple(shape), np.dtype(dtype).str)
+        if full_key not in self._buffers:
+            self._buffers[full_key] = np.empty(shape, dtype=dtype)
+        return self._buffers[full_key]
+
+    def _affine(self, key, x, W_name, b_name):
+        """ x . W + b for 2D or 3D x, written into a reused buffer
+
+        Scales of an int8 W are applied to x . W, not to W.
+        """
+        W = self.weights[W_name]
+        out = self._buffer(key, x.shape[:-1] + (W.shape[1],))
+        x2 = np.ascontiguousarray(x, dtype=self.dtype).reshape(
+            (-1, x.shape[-1]))
+        np.dot(x2, W, out=out.reshape((-1, W.shape[1])))
+        if W_name in self.quantized:
+            out *= self.weights[self.quantized[W_name]]
+        out += self._weight(key, b_name)
+        return out
+
+    def _weight(self, key, name):
+        """ Float weights, dequantized into a reused buffer if int8 """
+        if name not in self.quantized:
+            return self.weights[name]
+        quantized = self.weights[name]
+        scale = self.weights[self.quantized[name]]
+        out = self._buffer((key, name), quantized.shape)
+        np.multiply(quantized, scale, out=out)
+        return out
+
+    def _run_projection(self, n, layer, inputs):
+        p = layer["params"]
+        x = _concat(inputs["inputs"], self.dtype)
+        out = self._affine(n, x, p["W"], p["b"])
+        return [_activations[layer["options"]["activation"]](out)]
+
+    def _run_embedding(self, n, layer, inputs):
+        name = layer["params"]["W"]
+        W = self.weights[name]
+        list_of_indices = inputs["inputs"]
+        out = self._buffer(n, (len(list_of_indices[0]),
+                               len(list_of_indices), W.shape[1]))
+        for k, idx in enumerate(list_of_indices):
+            rows = W[np.asarray(idx, dtype="int32")]
+            if name in self.quantized:
+                np.multiply(rows, self.weights[self.quantized[name]],
+                            out=out[:, k])
+            else:
+                out[:, k] = rows
+        return [out]
+
+    def _run_dropout(self, n, layer, inputs):
+        return [_concat(inputs["inputs"], self.dtype)]
+
+    def _run_gaussian_sample(self, n, layer, inputs):
+        # Deterministic, the mean is used in place of a sample
+        return [_concat(inputs["mu"], self.dtype)]
+
+    def _run_softmax_sample(self, n, layer, inputs):
+        # Deterministic, one hot most probable class
+        pvals = _concat(inputs["inputs"], self.dtype)
+        eye = np.eye(pvals.shape[-1], dtype="int32")
+        return [eye[pvals.argmax(axis=-1)]]
+
+    def _gru_scan(self, key, projected, mask, Urz, U, h0,
+                  context_gates=None, context_hidden=None):
+        n_steps, batch_size = projected.shape[:2]
+        dim = U.shape[0]
+        h = self._buffer((key, "h"), (n_steps, batch_size, dim))
+        gates = self._buffer((key, "gates"), (batch_size, 2 * dim))
+        r = self._buffer((key, "r"), (batch_size, dim))
+        z = self._buffer((key, "z"), (batch_size, dim))
+        cand = self._buffer((key, "cand"), (batch_size, dim))
+        rh = self._buffer((key, "rh"), (batch_size, dim))
+        h_tm1 = h0
+        for t in range(n_steps):
+            x_t = projected[t]
+            m_t = mask[t][:, None]
+            np.dot(h_tm1, Urz, out=gates)
+            if context_gates is not None:
+                gates += context_gates
+            np.add(x_t[:, :dim], gates[:, :dim], out=r)
+            _sigmoid(r)
+            np.add(x_t[:, dim:2 * dim], gates[:, dim:], out=z)
+            _sigmoid(z)
+            if context_gates is None:
+                # Plain GRU resets before the recurrent projection
+                np.multiply(r, h_tm1, out=rh)
+                np.dot(rh, U, out=cand)
+            else:
+                # Conditional GRU resets after it
+                np.dot(h_tm1, U, out=cand)
+                cand *= r
+                cand += context_hidden
+            cand += x_t[:, 2 * dim:]
+            _tanh(cand)
+            # h_t = m * (z * h_tm1 + (1 - z) * cand) + (1 - m) * h_tm1
+            #     = h_tm1 + m * (1 - z) * (cand - h_tm1)
+            cand -= h_tm1
+            np.subtract(1., z, out=z)
+            z *= m_t
+            cand *= z
+            np.add(h_tm1, cand, out=h[t])
+            h_tm1 = h[t]
+        return h
+
+    def _initial_state(self, n, layer, role, batch_size, dim):
+        """ Trained initial state of a recurrent layer, zeros if absent """
+        if role not in layer["params"]:
+            # Exports older than the recorded initial states
+            return np.zeros((batch_size, dim), dtype=self.dtype)
+        state = self._weight(n, layer["params"][role])
+        if state.shape[0] != batch_size:
+            raise ValueError("Layer %s has %s %s with %i rows, which must "
+                             "match the batch size but got batch size %i" % (
+                                 layer["name"], role,
+                                 layer["params"][role], state.shape[0],
+                                 batch_size))
+        return state
+
+    def _run_gru(self, n, layer, inputs):
+        p = layer["params"]
+        x = _concat(inputs["inputs"], self.dtype)
+        mask = np.asarray(inputs["mask"][0], dtype=self.dtype)
+        projected = self._affine((n, "proj"), x, p["W"], p["b"])
+        U = self._weight(n, p["U"])
+        h0 = self._initial_state(n, layer, "h0", x.shape[1], U.shape[0])
+        Urz = self._weight(n, p["Urz"])
+        return [self._gru_scan(n, projected, mask, Urz, U, h0)]
+
+    def _run_bidirectional_gru(self, n, layer, inputs):
+        p = layer["params"]
+        x = _concat(inputs["inputs"], self.dtype)
+        mask = np.asarray(inputs["mask"][0], dtype=self.dtype)
+        hs = []
+        for d, x_d, mask_d in [("f", x, mask), ("r", x[::-1], mask[::-1])]:
+            projected = self._affine((n, d, "proj"), x_d, p[d + "_W"],
+                                     p[d + "_b"])
+            U = self._weight(n, p[d + "_U"])
+            h0 = self._initial_state(n, layer, d + "_h0", x.shape[1],
+                                     U.shape[0])
+            hs.append(self._gru_scan((n, d), projected, mask_d,
+                                     self._weight(n, p[d + "_Urz"]), U, h0))
+        return [np.concatenate([hs[0], hs[1][::-1]], axis=-1)]
+
+    def _run_conditional_gru(self, n, layer, inputs):
+        p = layer["params"]
+
+        def w(key):
+            return self._weight(n, key)
+
+        conc_output = _concat(inputs["outputs"], self.dtype)
+        context = _concat(inputs["hiddens"], self.dtype)[-1]
+        mask = np.asarray(inputs["mask"][0], dtype=self.dtype)
+        h0 = _tanh(self._affine((n, "h0"), context, p["h0_W"], p["h0_b"]))
+        shifted = self._buffer((n, "shifted"), conc_output.shape)
+        shifted[0] = 0.
+        shifted[1:] = conc_output[:-1]
+        projected = self._affine((n, "proj"), shifted, p["W"], p["b"])
+        context_gates = self._affine((n, "pcg"), context, p["Wg"], p["bg"])
+        context_hidden = self._affine((n, "pch"), context, p["Wh"], p["bh"])
+        h = self._gru_scan(n, projected, mask, w(p["Urz"]), w(p["U"]), h0,
+                           context_gates, context_hidden)
+        # Read only view repeating context over time, np.broadcast_to needs
+        # numpy 1.10
+        final_context = np.lib.stride_tricks.as_strided(
+            context, shape=h.shape[:1] + context.shape,
+            strides=(0,) + context.strides)
+        final_context.flags.writeable = False
+        return [h, final_context]
+
+    def _run_lstm(self, n, layer, inputs):
+        p = layer["params"]
+        x = _concat(inputs["inputs"], self.dtype)
+        mask = np.asarray(inputs["mask"][0], dtype=self.dtype)
+        projected = self._affine((n, "proj"), x, p["W"], p["b"])
+        U = self._weight(n, p["U"])
+        dim = U.shape[0]
+        n_steps, batch_size = projected.shape[:2]
+        h = self._buffer((n, "h"), (n_steps, batch_size, dim))
+        gates = self._buffer((n, "gates"), (batch_size, 4 * dim))
+        c_t = self._buffer((n, "c"), (batch_size, dim))
+        tmp = self._buffer((n, "tmp"), (batch_size, dim))
+        c_t[:] = self._initial_state(n, layer, "c0", batch_size, dim)
+        h_tm1 = self._initial_state(n, layer, "h0", batch_size, dim)
+        for t in range(n_steps):
+            m_t = mask[t][:, None]
+            np.dot(h_tm1, U, out=gates)
+            gates += projected[t]
+            i = _sigmoid(gates[:, :dim])
+            o = _sigmoid(gates[:, dim:2 * dim])
+            f = _sigmoid(gates[:, 2 * dim:3 * dim])
+            c = _tanh(gates[:, 3 * dim:])
+            # c_t = m * (f * c_tm1 + i * c) + (1 - m) * c_tm1
+            #     = c_tm1 + m * ((f - 1) * c_tm1 + i * c)
+            f -= 1.
+            f *= c_t
+            c *= i
+            c += f
+            c *= m_t
+            c_t += c
+            # h_t = h_tm1 + m * (o * tanh(c_t) - h_tm1)
+            np.tanh(c_t, out=tmp)
+            tmp *= o
+            tmp -= h_tm1
+            tmp *= m_t
+            np.add(h_tm1, tmp, out=h[t])
+            h_tm1 = h[t]
+        return [h]
+
+    def __call__(self, *args):
+        if len(args) != len(self.input_names):
+            raise ValueError("Expected %i inputs (%s), got %i" % (
+                len(self.input_names), ", ".join(self.input_names),
+                len(args)))
+        results = []
+
+        def fetch(ref):
+            if ref[0] == "input":
+                return args[ref[1]]
+            return results[ref[1]][ref[2]]
+
+        for n, layer in enumerate(self.manifest["layers"]):
+            inputs = dict((role, [fetch(r) for r in refs])
+                          for role, refs in layer["inputs"].items())
+            results.append(self._runners[layer["type"]](n, layer, inputs))
+        # Buffers are reused by the next call
+        return [np.array(fetch(r)) for r in self.manifest["outputs"]]
+
+
+def load_inference_model(export_dir):
+    """ Load the InferenceModel saved in export_dir by export_graph """
+    with open(os.path.join(export_dir, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    with np.load(os.path.join(export_dir, WEIGHTS_NAME)) as npz:
+        weights = dict((k, npz[k]) for k in npz.files)
+    return InferenceModel(manifest, weights)
@@ -0,0 +1,483 @@
+# Author: Kyle Kastner
+# License: BSD 3-clause
+from __future__ import print_function
+import multiprocessing
+import traceback
+import itertools
+import os
+import numpy as np
+import theano
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .training_utils import _iterate_function, make_minibatch
+from .training_utils import default_status_func, monitor_status_func
+from .training_utils import get_checkpoint_dir, _fork_context
+
+
+def _updated_shared_variables(fit_function):
+    """ Shared variables updated by a compiled function, in input order
+
+    This is the parameters and any optimizer state such as momentum.
+    """
+    return [i.variable for i in fit_function.maker.inputs
+            if isinstance(i.variable, theano.compile.SharedVariable) and
+            i.update is not None]
+
+
+def _to_shared_memory(arr):
+    """ Copy an array into process shared memory, returns numpy view """
+    arr = np.asarray(arr)
+    # Raw bytes work for any dtype without np.ctypeslib.as_ctypes_type,
+    # which old numpy lacks
+    raw = multiprocessing.RawArray("b", max(arr.nbytes, 1))
+    shared_arr = np.frombuffer(raw, dtype=arr.dtype, count=arr.size)
+    shared_arr = shared_arr.reshape(arr.shape)
+    shared_arr[...] = arr
+    return shared_arr
+
+
+class _ProcessBarrier(object):
+    """ Stand in for multiprocessing.Barrier (python 3.3+), wait and abort
+
+    wait raises RuntimeError, the base of threading.BrokenBarrierError,
+    once the barrier is aborted.
+    """
+    def __init__(self, ctx, parties):
+        self.parties = parties
+        self.condition = ctx.Condition()
+        self.count = ctx.RawValue("i", 0)
+        self.generation = ctx.RawValue("i", 0)
+        self.broken = ctx.RawValue("i", 0)
+
+    def wait(self):
+        with self.condition:
+            if self.broken.value:
+                raise RuntimeError("Barrier aborted")
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.parties:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+                return
+            while (generation == self.generation.value and
+                   not self.broken.value):
+                self.condition.wait()
+            if generation == self.generation.value:
+                raise RuntimeError("Barrier aborted")
+
+    def abort(self):
+        with self.condition:
+            self.broken.value = 1
+            self.condition.notify_all()
+
+
+def _make_barrier(ctx, parties):
+    if hasattr(ctx, "Barrier"):
+        return ctx.Barrier(parties)
+    return _ProcessBarrier(ctx, parties)
+
+
+class _SyncedFunction(object):
+    """
+    Wraps a compiled function to synchronize updated shared variables
+
+    Synchronization happens every sync_every calls and at the end of every
+    epoch of n_minibatches calls.
+
+    sync_mode "average" waits for all workers then replaces local values
+    with the mean over workers. sync_mode "hogwild" adds the local change
+    since the last synchronization to the shared values without locking
+    or waiting, then continues from the shared values.
+    """
+    def __init__(self, fit_function, shared_values, sync_mode, sync_every,
+                 n_minibatches, n_workers, worker_id, barrier, lock):
+        self.fit_function = fit_function
+        self.variables = _updated_shared_variables(fit_function)
+        self.shared_values = shared_values
+        self.sync_mode = sync_mode
+        self.sync_every = sync_every
+        self.n_minibatches = n_minibatches
+        self.n_workers = n_workers
+        self.worker_id = worker_id
+        self.barrier = barrier
+        self.lock = lock
+        self.n_calls = 0
+        self.n_syncs = 0
+        self._pull()
+
+    def _pull(self):
+        self.snapshots = [s.copy() for s in self.shared_values]
+        for v, s in zip(self.variables, self.snapshots):
+            v.set_value(s)
+
+    def _average(self):
+        self.barrier.wait()
+        if self.worker_id == 0:
+            for s in self.shared_values:
+                s[...] = 0
+        self.barrier.wait()
+        with self.lock:
+            for v, s in zip(self.variables, self.shared_values):
+                s += v.get_value(borrow=True) / self.n_workers
+        self.barrier.wait()
+        self._pull()
+
+    def _hogwild(self):
+        for v, s, old in zip(self.variables, self.shared_values,
+                             self.snapshots):
+            s += v.get_value(borrow=True) - old
+        self._pull()
+
+    def sync(self):
+        if self.sync_mode == "average":
+            self._average()
+        else:
+            self._hogwild()
+        self.n_syncs += 1
+
+    def __call__(self, *args):
+        outputs = self.fit_function(*args)
+        self.n_calls += 1
+        if (self.n_calls % self.sync_every == 0 or
+                self.n_calls % self.n_minibatches == 0):
+            self.sync()
+        return outputs
+
+
+def _data_parallel_worker(worker_id, synced_function, list_of_minibatch_args,
+                          minibatch_size, shard_indices, result_queue,
+                          iterate_kwargs):
+    try:
+        epoch_results = _iterate_function(
+            synced_function, list_of_minibatch_args, minibatch_size,
+            indices=shard_indices, **iterate_kwargs)
+        if worker_id != 0:
+            epoch_results = None
+        result_queue.put((worker_id, None, epoch_results))
+    except Exception:
+        if synced_function.barrier is not None:
+            # Don't leave other workers waiting on a dead process
+            synced_function.barrier.abort()
+        result_queue.put((worker_id, traceback.format_exc(), None))
+
+
+def data_parallel_trainer(fit_function, list_of_minibatch_args,
+                          minibatch_size, train_indices,
+                          n_workers=None, sync_mode="average",
+                          sync_every=10,
+                          list_of_minibatch_functions=[make_minibatch],
+                          fit_function_output_names=None,
+                          list_of_non_minibatch_args=None,
+                          list_of_preprocessing_functions=None,
+                          n_epochs=100, n_epoch_status=1,
+                          epoch_status_func=default_status_func,
+                          n_minibatch_status=.1,
+                          previous_epoch_results=None,
+                          shuffle=False, random_state=None,
+                          verbose=False):
+    """
+    Train fit_function with n_workers forked processes on shards of data
+
+    train_indices is split into n_workers disjoint shards of equal size,
+    trimmed to a multiple of minibatch_size so every worker runs the same
+    number of minibatches. Each worker runs _iterate_function over its shard
+    with its own copy of the compiled fit_function. The shared variables
+    updated by fit_function (parameters and optimizer state) are kept in
+    process shared memory.
+
+    sync_mode "average" waits for all workers every sync_every minibatches
+    and at the end of each epoch, then sets every worker to the mean of the
+    worker values. sync_mode "hogwild" pushes each worker's change since its
+    last sync into the shared values without waiting or locking - with
+    sync_every=1 this is Hogwild! style asynchronous SGD.
+
+    Only worker 0 runs epoch_status_func and minibatch monitoring, and its
+    epoch_results are returned. Sample counts in them are for one shard.
+    When training finishes the shared values are copied back into the
+    shared variables of fit_function in this process.
+
+    Workers are forked, so this needs a platform with fork. Set BLAS
+    threads to 1 (e.g. OMP_NUM_THREADS=1) to avoid oversubscribing cores.
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if n_workers < 1:
+        raise ValueError("n_workers must be >= 1")
+    if sync_mode not in ["average", "hogwild"]:
+        raise ValueError("Unknown sync_mode %s" % sync_mode)
+    if sync_every < 1:
+        raise ValueError("sync_every must be >= 1")
+    if shuffle:
+        assert random_state is not None
+
+    shards = np.array_split(np.asarray(train_indices), n_workers)
+    shard_size = min([len(s) for s in shards])
+    shard_size -= shard_size % minibatch_size
+    if shard_size == 0:
+        raise ValueError("Each of the %i workers needs at least "
+                         "minibatch_size=%i train_indices" % (n_workers,
+                                                              minibatch_size))
+    shards = [s[:shard_size] for s in shards]
+    n_minibatches = shard_size // minibatch_size
+
+    variables = _updated_shared_variables(fit_function)
+    shared_values = [_to_shared_memory(v.get_value()) for v in variables]
+
+    ctx = _fork_context()
+    if sync_mode == "average":
+        barrier = _make_barrier(ctx, n_workers)
+    else:
+        barrier = None
+    lock = ctx.Lock()
+    result_queue = ctx.Queue()
+    if random_state is not None:
+        seeds = random_state.randint(0, 2 ** 31 - 1, n_workers)
+    workers = []
+    for worker_id in range(n_workers):
+        synced_function = _SyncedFunction(
+            fit_function, shared_values, sync_mode, sync_every,
+            n_minibatches, n_workers, worker_id, barrier, lock)
+        iterate_kwargs = {
+            "list_of_minibatch_functions": list_of_minibatch_functions,
+            "list_of_non_minibatch_args": list_of_non_minibatch_args,
+            "list_of_preprocessing_functions":
+                list_of_preprocessing_functions,
+            "list_of_output_names": fit_function_output_names,
+            "n_epochs": n_epochs, "n_epoch_status": n_epoch_status,
+            "n_minibatch_status": n_minibatch_status,
+            "shuffle": shuffle, "verbose": verbose}
+        if worker_id == 0:
+            iterate_kwargs["epoch_status_func"] = epoch_status_func
+            iterate_kwargs["minibatch_status_func"] = monitor_status_func
+            iterate_kwargs["previous_epoch_results"] = previous_epoch_results
+        else:
+            iterate_kwargs["epoch_status_func"] = None
+            iterate_kwargs["minibatch_status_func"] = None
+        if random_state is not None:
+            iterate_kwargs["random_state"] = np.random.RandomState(
+                seeds[worker_id])
+        p = ctx.Process(target=_data_parallel_worker,
+                        args=(worker_id, synced_function,
+                              list_of_minibatch_args, minibatch_size,
+                              shards[worker_id], result_queue,
+                              iterate_kwargs))
+        p.start()
+        workers.append(p)
+
+    # Empty the queue before joining so large results can't block workers
+    errors = []
+    epoch_results = None
+    received = []
+    while len(received) < n_workers:
+        # A worker that had already exited, with nothing in the queue after
+        # the timeout, was killed without sending a result
+        dead = [i for i, p in enumerate(workers)
+                if i not in received and not p.is_alive()]
+        try:
+            worker_id, error, results = result_queue.get(timeout=1.)
+        except queue.Empty:
+            if len(dead) > 0:
+                for p in workers:
+                    if p.is_alive():
+                        p.terminate()
+                    p.join()
+                raise ValueError("Workers %s exited without a result, exit "
+                                 "codes %s" % (dead, [workers[i].exitcode
+                                                      for i in dead]))
+            continue
+        received.append(worker_id)
+        if error is not None:
+            errors.append("Worker %i failed:\n%s" % (worker_id, error))
+        if worker_id == 0:
+            epoch_results = results
+    for p in workers:
+        p.join()
+    if len(errors) > 0:
+        raise ValueError("\n".join(errors))
+
+    for v, s in zip(variables, shared_values):
+        v.set_value(s.copy())
+    return epoch_results
+
+
+def memmap_dataset(dataset, save_dir):
+    """
+    Save the arrays in a dataset dictionary and reload them memory mapped
+
+    Memory mapped arrays are shared between processes through the OS page
+    cache, so many workers can read one copy of a dataset. Existing files
+    are overwritten. Non-array values are kept as they are.
+
+    Parameters
+    ----------
+    dataset : dict
+        Dataset dictionary, such as the output of fetch_mnist.
+
+    save_dir : str
+        Directory for the .npy files, created if needed.
+
+    Returns
+    -------
+    memmapped : dict
+        Same keys as dataset, with arrays replaced by read-only memmaps.
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    memmapped = {}
+    for k, v in dataset.items():
+        if isinstance(v, np.ndarray) and v.dtype != object:
+            path = os.path.join(save_dir, "%s.npy" % k)
+            np.save(path, v)
+            memmapped[k] = np.load(path, mmap_mode="r")
+        else:
+            memmapped[k] = v
+    return memmapped
+
+
+def make_param_grid(param_lists):
+    """ All combinations of a dict of parameter lists, as a list of dicts
+
+    make_param_grid({"lr": [.1, .01], "n_hid": [128]}) gives
+    [{"lr": .1, "n_hid": 128}, {"lr": .01, "n_hid": 128}]
+    """
+    keys = sorted(param_lists.keys())
+    return [dict(zip(keys, values)) for values in
+            itertools.product(*[param_lists[k] for k in keys])]
+
+
+class _TrialStopped(Exception):
+    pass
+
+
+class _TrialReporter(object):
+    """
+    Callable passed to each trial as report(epoch_results)
+
+    Implements the median stopping rule - after grace_period reports, a
+    trial stops if its best value of stopping_key so far is worse (higher)
+    than the median of the best values other trials had after the same
+    number of reports. At least min_trials_for_stopping other trials must
+    have reached that point.
+    """
+    def __init__(self, trial_id, history, stopping_key, grace_period,
+                 min_trials_for_stopping):
+        self.trial_id = trial_id
+        self.history = history
+        self.stopping_key = stopping_key
+        self.grace_period = grace_period
+        self.min_trials_for_stopping = min_trials_for_stopping
+
+    def __call__(self, epoch_results):
+        values = [float(np.mean(v)) for v in epoch_results[self.stopping_key]]
+        # Manager dicts only see assignments, not in place changes
+        self.history[self.trial_id] = values
+        n_reports = len(values)
+        if n_reports <= self.grace_period:
+            return
+        other_bests = [min(h[:n_reports])
+                       for trial_id, h in self.history.items()
+                       if trial_id != self.trial_id and len(h) >= n_reports]
+        if len(other_bests) < self.min_trials_for_stopping:
+            return
+        median_best = np.median(other_bests)
+        if min(values) > median_best:
+            raise _TrialStopped("Trial %i stopped after %i reports, best %s "
+                                "%f worse than median %f" % (
+                                    self.trial_id, n_reports,
+                                    self.stopping_key, min(values),
+                                    median_best))
+
+
+# Set before forking the sweep pool so trial functions and datasets are
+# inherited rather than pickled
+_sweep_state = {}
+
+
+def _run_trial(trial_id, params, trial_dir, reporter):
+    trial_function = _sweep_state["trial_function"]
+    dataset = _sweep_state["dataset"]
+    # get_checkpoint_dir reads DAGBLDR_MODELS, giving each trial its own
+    # checkpoint folder. Pool processes run a single trial each.
+    os.environ["DAGBLDR_MODELS"] = trial_dir
+    trial_results = {"trial_id": trial_id, "params": params,
+                     "checkpoint_dir": get_checkpoint_dir(),
+                     "stopped_early": False, "error": None, "result": None}
+    try:
+        trial_results["result"] = trial_function(params, dataset, reporter)
+    except _TrialStopped as e:
+        print(str(e))
+        trial_results["stopped_early"] = True
+    except Exception:
+        trial_results["error"] = traceback.format_exc()
+        print("Trial %i failed:\n%s" % (trial_id, trial_results["error"]))
+    trial_results["history"] = list(reporter.history.get(trial_id, []))
+    return trial_results
+
+
+def sweep_runner(trial_function, list_of_params, dataset=None,
+                 n_processes=None, sweep_dir=None, memmap=True,
+                 stopping_key="valid_cost", grace_period=3,
+                 min_trials_for_stopping=3):
+    """
+    Run hyperparameter trials in a pool of forked processes
+
+    Each trial calls trial_function(params, dataset, report) in a fresh
+    process, where params is one entry of list_of_params. report should be
+    called with the trial's epoch_results after each validation, for
+    example from the epoch_status_func given to _iterate_function. It
+    raises an exception to end trials which are doing worse than the
+    median of the other trials on stopping_key (lower is better) - let it
+    propagate out of trial_function.
+
+    dataset is loaded once. With memmap=True arrays are saved to
+    sweep_dir/dataset and memory mapped, so every trial reads the same copy
+    through the page cache instead of re-fetching or copying it.
+
+    Each trial gets DAGBLDR_MODELS=sweep_dir/trial_<n>, so checkpoints and
+    monitors from get_checkpoint_dir are kept per trial. sweep_dir defaults
+    to a sweep folder in the current checkpoint directory.
+
+    Returns
+    -------
+    sweep_results : list of dict
+        One dict per trial, in the order of list_of_params, with keys
+        trial_id, params, checkpoint_dir, result (the return value of
+        trial_function, None if stopped or failed), stopped_early, error
+        (traceback string or None) and history (reported stopping_key
+        values).
+    """
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    if sweep_dir is None:
+        sweep_dir = os.path.join(get_checkpoint_dir(), "sweep")
+    if not os.path.exists(sweep_dir):
+        os.makedirs(sweep_dir)
+    if dataset is not None and memmap:
+        dataset = memmap_dataset(dataset, os.path.join(sweep_dir, "dataset"))
+    _sweep_state["trial_function"] = trial_function
+    _sweep_state["dataset"] = dataset
+
+    ctx = _fork_context()
+    manager = ctx.Manager()
+    history = manager.dict()
+    # One trial per process keeps theano and environment state separate
+    pool = ctx.Pool(n_processes, maxtasksperchild=1)
+    try:
+        async_results = []
+        for trial_id, params in enumerate(list_of_params):
+            trial_dir = os.path.join(sweep_dir, "trial_%i" % trial_id)
+            reporter = _TrialReporter(trial_id, history, stopping_key,
+                                      grace_period, min_trials_for_stopping)
+            async_results.append(pool.apply_async(
+                _run_trial, (trial_id, params, trial_dir, reporter)))
+        sweep_results = [r.get() for r in async_results]
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+        _sweep_state.clear()
+    return sweep_results
@@ -14,7 +14,13 @@ def _get_js_path():
     return js_path
 
 
-def _filled_js_template_from_results_dict(results_dict, default_show="all"):
+# The template and js dependencies never change, so only read them once
+_js_template_cache = {}
+
+
+def _get_js_template_parts():
+    if "parts" in _js_template_cache:
+        return _js_template_cache["parts"]
     # Uses arbiter strings in the template to split the template and stick
     # values in
     js_path = _get_js_path()
@@ -39,9 +45,19 @@ def _filled_js_template_from_results_dict(results_dict, default_show="all"):
     post_imports_part = all_template_lines[
         imports_split_index + 1:data_split_index]
     last_part = all_template_lines[data_split_index + 1:]
+    parts = (first_part, imports_part, post_imports_part, last_part)
+    _js_template_cache["parts"] = parts
+    return parts
+
+
+def _filled_js_template_from_results_dict(results_dict, default_show="all"):
+    first_part, imports_part, post_imports_part, last_part = \
+        _get_js_template_parts()
 
     def gen_js_field_for_key_value(key, values, show=True):
-        assert type(values) is list
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        values = list(values)
         if isinstance(values[0], (np.generic, np.ndarray)):
             values = [float(v.ravel()) for v in values]
         maxlen = 1500
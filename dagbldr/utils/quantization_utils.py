@@ -0,0 +1,108 @@
+# Author: Kyle Kastner
+# License: BSD 3-clause
+import numpy as np
+import theano
+from theano import tensor
+from collections import OrderedDict
+
+from .utils import LAYERS_ID, QUANTIZED_ID
+from .utils import add_inference_replacements_to_graph
+
+# Layer types whose W is quantized by default
+_QUANTIZABLE_LAYERS = ("projection", "embedding")
+
+
+def quantize_array(arr):
+    """
+    Symmetric int8 quantization of a 2D array with one scale per column
+
+    Returns
+    -------
+    quantized : int8 array, same shape as arr
+    scale : array of shape (arr.shape[1],), same dtype as arr
+
+    arr is approximated by quantized * scale.
+    """
+    arr = np.asarray(arr)
+    if arr.ndim != 2:
+        raise ValueError("Only 2D arrays can be quantized, got shape %s" %
+                         str(arr.shape))
+    scale = np.abs(arr).max(axis=0) / 127.
+    # All zero columns would divide by zero
+    scale[scale == 0] = 1.
+    quantized = np.clip(np.round(arr / scale), -127, 127).astype("int8")
+    return quantized, scale.astype(arr.dtype)
+
+
+def dequantize_array(quantized, scale):
+    """ Inverse of quantize_array """
+    return quantized.astype(scale.dtype) * scale
+
+
+def quantize_graph_params(graph, list_of_names=None):
+    """
+    Post-training int8 quantization of graph parameters
+
+    Each parameter gets int8 values and per-column scales, stored as
+    shared variables under graph["__quantized__"]. It is replaced by its
+    on the fly dequantization in compile_inference_function and
+    make_inference_outputs, and export_graph writes the int8 values. The
+    float parameter itself is left as is, so training is unaffected.
+    Quantizing again after more training refreshes the stored values.
+
+    This only saves space: int8 weights are about 4x smaller on disk and
+    in memory. Theano has no int8 matrix product, so compiled functions
+    dequantize the whole weight on every call and are slower than float32
+    ones. The NumPy runtime applies the scales to x . W instead, which is
+    cheaper, but still no faster than float32.
+
+    Parameters
+    ----------
+    graph : OrderedDict
+    list_of_names : list of str, optional (default=None)
+        Names of 2D parameters in graph. Default is the W of every
+        projection and embedding layer in the graph.
+
+    Returns
+    -------
+    list_of_names : list of str
+        The quantized parameter names
+    """
+    if list_of_names is None:
+        if LAYERS_ID not in graph.keys():
+            raise ValueError("No layers recorded in graph, pass "
+                             "list_of_names explicitly")
+        list_of_names = []
+        for layer in graph[LAYERS_ID]:
+            if layer["type"] in _QUANTIZABLE_LAYERS:
+                name = layer["params"]["W"]
+                if name not in list_of_names:
+                    list_of_names.append(name)
+    missing = [n for n in list_of_names if n not in graph.keys()]
+    if len(missing) > 0:
+        raise ValueError("Parameters %s not found in graph" % missing)
+    if QUANTIZED_ID not in graph.keys():
+        graph[QUANTIZED_ID] = OrderedDict()
+    for name in list_of_names:
+        quantized, scale = quantize_array(graph[name].get_value())
+        if name in graph[QUANTIZED_ID]:
+            quantized_sym, scale_sym = graph[QUANTIZED_ID][name]
+            quantized_sym.set_value(quantized)
+            scale_sym.set_value(scale)
+            continue
+        quantized_sym = theano.shared(quantized, name=name + "_int8")
+        scale_sym = theano.shared(scale, name=name + "_scale")
+        graph[QUANTIZED_ID][name] = (quantized_sym, scale_sym)
+        dequantized = tensor.cast(quantized_sym, str(scale.dtype))
+        dequantized = dequantized * scale_sym
+        add_inference_replacements_to_graph([graph[name]], [dequantized],
+                                            graph)
+    return list_of_names
+
+
+def get_quantized_params(graph):
+    """ Map of quantized parameter name to (int8 array, scale array) """
+    if QUANTIZED_ID not in graph.keys():
+        return OrderedDict()
+    return OrderedDict((k, (q.get_value(), s.get_value()))
+                       for k, (q, s) in graph[QUANTIZED_ID].items())
@@ -0,0 +1,390 @@
+# Author: Kyle Kastner
+# License: BSD 3-clause
+from __future__ import print_function
+import threading
+import traceback
+import socket
+import struct
+import time
+import numpy as np
+from collections import deque, Counter
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .training_utils import load_checkpoint
+
+# Reserved request name to fetch server statistics
+STATS_ID = "__stats__"
+_HEADER = struct.Struct("!Q")
+
+
+def _send_message(sock, obj):
+    payload = pickle.dumps(obj, protocol=-1)
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, n_bytes):
+    chunks = []
+    while n_bytes > 0:
+        chunk = sock.recv(min(n_bytes, 1 << 20))
+        if len(chunk) == 0:
+            return None
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_message(sock):
+    """ Returns None if the other side closed the connection """
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    payload = _recv_exactly(sock, _HEADER.unpack(header)[0])
+    if payload is None:
+        return None
+    return pickle.loads(payload)
+
+
+class _Request(object):
+    def __init__(self, args):
+        self.args = [np.asarray(a) for a in args]
+        self.n = len(self.args[0]) if len(self.args) > 0 else 0
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+    def compatible(self, other):
+        """ Requests can share a batch if everything but axis 0 matches """
+        if len(self.args) != len(other.args):
+            return False
+        return all(a.dtype == b.dtype and a.shape[1:] == b.shape[1:]
+                   for a, b in zip(self.args, other.args))
+
+
+class _ServerStats(object):
+    """ Thread safe running statistics for one served function """
+    def __init__(self, n_latencies=10000):
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=n_latencies)
+
+    def record_batch(self, batch, queue_depth):
+        finished = time.time()
+        with self.lock:
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            self.batch_sizes[sum([r.n for r in batch])] += 1
+            self.latencies.extend([finished - r.arrival for r in batch])
+
+    def summary(self, queue_depth):
+        with self.lock:
+            latencies = list(self.latencies)
+            summary = {"n_requests": self.n_requests,
+                       "n_batches": self.n_batches,
+                       "queue_depth": queue_depth,
+                       "max_queue_depth": self.max_queue_depth,
+                       "batch_sizes": dict(self.batch_sizes)}
+        if len(latencies) > 0:
+            summary["latency_p50"] = float(np.percentile(latencies, 50))
+            summary["latency_p99"] = float(np.percentile(latencies, 99))
+        else:
+            summary["latency_p50"] = None
+            summary["latency_p99"] = None
+        return summary
+
+
+class _MicroBatcher(object):
+    """
+    Coalesces concurrent requests to one function into batches
+
+    The dispatch thread takes the oldest request, then waits for more
+    until max_batch_size rows are collected or max_latency seconds have
+    passed since the oldest request arrived. Arguments are concatenated
+    along axis 0, and outputs with a leading axis matching the batch are
+    split back per request. Other outputs are returned whole.
+    """
+    def __init__(self, function, max_batch_size, max_latency):
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        # Requests which did not fit the previous batch
+        self.carry = deque()
+        self.stats = _ServerStats()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def queue_depth(self):
+        return self.queue.qsize() + len(self.carry)
+
+    def submit(self, args):
+        request = _Request(args)
+        self.queue.put(request)
+        request.done.wait()
+        return request
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _next(self, timeout=None):
+        if len(self.carry) > 0:
+            return self.carry.popleft()
+        if timeout is None:
+            return self.queue.get()
+        return self.queue.get(timeout=timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._next()
+            if first is None:
+                break
+            batch = [first]
+            n_rows = first.n
+            deadline = first.arrival + self.max_latency
+            while n_rows < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._next(timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                if (not first.compatible(request) or
+                        n_rows + request.n > self.max_batch_size):
+                    self.carry.append(request)
+                    break
+                batch.append(request)
+                n_rows += request.n
+            queue_depth = self.queue_depth()
+            self._dispatch(batch, n_rows)
+            self.stats.record_batch(batch, queue_depth)
+        # Fail anything still waiting so handlers do not hang
+        while True:
+            try:
+                request = self._next(0.)
+            except queue.Empty:
+                break
+            if request is not None:
+                request.error = "Server is shutting down"
+                request.done.set()
+
+    def _dispatch(self, batch, n_rows):
+        try:
+            if len(batch) == 1:
+                args = batch[0].args
+            else:
+                args = [np.concatenate([r.args[i] for r in batch], axis=0)
+                        for i in range(len(batch[0].args))]
+            outputs = self.function(*args)
+            start = 0
+            for r in batch:
+                r.outputs = [o[start:start + r.n]
+                             if np.ndim(o) > 0 and len(o) == n_rows else o
+                             for o in outputs]
+                start += r.n
+        except Exception:
+            error = traceback.format_exc()
+            for r in batch:
+                r.error = error
+        for r in batch:
+            r.done.set()
+
+
+class _InferenceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.inference_server
+        while True:
+            message = _recv_message(self.request)
+            if message is None:
+                break
+            function_name, args = message
+            if function_name == STATS_ID:
+                _send_message(self.request, ("ok", server.stats()))
+            elif function_name not in server.batchers:
+                _send_message(self.request, (
+                    "error", "No function named %s, served functions are "
+                    "%s" % (function_name, sorted(server.batchers.keys()))))
+            else:
+                request = server.batchers[function_name].submit(args)
+                if request.error is not None:
+                    _send_message(self.request, ("error", request.error))
+                else:
+                    _send_message(self.request, ("ok", request.outputs))
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn,
+                          socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                               socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class InferenceServer(object):
+    """
+    Serve compiled functions to local clients with dynamic micro-batching
+
+    Each connection sends (function_name, list_of_args) requests, and
+    concurrent requests to the same function are coalesced into one call
+    by a dispatch thread per function. All arguments and outputs must be
+    batched along axis 0, so feedforward functions such as the
+    encode_function and decode_function of the vae examples work as is.
+
+    Messages are pickled, so only bind to addresses reachable by trusted
+    clients. The default is localhost with a free port.
+
+    Parameters
+    ----------
+    dict_of_functions : dict
+        Maps request names to callables, typically compiled theano
+        functions or a model from load_inference_model.
+
+    address : tuple or str, optional (default=("127.0.0.1", 0))
+        (host, port) for TCP or a path for a unix socket. Port 0 picks a
+        free port, see the address attribute after construction.
+
+    max_batch_size : int, optional (default=100)
+        Maximum rows per call. A single larger request is run alone.
+
+    max_latency : float, optional (default=0.005)
+        Seconds to wait for more requests after the oldest one arrived.
+    """
+    def __init__(self, dict_of_functions, address=("127.0.0.1", 0),
+                 max_batch_size=100, max_latency=0.005):
+        if len(dict_of_functions) == 0:
+            raise ValueError("No functions to serve!")
+        if STATS_ID in dict_of_functions:
+            raise ValueError("%s is reserved for server stats" % STATS_ID)
+        self.batchers = dict((k, _MicroBatcher(f, max_batch_size,
+                                               max_latency))
+                             for k, f in dict_of_functions.items())
+        if isinstance(address, str):
+            server_class = _ThreadingUnixServer
+        else:
+            server_class = _ThreadingTCPServer
+        self.server = server_class(address, _InferenceHandler)
+        self.server.inference_server = self
+        self.address = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        """ Start accepting connections in a background thread """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        """ Accept connections in this thread until shutdown """
+        self.server.serve_forever()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+        for b in self.batchers.values():
+            b.stop()
+
+    def stats(self):
+        """
+        Statistics per served function
+
+        Returns a dict of function name to a dict with n_requests,
+        n_batches, queue_depth, max_queue_depth, batch_sizes (rows per
+        call to number of calls) and latency_p50 / latency_p99 in seconds
+        over the most recent requests.
+        """
+        return dict((k, b.stats.summary(b.queue_depth()))
+                    for k, b in self.batchers.items())
+
+
+def serve_checkpoint(save_path, list_of_function_names,
+                     address=("127.0.0.1", 0), max_batch_size=100,
+                     max_latency=0.005):
+    """
+    Load a checkpoint once and serve the named functions from it
+
+    Returns the started InferenceServer. See InferenceServer for the
+    remaining arguments.
+    """
+    checkpoint_dict = load_checkpoint(save_path)
+    missing = [k for k in list_of_function_names
+               if k not in checkpoint_dict.keys()]
+    if len(missing) > 0:
+        raise ValueError("Functions %s not found in checkpoint %s" % (
+            missing, save_path))
+    dict_of_functions = dict((k, checkpoint_dict[k])
+                             for k in list_of_function_names)
+    return InferenceServer(dict_of_functions, address=address,
+                           max_batch_size=max_batch_size,
+                           max_latency=max_latency).start()
+
+
+class InferenceClient(object):
+    """
+    Blocking client for InferenceServer
+
+    Holds one connection, so use one client per thread. Requests made
+    from many clients at once are what the server batches together.
+    """
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(address)
+
+    def _request(self, function_name, args):
+        _send_message(self.sock, (function_name, args))
+        response = _recv_message(self.sock)
+        if response is None:
+            raise ValueError("Server closed the connection")
+        status, result = response
+        if status != "ok":
+            raise ValueError("Server error calling %s:\n%s" % (
+                function_name, result))
+        return result
+
+    def __call__(self, function_name, *args):
+        """ Returns the list of outputs for this request """
+        return self._request(function_name, list(args))
+
+    def stats(self):
+        return self._request(STATS_ID, [])
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
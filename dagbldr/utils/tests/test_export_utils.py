@@ -0,0 +1,148 @@
+from nose.tools import assert_raises
+from numpy.testing import assert_almost_equal
+import numpy as np
+import theano
+from theano import tensor
+import tempfile
+import shutil
+import os
+import sys
+import subprocess
+from collections import OrderedDict
+
+from dagbldr.utils import add_datasets_to_graph, export_graph
+from dagbldr.utils import load_inference_model, compile_inference_function
+from dagbldr.nodes import relu_layer, softmax_layer, linear_layer
+from dagbldr.nodes import sigmoid_layer, softplus_layer, dropout_layer
+from dagbldr.nodes import gaussian_log_sample_layer, softmax_sample_layer
+from dagbldr.nodes import embedding_layer, gru_recurrent_layer
+from dagbldr.nodes import lstm_recurrent_layer
+from dagbldr.nodes import bidirectional_gru_recurrent_layer
+from dagbldr.nodes import conditional_gru_recurrent_layer
+from dagbldr.datasets import load_digits
+
+digits = load_digits()
+X = digits["data"].astype(theano.config.floatX)
+
+
+def _check_export(list_of_inputs, list_of_outputs, graph, list_of_args):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        export_graph(list_of_inputs, list_of_outputs, graph, tmp_dir)
+        f, used = compile_inference_function(list_of_inputs,
+                                             list_of_outputs, graph,
+                                             mode="FAST_COMPILE")
+        expected = f(*list_of_args)
+        model = load_inference_model(tmp_dir)
+        # Twice, to check reused buffers do not corrupt earlier outputs
+        first = model(*list_of_args)
+        second = model(*list_of_args)
+        for e, a, b in zip(expected, first, second):
+            assert_almost_equal(e, a, decimal=4)
+            assert_almost_equal(a, b)
+        return tmp_dir, first
+    except:
+        shutil.rmtree(tmp_dir)
+        raise
+
+
+def test_export_feedforward():
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+    X_sym = add_datasets_to_graph([X], ["X"], graph)
+    on_off = tensor.iscalar()
+    l1 = relu_layer([X_sym], graph, 'l1', 32, random_state)
+    d1 = dropout_layer([l1], graph, 'd1', on_off, random_state=random_state)
+    mu = linear_layer([d1], graph, 'mu', 8, random_state)
+    log_sigma = linear_layer([d1], graph, 'log_sigma', 8, random_state)
+    samp = gaussian_log_sample_layer([mu], [log_sigma], graph, 'samp',
+                                     random_state)
+    l2 = softplus_layer([samp, X_sym], graph, 'l2', 16, random_state)
+    out = sigmoid_layer([l2], graph, 'out', 64, random_state)
+    pred = softmax_layer([l2], graph, 'pred', 10, random_state)
+    cat = softmax_sample_layer([pred], graph, 'cat', random_state)
+    tmp_dir, (out_r, pred_r, cat_r) = _check_export(
+        [X_sym], [out, pred, cat], graph, [X[:100]])
+    try:
+        assert cat_r.dtype == np.int32
+        # Ties still give one hot rows
+        model = load_inference_model(tmp_dir)
+        tied = np.array([[.4, .4, .2], [.1, .2, .7]], dtype="float32")
+        assert_almost_equal(model._run_softmax_sample(
+            None, None, {"inputs": [tied]})[0], [[1, 0, 0], [0, 0, 1]])
+        assert sorted(os.listdir(tmp_dir)) == ["dagbldr_runtime.py",
+                                               "manifest.json",
+                                               "weights.npz"]
+        # The copied runtime must work with numpy alone
+        script = ("import sys; sys.modules['theano'] = None; "
+                  "sys.path.insert(0, %r); import numpy as np; "
+                  "from dagbldr_runtime import load_inference_model; "
+                  "m = load_inference_model(%r); "
+                  "print(m(np.ones((3, 64), dtype='float32'))[0].shape)" % (
+                      tmp_dir, tmp_dir))
+        res = subprocess.check_output([sys.executable, "-c", script],
+                                      cwd=tmp_dir)
+        assert res.decode("ascii").strip() == "(3, 64)"
+        # Unregistered expressions cannot be exported
+        assert_raises(ValueError, export_graph, [X_sym], [2 * out], graph,
+                      tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_export_recurrent():
+    random_state = np.random.RandomState(1999)
+    n_steps, batch_size, vocab = 7, 5, 11
+    idx = [random_state.randint(0, vocab, batch_size).astype("int32")
+           for i in range(n_steps)]
+    X_r = random_state.randn(n_steps, batch_size, 4).astype(
+        theano.config.floatX)
+    mask = np.ones((n_steps, batch_size), dtype=theano.config.floatX)
+    mask[5:, 2:] = 0.
+    graph = OrderedDict()
+    X_sym, mask_sym = add_datasets_to_graph([X_r, mask], ["X", "mask"],
+                                            graph)
+    idx_syms = [tensor.ivector() for i in idx]
+    emb = embedding_layer(idx_syms, vocab, 3, graph, 'emb', random_state)
+    h_g = gru_recurrent_layer([X_sym], mask_sym, 6, graph, 'gru',
+                              random_state, recurrent_dropout_prob=0.5)
+    h_l = lstm_recurrent_layer([X_sym, h_g], mask_sym, 5, graph, 'lstm',
+                               random_state)
+    h_b = bidirectional_gru_recurrent_layer([h_l], mask_sym, 4, graph, 'bi',
+                                            random_state)
+    h_c, ctx = conditional_gru_recurrent_layer([X_sym], [h_b], mask_sym, 8,
+                                               graph, 'cond', random_state)
+    out = linear_layer([h_c], graph, 'out', 3, random_state)
+    tmp_dir, _ = _check_export(idx_syms + [X_sym, mask_sym],
+                               [emb, out, ctx], graph, idx + [X_r, mask])
+    shutil.rmtree(tmp_dir)
+
+
+def test_export_initial_states():
+    random_state = np.random.RandomState(1999)
+    n_steps, batch_size = 6, 5
+    X_r = random_state.randn(n_steps, batch_size, 4).astype(
+        theano.config.floatX)
+    mask = np.ones((n_steps, batch_size), dtype=theano.config.floatX)
+    mask[4:, 3:] = 0.
+    graph = OrderedDict()
+    X_sym, mask_sym = add_datasets_to_graph([X_r, mask], ["X", "mask"],
+                                            graph)
+    h_g = gru_recurrent_layer([X_sym], mask_sym, 6, graph, 'gru',
+                              random_state)
+    h_l = lstm_recurrent_layer([X_sym], mask_sym, 5, graph, 'lstm',
+                               random_state)
+    h_b = bidirectional_gru_recurrent_layer([X_sym], mask_sym, 4, graph,
+                                            'bi', random_state)
+    # Initial states are trained parameters, so must be exported
+    for name in ["gru_h0", "lstm_h0", "lstm_c0", "bi_f_h0", "bi_r_h0"]:
+        shape = graph[name].get_value().shape
+        graph[name].set_value(random_state.randn(*shape).astype(
+            theano.config.floatX))
+    tmp_dir, _ = _check_export([X_sym, mask_sym], [h_g, h_l, h_b], graph,
+                               [X_r, mask])
+    try:
+        model = load_inference_model(tmp_dir)
+        assert_raises(ValueError, model, X_r[:, :3], mask[:, :3])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from nose.tools import assert_raises
+from numpy.testing import assert_almost_equal
+import numpy as np
+import theano
+import tempfile
+import shutil
+import os
+
+from dagbldr.utils import add_datasets_to_graph, get_params_and_grads
+from dagbldr.utils import convert_to_one_hot, data_parallel_trainer
+from dagbldr.utils import sweep_runner, make_param_grid
+from dagbldr.utils.parallel_utils import _ProcessBarrier
+from dagbldr.utils.training_utils import _fork_context
+from dagbldr.nodes import linear_layer, softmax_layer
+from dagbldr.nodes import categorical_crossentropy
+from dagbldr.optimizers import sgd
+from dagbldr.datasets import load_digits
+
+digits = load_digits()
+X = digits["data"]
+y = convert_to_one_hot(digits["target"], 10)
+
+
+def _build_classifier():
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+    X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], graph)
+    l1_o = linear_layer([X_sym], graph, 'l1', proj_dim=20,
+                        random_state=random_state)
+    y_pred = softmax_layer([l1_o], graph, 'pred', 10,
+                           random_state=random_state)
+    cost = categorical_crossentropy(y_pred, y_sym).mean()
+    params, grads = get_params_and_grads(graph, cost)
+    updates = sgd(params).updates(params, grads, 0.01)
+    fit_function = theano.function([X_sym, y_sym], [cost], updates=updates,
+                                   mode="FAST_COMPILE")
+    cost_function = theano.function([X_sym, y_sym], [cost],
+                                    mode="FAST_COMPILE")
+    return graph, fit_function, cost_function
+
+
+def test_data_parallel_trainer():
+    train_indices = np.arange(len(X))
+    for sync_mode in ["average", "hogwild"]:
+        graph, fit_function, cost_function = _build_classifier()
+        start_cost = cost_function(X, y)[0]
+        epoch_results = data_parallel_trainer(
+            fit_function, [X, y], 50, train_indices, n_workers=2,
+            sync_mode=sync_mode, sync_every=3,
+            fit_function_output_names=["cost"], n_epochs=2,
+            epoch_status_func=None, shuffle=True,
+            random_state=np.random.RandomState(1))
+        assert len(epoch_results["cost"]) == 2
+        # Shards of 898 samples, trimmed to a multiple of 50
+        assert epoch_results["number_of_samples_auto"][-1] == 850
+        # Trained values are copied back to this process
+        assert cost_function(X, y)[0] < start_cost
+
+
+def test_data_parallel_trainer_errors():
+    graph, fit_function, cost_function = _build_classifier()
+    train_indices = np.arange(len(X))
+    assert_raises(ValueError, data_parallel_trainer, fit_function, [X, y],
+                  50, train_indices, n_workers=2, sync_mode="sometimes")
+    assert_raises(ValueError, data_parallel_trainer, fit_function, [X, y],
+                  1000, train_indices, n_workers=2)
+
+    def bad_minibatch(arg, sl):
+        raise ValueError("broken minibatch")
+
+    assert_raises(ValueError, data_parallel_trainer, fit_function, [X, y],
+                  50, train_indices, n_workers=2,
+                  list_of_minibatch_functions=[bad_minibatch],
+                  n_epochs=1, epoch_status_func=None)
+
+    def killed_minibatch(arg, sl):
+        os._exit(1)
+
+    # Workers that die without reporting fail the call instead of hanging
+    assert_raises(ValueError, data_parallel_trainer, fit_function, [X, y],
+                  50, train_indices, n_workers=2,
+                  list_of_minibatch_functions=[killed_minibatch],
+                  n_epochs=1, epoch_status_func=None)
+
+
+def _barrier_worker(barrier, counter):
+    for i in range(3):
+        barrier.wait()
+        with counter.get_lock():
+            counter.value += 1
+    try:
+        barrier.wait()
+    except RuntimeError:
+        with counter.get_lock():
+            counter.value += 10
+
+
+def test_process_barrier():
+    ctx = _fork_context()
+    barrier = _ProcessBarrier(ctx, 3)
+    counter = ctx.Value("i", 0)
+    workers = [ctx.Process(target=_barrier_worker, args=(barrier, counter))
+               for i in range(2)]
+    for p in workers:
+        p.start()
+    for i in range(3):
+        barrier.wait()
+    # Workers are stuck on the last wait until it is aborted
+    barrier.abort()
+    for p in workers:
+        p.join()
+    assert counter.value == 26
+    assert_raises(RuntimeError, barrier.wait)
+
+
+def test_sweep_runner():
+    def trial_function(params, dataset, report):
+        if params["offset"] < 0:
+            raise ValueError("bad trial")
+        assert isinstance(dataset["data"], np.memmap)
+        epoch_results = {"valid_cost": []}
+        for e in range(6):
+            epoch_results["valid_cost"].append(params["offset"] + 1. / (e + 1))
+            report(epoch_results)
+        return dataset["data"].sum() + epoch_results["valid_cost"][-1]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        list_of_params = make_param_grid({"offset": [0., .1, .2, 5., -1.]})
+        assert len(list_of_params) == 5
+        sweep_results = sweep_runner(
+            trial_function, list_of_params,
+            dataset={"data": np.ones((10, 2)), "name": "ones"},
+            n_processes=1, sweep_dir=tmp_dir, grace_period=2,
+            min_trials_for_stopping=3)
+        assert [r["stopped_early"] for r in sweep_results] == [
+            False, False, False, True, False]
+        assert_almost_equal(sweep_results[0]["result"], 20. + 1. / 6)
+        assert len(sweep_results[3]["history"]) == 3
+        assert sweep_results[3]["result"] is None
+        assert "bad trial" in sweep_results[4]["error"]
+        assert sweep_results[1]["checkpoint_dir"].startswith(
+            os.path.join(tmp_dir, "trial_1"))
+    finally:
+        shutil.rmtree(tmp_dir)
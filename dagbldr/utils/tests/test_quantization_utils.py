@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from nose.tools import assert_raises
+from numpy.testing import assert_almost_equal
+import numpy as np
+import theano
+from theano import tensor
+import tempfile
+import shutil
+
+from dagbldr.utils import add_datasets_to_graph, get_params_and_grads
+from dagbldr.utils import compile_inference_function, export_graph
+from dagbldr.utils import load_inference_model
+from dagbldr.utils import quantize_array, dequantize_array
+from dagbldr.utils import quantize_graph_params, get_quantized_params
+from dagbldr.nodes import relu_layer, softmax_layer, linear_layer
+from dagbldr.nodes import embedding_layer, gaussian_log_sample_layer
+from dagbldr.nodes import categorical_crossentropy
+from dagbldr.datasets import load_digits
+
+digits = load_digits()
+X = digits["data"].astype(theano.config.floatX)
+
+
+def test_quantize_array():
+    random_state = np.random.RandomState(1999)
+    W = random_state.randn(20, 10).astype(theano.config.floatX)
+    W[:, 3] = 0.
+    W[:, 4] *= 100.
+    quantized, scale = quantize_array(W)
+    assert quantized.dtype == np.int8
+    assert scale.shape == (10,)
+    assert scale.dtype == W.dtype
+    assert np.abs(quantized).max() == 127
+    # Per column scales keep the error relative to each column
+    err = np.abs(dequantize_array(quantized, scale) - W)
+    assert np.all(err <= scale / 2. + 1E-6)
+    assert np.all(dequantize_array(quantized, scale)[:, 3] == 0.)
+    assert_raises(ValueError, quantize_array, W[0])
+
+
+def test_quantize_graph_params():
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+    X_sym = add_datasets_to_graph([X], ["X"], graph)
+    idx_sym = tensor.ivector()
+    l1 = relu_layer([X_sym], graph, 'l1', 32, random_state)
+    mu = linear_layer([l1], graph, 'mu', 8, random_state)
+    log_sigma = linear_layer([l1], graph, 'log_sigma', 8, random_state)
+    samp = gaussian_log_sample_layer([mu], [log_sigma], graph, 'samp',
+                                     random_state)
+    emb = embedding_layer([idx_sym], 10, 8, graph, 'emb', random_state)
+    y_pred = softmax_layer([samp], graph, 'pred', 10, random_state)
+    inputs = [X_sym, idx_sym]
+    outputs = [y_pred, emb]
+    args = [X[:50], digits["target"][:50].astype("int32")]
+    f_float, _ = compile_inference_function(inputs, outputs, graph,
+                                            mode="FAST_COMPILE")
+    expected, expected_emb = f_float(*args)
+    names = quantize_graph_params(graph)
+    assert names == ["l1_W", "mu_W", "log_sigma_W", "emb_embedding_W",
+                     "pred_W"]
+    assert sorted(get_quantized_params(graph).keys()) == sorted(names)
+    # int8 copies are not trainable parameters
+    cost = categorical_crossentropy(y_pred, tensor.ivector()).mean()
+    cost += emb.sum()
+    params, grads = get_params_and_grads(graph, cost)
+    assert len(params) == 9
+    f_quant, _ = compile_inference_function(inputs, outputs, graph,
+                                            mode="FAST_COMPILE")
+    # The sample mean, registered before quantization, is also replaced.
+    # log_sigma is pruned at inference
+    used = [str(v) for v in
+            theano.gof.graph.inputs(f_quant.maker.fgraph.outputs)]
+    assert [n for n in names if n + "_int8" in used] == [
+        "l1_W", "mu_W", "emb_embedding_W", "pred_W"]
+    assert len([n for n in names if n in used]) == 0
+    result, result_emb = f_quant(*args)
+    assert_almost_equal(result, expected, decimal=1)
+    assert np.mean(result.argmax(axis=1) == expected.argmax(axis=1)) > .95
+    assert_almost_equal(result_emb, expected_emb, decimal=2)
+    assert np.abs(result - expected).max() > 0.
+
+    # Quantizing again picks up new parameter values
+    graph["pred_W"].set_value(2 * graph["pred_W"].get_value())
+    quantize_graph_params(graph, ["pred_W"])
+    assert len(graph["__inference__"]) == 1 + len(names)
+    changed, _ = f_quant(*args)
+    assert np.abs(changed - result).max() > 1E-3
+    assert_raises(ValueError, quantize_graph_params, graph, ["missing_W"])
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        manifest = export_graph(inputs, outputs, graph, tmp_dir)
+        assert sorted(manifest["quantized"].keys()) == sorted(names)
+        model = load_inference_model(tmp_dir)
+        assert model.weights["pred_W"].dtype == np.int8
+        exported, exported_emb = model(*args)
+        assert_almost_equal(exported, changed, decimal=4)
+        assert_almost_equal(exported_emb, result_emb, decimal=4)
+    finally:
+        shutil.rmtree(tmp_dir)
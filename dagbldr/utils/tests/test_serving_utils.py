@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from nose.tools import assert_raises
+from numpy.testing import assert_almost_equal
+import numpy as np
+import theano
+import threading
+import tempfile
+import shutil
+import os
+
+from dagbldr.utils import add_datasets_to_graph, save_checkpoint
+from dagbldr.utils import InferenceServer, InferenceClient, serve_checkpoint
+from dagbldr.nodes import linear_layer, softmax_layer
+from dagbldr.datasets import load_digits
+
+digits = load_digits()
+X = digits["data"].astype(theano.config.floatX)
+
+
+def _build_predict_function():
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+    X_sym = add_datasets_to_graph([X], ["X"], graph)
+    l1_o = linear_layer([X_sym], graph, 'l1', proj_dim=20,
+                        random_state=random_state)
+    y_pred = softmax_layer([l1_o], graph, 'pred', 10,
+                           random_state=random_state)
+    return theano.function([X_sym], [y_pred], mode="FAST_COMPILE")
+
+
+def _concurrent_requests(address, list_of_batches):
+    results = [None] * len(list_of_batches)
+    # threading.Barrier is python 3 only
+    ready = threading.Semaphore(0)
+    go = threading.Event()
+
+    def run(n):
+        with InferenceClient(address) as client:
+            ready.release()
+            go.wait()
+            results[n] = client("predict", list_of_batches[n])[0]
+
+    threads = [threading.Thread(target=run, args=(n,))
+               for n in range(len(list_of_batches))]
+    for t in threads:
+        t.start()
+    # Send once every client is connected
+    for t in threads:
+        ready.acquire()
+    go.set()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_inference_server():
+    predict_function = _build_predict_function()
+    server = InferenceServer({"predict": predict_function},
+                             max_batch_size=64, max_latency=0.1).start()
+    try:
+        batches = [X[10 * n:10 * n + n + 1] for n in range(6)]
+        results = _concurrent_requests(server.address, batches)
+        for b, r in zip(batches, results):
+            assert_almost_equal(predict_function(b)[0], r)
+        with InferenceClient(server.address) as client:
+            stats = client.stats()["predict"]
+            assert_raises(ValueError, client, "missing", X[:2])
+            # Bad input fails the request but not the server
+            assert_raises(ValueError, client, "predict", X[:2, :5])
+            assert_almost_equal(client("predict", X[:3])[0],
+                                predict_function(X[:3])[0])
+        assert stats["n_requests"] == len(batches)
+        assert sum([k * v for k, v in stats["batch_sizes"].items()]) == 21
+        # Concurrent requests should have been coalesced
+        assert stats["n_batches"] < len(batches)
+        assert stats["latency_p50"] <= stats["latency_p99"]
+        assert stats["queue_depth"] == 0
+    finally:
+        server.shutdown()
+
+
+def test_serve_checkpoint():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        save_path = os.path.join(tmp_dir, "model.pkl")
+        predict_function = _build_predict_function()
+        save_checkpoint(save_path, {"predict": predict_function})
+        assert_raises(ValueError, serve_checkpoint, save_path, ["missing"])
+        # Unix socket, with batches capped below the total request size
+        server = serve_checkpoint(save_path, ["predict"],
+                                  address=os.path.join(tmp_dir, "sock"),
+                                  max_batch_size=4, max_latency=0.05)
+        try:
+            batches = [X[:3], X[3:6], X[6:7], X[7:10]]
+            results = _concurrent_requests(server.address, batches)
+            for b, r in zip(batches, results):
+                assert_almost_equal(predict_function(b)[0], r)
+            stats = server.stats()["predict"]
+            assert max(stats["batch_sizes"].keys()) <= 4
+        finally:
+            server.shutdown()
+    finally:
+        shutil.rmtree(tmp_dir)
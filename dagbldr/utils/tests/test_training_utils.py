@@ -1,8 +1,37 @@
 from nose.tools import assert_raises
+from numpy.testing import assert_almost_equal
+import numpy as np
+import theano
+import tempfile
+import shutil
+import os
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from dagbldr.utils import make_character_level_from_text, convert_to_one_hot
+from dagbldr.utils import gen_vectorized_character_mapper
+from dagbldr.utils import build_word_vocabulary, whitespace_tokenizer
 from dagbldr.utils import make_embedding_minibatch
-from dagbldr.datasets import load_digits
+from dagbldr.utils import gen_chunk_shuffle_function
+from dagbldr.utils import gen_make_chunked_minibatch
+from dagbldr.utils import read_metrics_log
+from dagbldr.utils.training_utils import _evaluate_function
+from dagbldr.utils.training_utils import _log_new_results
+from dagbldr.utils.training_utils import _MetricArray, _new_results_dict
+from dagbldr.utils.training_utils import _find_nan_keys
+from dagbldr.utils.training_utils import _iterate_function
+from dagbldr.utils.training_utils import _layer_name_from_key
+from dagbldr.utils.training_utils import _make_theano_profiled_function
+from dagbldr.utils.training_utils import _call_theano_profiled_function
+from dagbldr.utils import theano_layer_profile
+from dagbldr.utils import add_datasets_to_graph, get_params_and_grads
+from dagbldr.nodes import linear_layer, softmax_layer
+from dagbldr.nodes import categorical_crossentropy
+from dagbldr.optimizers import sgd
+from dagbldr.datasets import load_digits, load_mountains
 
 digits = load_digits()
 X = digits["data"]
@@ -46,5 +75,279 @@ def test_character_level_from_text():
     if new_clean[-1] != m["EOS"]:
         raise AssertionError("Failed to add EOS tag")
 
+
+def test_vectorized_character_mapper():
+    text = load_mountains()["data"]
+    cleaned, mapper_func, inverse_mapper_func, mapper = \
+        make_character_level_from_text(text[:100])
+    vec_mapper_func, vec_inverse_mapper_func = \
+        gen_vectorized_character_mapper(mapper)
+    # Later lines have characters missing from mapper, which map to UNK
+    symbols = vec_mapper_func(text[:200])
+    assert len(symbols) == 200
+    for n in [0, 99, 150, 199]:
+        assert symbols[n].dtype == np.int32
+        assert list(symbols[n]) == mapper_func(text[n])
+        assert vec_inverse_mapper_func(symbols[n]) == inverse_mapper_func(
+            symbols[n])
+    assert list(vec_mapper_func(text[3])) == mapper_func(text[3])
+    assert vec_inverse_mapper_func(vec_mapper_func(u"\u2603a")) == "UNKa"
+
+
+def test_build_word_vocabulary():
+    assert whitespace_tokenizer(
+        "Bob dropped the apple. Where is the apple?") == [
+            "Bob", "dropped", "the", "apple", ".", "Where", "is", "the",
+            "apple", "?"]
+    text = load_mountains()["data"]
+    cleaned, mapper_func, inverse_mapper_func, mapper = \
+        build_word_vocabulary(text, chunk_size=500)
+    assert len(cleaned) == len(text)
+    for n in [0, 499, 500, len(text) - 1]:
+        assert cleaned[n].dtype == np.int32
+        assert cleaned[n][-1] == 1
+        assert np.all(cleaned[n] == mapper_func(text[n]))
+        assert inverse_mapper_func(cleaned[n]) == " ".join(
+            whitespace_tokenizer(text[n]))
+    # Most frequent words get the smallest ids
+    all_ids = np.concatenate(cleaned)
+    counts = np.bincount(all_ids)
+    assert np.all(np.diff(counts[2:]) <= 0)
+
+    cleaned_small, _, _, mapper_small = build_word_vocabulary(
+        text, max_vocab=100, min_count=2, lowercase=True, n_processes=2,
+        chunk_size=500)
+    assert len(mapper_small) == 100
+    assert max(np.concatenate(cleaned_small)) == 99
+    assert "the" in mapper_small
+    assert "The" not in mapper_small
+    assert_raises(ValueError, build_word_vocabulary, "abc")
+
+    # Literal EOS words and newlines inside a line do not split it
+    cleaned_eos, mapper_func, _, mapper_eos = build_word_vocabulary(
+        ["the EOS token here", "a b\nc", "x"])
+    assert len(cleaned_eos) == 3
+    assert [len(c) for c in cleaned_eos] == [5, 4, 2]
+    assert cleaned_eos[0][1] == 1
+    assert np.all(cleaned_eos[1] == mapper_func("a b\nc"))
+    assert sorted(mapper_eos.values()) == list(range(len(mapper_eos)))
+
+
+def test_evaluate_function():
+    def mean_function(X_mb, y_mb):
+        return [X_mb.mean(), y_mb.mean()]
+
+    y_2d = y[:, None].astype("float32")
+    indices = np.arange(7, len(X))
+    # 1790 samples do not divide evenly into minibatches of 100
+    results = _evaluate_function(mean_function, [X, y_2d], 100,
+                                 indices=indices,
+                                 list_of_output_names=["X_mean", "y_mean"])
+    assert_almost_equal(results["X_mean"], X[indices].mean(), decimal=4)
+    assert_almost_equal(results["y_mean"], y_2d[indices].mean(), decimal=4)
+
+    dropped = _evaluate_function(mean_function, [X, y_2d], 100,
+                                 indices=indices,
+                                 drop_partial_minibatch=True)
+    assert_almost_equal(dropped[0], X[indices[:1700]].mean(), decimal=4)
+
+
+def test_metrics_log():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(tmp_dir, "model_update_log.csv")
+        costs = [1.5, 1.25, 1E-9]
+        update_results = _new_results_dict()
+        for n, c in enumerate(costs):
+            update_results["cost"].append(c)
+            update_results["acc"].append(float(n))
+            _log_new_results(update_results, log_path)
+        results = read_metrics_log(log_path)
+        assert_almost_equal(results["cost"], costs)
+        assert_almost_equal(results["acc"], [0., 1., 2.])
+
+        # Keys appended at different rates are all logged at their own step
+        log_path = os.path.join(tmp_dir, "model_checkpoint_log.csv")
+        epoch_results = _new_results_dict()
+        for n in range(4):
+            epoch_results["cost"].append(float(n))
+            if n % 2 == 1:
+                epoch_results["valid, cost"].append(np.array([10. + n]))
+                _log_new_results(epoch_results, log_path)
+            # Appended after the status call, logged by the next one
+            epoch_results["status_time_s_auto"].append(.5)
+        _log_new_results(epoch_results, log_path)
+        results, steps = read_metrics_log(log_path, return_steps=True)
+        assert_almost_equal(results["cost"], [0., 1., 2., 3.])
+        assert steps["cost"] == [1, 2, 3, 4]
+        assert_almost_equal(results["valid, cost"], [11., 13.])
+        assert steps["valid, cost"] == [1, 2]
+        assert steps["status_time_s_auto"] == [1, 2, 3, 4]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_metric_array():
+    m = _MetricArray()
+    values = [np.float32(v) for v in np.linspace(1., 0., 50)]
+    for v in values:
+        m.append(np.array(v))
+    assert len(m) == 50
+    assert_almost_equal(m[-1], 0.)
+    assert_almost_equal(m.minimum, 0.)
+    assert_almost_equal(m.maximum, 1.)
+    assert_almost_equal(np.mean(m), np.mean(values))
+    assert m.all_finite()
+    assert min(m + [np.inf]) == m.minimum
+    assert ([2.] + m)[0] == 2.
+    assert len([2.] + m) == 51
+
+    m.append(np.inf)
+    assert m.n_inf == 1
+    assert not m.all_finite()
+    assert_almost_equal(m.maximum, 1.)
+
+    r = pickle.loads(pickle.dumps(m))
+    assert type(r) is list
+    assert_almost_equal(r, m.values)
+    r = _new_results_dict({"cost": r})["cost"]
+    assert r.n_inf == 1
+
+
+def test_find_nan_keys():
+    results = _new_results_dict({"old_list": [1., 2.]})
+    results["cost"].append(1.)
+    assert len(_find_nan_keys(results)) == 0
+    results["cost"].append(np.nan)
+    results["old_list"].append(np.nan)
+    assert _find_nan_keys(results) == set(["cost", "old_list"])
+    assert _find_nan_keys({"plain": [np.array([np.nan])]}) == set(["plain"])
+    r = pickle.loads(pickle.dumps(results))
+    assert _find_nan_keys(r) == set(["cost", "old_list"])
+
+
+class _CountingProfiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.calls = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+
+def test_iterate_function_timing():
+    profiler = _CountingProfiler()
+
+    def mean_function(X_mb):
+        profiler.calls.append(profiler.enabled)
+        return [X_mb.mean()]
+
+    epoch_results = _iterate_function(
+        mean_function, [X], 100, list_of_output_names=["mean"],
+        n_epochs=2, profile_minibatches=(3, 20), profiler=profiler)
+    for phase in ["minibatch", "function", "monitor"]:
+        for stat in ["p50", "p95", "max"]:
+            k = "%s_time_%s_s_auto" % (phase, stat)
+            assert len(epoch_results[k]) == 2
+    assert "preprocess_time_p50_s_auto" not in epoch_results
+    assert epoch_results["function_time_p50_s_auto"][0] <= \
+        epoch_results["function_time_max_s_auto"][0]
+    assert sum(profiler.calls) == 17
+    assert not profiler.enabled
+
+    n_updates = epoch_results["total_number_of_updates_auto"][-1]
+    epoch_results = _iterate_function(
+        mean_function, [X], 100, list_of_output_names=["mean"],
+        n_epochs=1, previous_epoch_results=epoch_results)
+    assert epoch_results["total_number_of_epochs_auto"].tolist() == [1, 2, 3]
+    assert epoch_results["total_number_of_updates_auto"][-1] == 1.5 * n_updates
+
+
+def test_chunk_shuffle():
+    random_state = np.random.RandomState(1999)
+    chunk_size = 50
+    chunk_shuffle = gen_chunk_shuffle_function(chunk_size, n_buffer_chunks=3)
+    indices = np.arange(1500)
+    shuffled = chunk_shuffle(indices, random_state)
+    assert np.all(np.sort(shuffled) == indices)
+    assert np.any(shuffled != indices)
+    # Each buffer of 3 * chunk_size samples comes from 3 chunks
+    for i in range(0, len(shuffled), 3 * chunk_size):
+        assert len(np.unique(shuffled[i:i + 3 * chunk_size] // chunk_size)) == 3
+
+    make_chunked_minibatch = gen_make_chunked_minibatch(chunk_size)
+    mb = make_chunked_minibatch(X, shuffled[:100])[0]
+    assert np.all(mb == X[shuffled[:100]])
+
+    seen = []
+
+    def record_function(X_mb):
+        seen.append(X_mb)
+        return [X_mb.mean()]
+
+    _iterate_function(record_function, [X[:1700]], 100,
+                      list_of_minibatch_functions=[make_chunked_minibatch],
+                      n_epochs=1, minibatch_status_func=None,
+                      shuffle=True, random_state=random_state,
+                      shuffle_function=chunk_shuffle)
+    assert len(seen) == 17
+    seen = np.concatenate(seen, axis=0)
+    assert np.all(np.sort(seen, axis=0) == np.sort(X[:1700], axis=0))
+
+
+def test_layer_name_from_key():
+    assert _layer_name_from_key("l1_W") == "l1"
+    assert _layer_name_from_key("enc_f_gru_rec_step_Urz") == "enc_f"
+    assert _layer_name_from_key("dec_cond_gru_step_Wi_att") == "dec"
+    assert _layer_name_from_key("emb_embedding_W") == "emb"
+    assert _layer_name_from_key(
+        "grad_of_rec_lstm_recurrent_scan") == "rec"
+
+
+def test_theano_layer_profile():
+    random_state = np.random.RandomState(1999)
+    graph = OrderedDict()
+    y_one_hot = convert_to_one_hot(y, 10).astype(theano.config.floatX)
+    X_sym, y_sym = add_datasets_to_graph([X, y_one_hot], ["X", "y"], graph)
+    l1_o = linear_layer([X_sym], graph, 'l1', proj_dim=20,
+                        random_state=random_state)
+    y_pred = softmax_layer([l1_o], graph, 'pred', 10,
+                           random_state=random_state)
+    cost = categorical_crossentropy(y_pred, y_sym).mean()
+    params, grads = get_params_and_grads(graph, cost)
+    updates = sgd(params).updates(params, grads, 0.001)
+    fit_function = theano.function([X_sym, y_sym], [cost], updates=updates,
+                                   mode="FAST_COMPILE")
+    W = graph["l1_W"].get_value()
+    _iterate_function(fit_function, [X, y_one_hot], 100,
+                      list_of_output_names=["cost"], n_epochs=1,
+                      theano_profile_minibatches=(2, 5), graph=graph)
+    # Profiled calls share parameters with fit_function
+    assert np.any(W != graph["l1_W"].get_value())
+    assert_raises(ValueError, _iterate_function, fit_function,
+                  [X, y_one_hot], 100, n_epochs=1,
+                  theano_profile_minibatches=(2, 5))
+
+    profiled_function = _make_theano_profiled_function(fit_function)
+    _call_theano_profiled_function(profiled_function, [X[:100],
+                                                       y_one_hot[:100]])
+    # Profile flags are restored after the call
+    assert not theano.config.profile
+    assert not theano.config.profile_memory
+    layer_profile = theano_layer_profile(profiled_function, graph)
+    layers = dict([(l["layer"], l) for l in layer_profile])
+    assert "l1" in layers
+    assert "pred" in layers
+    assert layers["l1"]["n_ops"] > 0
+    assert layers["l1"]["param_bytes"] == W.nbytes + 20 * W.itemsize
+    assert layers["pred"]["output_bytes"] > 0
+    times = [l["time_s"] for l in layer_profile]
+    assert times == sorted(times, reverse=True)
+    assert_almost_equal(sum([l["time_fraction"] for l in layer_profile]), 1.)
+
+
 if __name__ == "__main__":
     test_make_embedding_minibatch()
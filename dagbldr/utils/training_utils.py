@@ -15,16 +15,37 @@ import inspect
 import zipfile
 import time
 import pprint
+import cProfile
+import pstats
+import multiprocessing
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
-from collections import defaultdict
+from collections import defaultdict, Counter
 from functools import reduce
 from .plot_utils import _filled_js_template_from_results_dict
 
 # TODO: Fetch from env
 NUM_SAVED_TO_KEEP = 2
+# Minimum number of seconds between html monitor renders
+# TODO: Fetch from env
+HTML_RENDER_INTERVAL_S = 60.
+_last_html_render_times = {}
+# Renders skipped by the rate limit, written by _flush_monitor_html
+_pending_html_renders = {}
+# Number of values of each key already written to each metrics log
+_logged_lengths = {}
+# Suffixes added to layer names for parameters and scans in dagbldr.nodes
+_LAYER_SUFFIX_RES = [re.compile(r"_(tanh|gru|cond_gru|lstm)_recurrent_scan$"),
+                     re.compile(r"_(tanh|gru|cond_gru|lstm)_rec_step_\w+$"),
+                     re.compile(r"_cond_gru_step_\w+$"),
+                     re.compile(r"_embedding_W$"),
+                     re.compile(r"_(W|b|h0|c0)$")]
+# Words and runs of punctuation as separate tokens, shared with datasets
+_word_punct_re = re.compile(r"\w+|[^\w\s]+")
+# Same, with newline kept as a line marker
+_word_punct_newline_re = re.compile(r"\w+|[^\w\s]+|\n")
 
 
 def get_checkpoint_dir(checkpoint_dir=None, folder=None, create_dir=True):
@@ -33,7 +54,8 @@ def get_checkpoint_dir(checkpoint_dir=None, folder=None, create_dir=True):
         checkpoint_dir = os.getenv("DAGBLDR_MODELS", os.path.join(
             os.path.expanduser("~"), "dagbldr_models"))
     if folder is None:
-        checkpoint_name = main.__file__.split(".")[0]
+        # main.__file__ is an absolute path on newer pythons
+        checkpoint_name = os.path.basename(main.__file__).split(".")[0]
         checkpoint_dir = os.path.join(checkpoint_dir, checkpoint_name)
     else:
         checkpoint_dir = os.path.join(checkpoint_dir, folder)
@@ -96,13 +118,84 @@ def make_character_level_from_text(text):
     return cleaned, mapper_func, inverse_mapper_func, mapper
 
 
+def gen_vectorized_character_mapper(mapper):
+    """ Vectorized mapper_func and inverse_mapper_func for a char mapper
+
+    Parameters
+    ----------
+    mapper : dict
+        Dictionary of char -> integer, such as from
+        make_character_level_from_text. "UNK" and "EOS" are required.
+
+    Returns
+    -------
+    mapper_func : function
+        Maps a string to an int32 array ending in EOS, or a list of strings
+        to a list of such arrays (views into one buffer). Characters are
+        looked up by unicode codepoint in a numpy table, for all the text
+        in a single array operation.
+
+    inverse_mapper_func : function
+        Maps an array of ints back to a string, dropping EOS
+
+    """
+    unk = mapper["UNK"]
+    eos = mapper["EOS"]
+    chars = [k for k in mapper.keys() if len(k) == 1]
+    max_codepoint = max([ord(c) for c in chars] + [255])
+    # Last entry catches every codepoint past the table
+    codepoint_to_id = np.zeros((max_codepoint + 2,), dtype="int32") + unk
+    for c in chars:
+        codepoint_to_id[ord(c)] = mapper[c]
+    # Private use codepoint stands in for UNK until the final string
+    unk_placeholder = u"\ue000"
+    id_to_codepoint = np.zeros((max(mapper.values()) + 1,), dtype="uint32")
+    id_to_codepoint[unk] = ord(unk_placeholder)
+    for c in chars:
+        id_to_codepoint[mapper[c]] = ord(c)
+
+    def _codepoints(text):
+        return np.frombuffer(text.encode("utf-32-le"), dtype="uint32")
+
+    def mapper_func(text):
+        if isinstance(text, (str, type(u""))):
+            codepoints = np.minimum(_codepoints(text), max_codepoint + 1)
+            symbols = np.empty((len(codepoints) + 1,), dtype="int32")
+            symbols[:-1] = codepoint_to_id[codepoints]
+            symbols[-1] = eos
+            return symbols
+        lengths = np.array([len(t) for t in text], dtype="int64")
+        codepoints = np.minimum(_codepoints(u"".join(text)),
+                                max_codepoint + 1)
+        symbols = np.zeros((len(codepoints) + len(text),), dtype="int32")
+        symbols += eos
+        # Shift each line past the EOS of the lines before it
+        symbols[np.arange(len(codepoints)) + np.repeat(
+            np.arange(len(text)), lengths)] = codepoint_to_id[codepoints]
+        offsets = np.cumsum(lengths + 1)
+        return np.split(symbols, offsets[:-1])
+
+    def inverse_mapper_func(symbol_line):
+        symbol_line = np.asarray(symbol_line)
+        codepoints = id_to_codepoint[symbol_line[symbol_line != eos]]
+        # tobytes is numpy 1.9+, tostring is gone in numpy 2
+        if hasattr(codepoints, "tobytes"):
+            raw = codepoints.tobytes()
+        else:
+            raw = codepoints.tostring()
+        text = raw.decode("utf-32-le")
+        return text.replace(unk_placeholder, "UNK")
+
+    return mapper_func, inverse_mapper_func
+
+
 def whitespace_tokenizer(line):
     '''Return the tokens of a sentence including punctuation.
 
     >>> tokenize('Bob dropped the apple. Where is the apple?')
     ['Bob', 'dropped', 'the', 'apple', '.', 'Where', 'is', 'the', 'apple', '?']
     '''
-    return [x.strip() for x in re.split('(\W+)?', line) if x.strip()]
+    return _word_punct_re.findall(line)
 
 
 def make_word_level_from_text(text, tokenizer="default"):
@@ -134,8 +227,7 @@ def make_word_level_from_text(text, tokenizer="default"):
         raise ValueError("Text should be iterable of strings")
     except TypeError:
         pass
-    all_words = reduce(lambda x, y: set(
-        whitespace_tokenizer(x)) | set(whitespace_tokenizer(y)), text, set())
+    all_words = set(w for t in text for w in whitespace_tokenizer(t))
     mapper = {k: n + 2 for n, k in enumerate(list(all_words))}
     # 1 is EOS
     mapper["EOS"] = 1
@@ -156,6 +248,165 @@ def make_word_level_from_text(text, tokenizer="default"):
     return cleaned, mapper_func, inverse_mapper_func, mapper
 
 
+def _fork_context():
+    """ multiprocessing, or its fork context where contexts exist (py3.4+)
+
+    Python 2 has no contexts, but always forks on unix.
+    """
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork")
+    return multiprocessing
+
+
+# Token -> id for _encode_chunk in forked pool processes
+_word_lookup = None
+
+
+def _tokenize_chunk(args):
+    """ Tokens of a chunk of lines, with "\\n" after each, and their counts """
+    lines, lowercase = args
+    # Newlines inside a line would be read as line ends
+    text = "\n".join([l.replace("\n", " ") for l in lines]) + "\n"
+    if lowercase:
+        text = text.lower()
+    tokens = _word_punct_newline_re.findall(text)
+    counts = Counter(tokens)
+    del counts["\n"]
+    return tokens, counts
+
+
+def _count_chunk(args):
+    return _tokenize_chunk(args)[1]
+
+
+def _encode_tokens(tokens, lookup):
+    return np.fromiter((lookup.get(t, 0) for t in tokens), dtype="int32",
+                       count=len(tokens))
+
+
+def _encode_chunk(args):
+    return _encode_tokens(_tokenize_chunk(args)[0], _word_lookup)
+
+
+def build_word_vocabulary(text, max_vocab=None, min_count=1, lowercase=False,
+                          n_processes=None, chunk_size=10000):
+    """ Fast word level mapping with frequency cutoffs
+
+    Lines are tokenized into words and punctuation chunk_size lines at a
+    time, with one compiled regex findall per chunk and bulk Counter
+    updates. If n_processes is more than 1, chunks are tokenized and encoded
+    in a forked multiprocessing Pool.
+
+    Parameters
+    ----------
+    text : iterable of strings
+
+    max_vocab : int, optional
+        Maximum vocabulary size, counting UNK and EOS. The most frequent
+        words are kept, ties broken alphabetically.
+
+    min_count : int, optional, default 1
+        Words seen fewer times are mapped to UNK
+
+    lowercase : bool, optional, default False
+
+    Returns
+    -------
+    cleaned : list of int32 arrays, length (n_nonblank_lines, )
+         The original text as token ids, each line ending in EOS
+
+    mapper_func : function
+         Maps a string to an int32 array of ids ending in EOS
+
+    inverse_mapper_func : function
+        Maps ids back to space separated words, dropping EOS
+
+    mapper : dict
+        Dictionary of word -> integer. 0 is UNK, 1 is EOS and other words
+        are numbered from 2 by decreasing frequency.
+
+    """
+    # Try to catch invalid input
+    try:
+        ord(text[0])
+        raise ValueError("Text should be iterable of strings")
+    except TypeError:
+        pass
+    if max_vocab is not None and max_vocab < 2:
+        raise ValueError("max_vocab must be at least 2 for UNK and EOS")
+    # Remove blank lines
+    text = [t for t in text if t != ""]
+    chunks = [(text[i:i + chunk_size], lowercase)
+              for i in range(0, len(text), chunk_size)]
+    use_pool = n_processes is not None and n_processes > 1
+    if use_pool:
+        # Sending tokens between processes costs more than tokenizing, so
+        # workers tokenize twice - once to count, then to encode
+        ctx = _fork_context()
+        pool = ctx.Pool(n_processes)
+        try:
+            all_counts = pool.map(_count_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tokenized = [_tokenize_chunk(c) for c in chunks]
+        all_counts = [c for _, c in tokenized]
+    counts = Counter()
+    for chunk_counts in all_counts:
+        counts.update(chunk_counts)
+
+    # Literal UNK and EOS words share the special ids
+    words = sorted([w for w, c in counts.items()
+                    if c >= min_count and w not in ("UNK", "EOS")],
+                   key=lambda w: (-counts[w], w))
+    if max_vocab is not None:
+        words = words[:max_vocab - 2]
+    mapper = {w: n + 2 for n, w in enumerate(words)}
+    # 1 is EOS
+    mapper["EOS"] = 1
+    # 0 is UNK/MASK
+    mapper["UNK"] = 0
+    inverse_mapper = np.array(["UNK", "EOS"] + words, dtype=object)
+    lookup = dict(mapper)
+    # Line ends get a sentinel, so a literal EOS word does not split a line
+    lookup["\n"] = -1
+
+    if use_pool:
+        global _word_lookup
+        # Set before forking so workers inherit it
+        _word_lookup = lookup
+        pool = ctx.Pool(n_processes)
+        try:
+            all_symbols = pool.map(_encode_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+            _word_lookup = None
+    else:
+        all_symbols = [_encode_tokens(tokens, lookup)
+                       for tokens, _ in tokenized]
+    cleaned = []
+    for symbols in all_symbols:
+        ends = np.flatnonzero(symbols == -1)
+        symbols[ends] = 1
+        ends += 1
+        starts = np.concatenate(([0], ends[:-1]))
+        cleaned.extend(symbols[a:b] for a, b in zip(starts, ends))
+
+    def mapper_func(text_line):
+        symbols = _encode_tokens(
+            _tokenize_chunk(([text_line], lowercase))[0], lookup)
+        symbols[symbols == -1] = 1
+        return symbols
+
+    def inverse_mapper_func(symbol_line):
+        symbol_line = np.asarray(symbol_line)
+        return " ".join(inverse_mapper[symbol_line[symbol_line != 1]])
+
+    return cleaned, mapper_func, inverse_mapper_func, mapper
+
+
 def convert_to_one_hot(itr, n_classes, dtype="int32"):
     """ Convert 1D or 2D iterators of class to 2D or 3D iterators of one hot
         class indicators.
@@ -250,6 +501,98 @@ def _write_results_as_html(results_dict, save_path, default_show="all"):
         f.writelines(as_html)
 
 
+def _append_rows_to_log(rows, save_path):
+    """ Append (step, key, value) rows to a csv log """
+    write_header = not os.path.exists(save_path)
+    now = time.time()
+    with open(save_path, "a") as f:
+        if write_header:
+            f.write("time_s,step,key,value\n")
+        for step, k, value in rows:
+            f.write("%.6f,%i,%s,%r\n" % (now, step, str(k), value))
+
+
+def _scalar(value):
+    # This really, really assumes a 1D numpy array (1,) or (1, 1)
+    if isinstance(value, (np.generic, np.ndarray)):
+        return float("%.15f" % value.ravel()[-1])
+    return float("%.15f" % value)
+
+
+def _log_new_results(results_dict, log_path, continue_log=True):
+    """
+    Append every value added to results_dict since the last call
+
+    Keys are appended at different rates (validation costs only at status
+    points, timings after the status call), so each value is logged with
+    its own position in its key's history as the step. A new results_dict
+    for the same log starts again from step 1, unless this is the first
+    call in this process and continue_log is True - then logging picks up
+    after the steps already in the log, for continued training.
+    """
+    entry = _logged_lengths.get(log_path)
+    if entry is None or entry[0] is not results_dict:
+        lengths = {}
+        if entry is None and continue_log and os.path.exists(log_path):
+            _, steps = read_metrics_log(log_path, return_steps=True)
+            lengths = dict((k, max(v)) for k, v in steps.items())
+        entry = (results_dict, lengths)
+        _logged_lengths[log_path] = entry
+    logged = entry[1]
+    rows = []
+    for k in sorted(results_dict.keys(), key=str):
+        values = results_dict[k]
+        for i in range(logged.get(str(k), 0), len(values)):
+            rows.append((i + 1, k, _scalar(values[i])))
+        logged[str(k)] = len(values)
+    _append_rows_to_log(rows, log_path)
+
+
+def read_metrics_log(log_path, return_steps=False):
+    """ Read a metrics csv log written during training
+
+    Parameters
+    ----------
+    log_path : string
+        Path to a model_checkpoint_log.csv or model_update_log.csv file
+
+    return_steps : bool, optional (default=False)
+        Also return the step each value was logged at
+
+    Returns
+    -------
+    results_dict : dict
+        Dictionary of key -> list of values, in the order they were logged
+
+    steps_dict : dict
+        Dictionary of key -> list of int steps, only if return_steps
+    """
+    results_dict = defaultdict(list)
+    steps_dict = defaultdict(list)
+    with open(log_path, "r") as f:
+        # Skip header
+        f.readline()
+        for line in f:
+            # Keys may contain commas, values and the leading columns never
+            _, step, rest = line.rstrip("\n").split(",", 2)
+            key, value = rest.rsplit(",", 1)
+            results_dict[key].append(float(value))
+            steps_dict[key].append(int(step))
+    if return_steps:
+        return results_dict, steps_dict
+    return results_dict
+
+
+def write_metrics_log_as_html(log_path, save_path=None):
+    """ Render a metrics csv log to an html plot on demand """
+    if save_path is None:
+        save_path = os.path.splitext(log_path)[0] + ".html"
+    results_dict = read_metrics_log(log_path)
+    show_keys = [k for k in results_dict.keys() if "_auto" not in k]
+    _write_results_as_html(results_dict, save_path, default_show=show_keys)
+    return save_path
+
+
 def _get_file_matches(glob_ext, append_name):
     all_files = glob.glob(
         os.path.join(get_checkpoint_dir(), glob_ext))
@@ -301,7 +644,8 @@ def _archive_dagbldr():
     code_snapshot_dir = os.path.join(checkpoint_dir, "code_snapshot")
     if not os.path.exists(code_snapshot_dir):
         os.mkdir(code_snapshot_dir)
-    save_script_path = os.path.join(code_snapshot_dir, main.__file__)
+    save_script_path = os.path.join(code_snapshot_dir,
+                                    os.path.basename(main.__file__))
     training_utils_dir = inspect.getfile(inspect.currentframe())
     lib_dir = str(os.sep).join(training_utils_dir.split(os.sep)[:-2])
     save_lib_path = os.path.join(code_snapshot_dir, "dagbldr_archive.zip")
@@ -315,16 +659,122 @@ def _archive_dagbldr():
         _zip_dir(lib_dir, save_lib_path)
 
 
+class _MetricArray(object):
+    """
+    Append only storage for one training metric.
+
+    Values are stored in a float64 array which doubles in size when full.
+    Counts of NaN and inf values, as well as the min, max and sum of the
+    finite values, are kept up to date on every append so checks never need
+    to rescan the history.
+
+    Acts enough like a list (append, len, indexing, iteration, + list) to
+    be a drop in replacement for the lists in a results dictionary.
+    """
+    def __init__(self, values=None):
+        self._values = np.zeros((16,), dtype="float64")
+        self._n = 0
+        self.n_nan = 0
+        self.n_inf = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.total = 0.
+        if values is not None:
+            for v in values:
+                self.append(v)
+
+    def append(self, value):
+        # Outputs are 0D or size 1 arrays, mean keeps the old np.mean behavior
+        value = float(np.mean(value))
+        if self._n == len(self._values):
+            self._values = np.concatenate(
+                (self._values, np.zeros_like(self._values)))
+        self._values[self._n] = value
+        self._n += 1
+        if np.isnan(value):
+            self.n_nan += 1
+        elif np.isinf(value):
+            self.n_inf += 1
+        else:
+            self.minimum = min(self.minimum, value)
+            self.maximum = max(self.maximum, value)
+            self.total += value
+
+    @property
+    def values(self):
+        return self._values[:self._n]
+
+    def all_finite(self):
+        return (self.n_nan + self.n_inf) == 0
+
+    def tolist(self):
+        return self.values.tolist()
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.tolist()
+
+    def __reduce__(self):
+        # Pickle as a plain list so checkpoints do not depend on this class
+        return (list, (self.tolist(),))
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.values.copy()
+        return self.values.astype(dtype)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+def _new_results_dict(previous_results=None):
+    """ Results dictionary of key -> _MetricArray, converting old lists """
+    results_dict = defaultdict(_MetricArray)
+    if previous_results is not None:
+        for k, v in previous_results.items():
+            if isinstance(v, _MetricArray):
+                results_dict[k] = v
+            else:
+                results_dict[k] = _MetricArray(v)
+    return results_dict
+
+
+def _find_nan_keys(results_dict):
+    """ Keys with any NaN in their history. O(n_keys) for _MetricArray """
+    nan_keys = set()
+    for k, v in results_dict.items():
+        if isinstance(v, _MetricArray):
+            if v.n_nan > 0:
+                nan_keys.add(k)
+        elif any([np.any(np.isnan(vi)) for vi in v]):
+            nan_keys.add(k)
+    return nan_keys
+
+
+def _metric_min(values):
+    if isinstance(values, _MetricArray):
+        return values.minimum
+    # Quick trick to avoid 0 length list
+    return min(list(values) + [np.inf])
+
+
 def monitor_status_func(results_dict, append_name=None, status_type="epoch",
                         nan_check=True, print_output=True):
     """ Dump the last results from a results dictionary """
     n_seen = max([len(l) for l in results_dict.values()])
-    last_results = {k: v[-1] for k, v in results_dict.items()}
-    # This really, really assumes a 1D numpy array (1,) or (1, 1)
-    last_results = {k: float("%.15f" % v.ravel()[-1])
-                    if isinstance(v, (np.generic, np.ndarray))
-                    else float("%.15f" % v)
-                    for k, v in last_results.items()}
+    last_results = {k: _scalar(v[-1]) for k, v in results_dict.items()
+                    if len(v) > 0}
     pp = pprint.PrettyPrinter()
     filename = main.__file__
     fileline = "Script %s" % str(filename)
@@ -341,44 +791,95 @@ def monitor_status_func(results_dict, append_name=None, status_type="epoch",
         print(statusline)
         print(breakline)
         pp.pprint(last_results)
+    save_path, log_path = _monitor_paths(n_seen, status_type, append_name)
+    if not _in_nosetest():
+        # Don't dump if testing!
+        # Only enable user defined keys
+        nan_keys = _find_nan_keys(results_dict) if nan_check else set()
+        if len(nan_keys) > 0:
+            raise ValueError("Found NaN values in the following keys ",
+                             "%s, exiting training" % nan_keys)
+        # Minibatch results restart every epoch
+        _log_new_results(results_dict, log_path,
+                         continue_log=status_type == "epoch")
+        # Full html renders are expensive and grow with training length
+        now = time.time()
+        last_render = _last_html_render_times.get(log_path, -np.inf)
+        if (now - last_render) < HTML_RENDER_INTERVAL_S:
+            # Written at the end of training if nothing renders sooner
+            _pending_html_renders[log_path] = (results_dict, status_type,
+                                               append_name)
+            return
+        _last_html_render_times[log_path] = now
+        _pending_html_renders.pop(log_path, None)
+        _render_monitor_html(results_dict, save_path, status_type,
+                             append_name)
+
+
+def _monitor_paths(n_seen, status_type, append_name):
+    """ html monitor and csv log paths for monitor_status_func """
     if status_type == "epoch":
         save_path = os.path.join(get_checkpoint_dir(),
                                  "model_checkpoint_%i.html" % n_seen)
+        log_path = os.path.join(get_checkpoint_dir(),
+                                "model_checkpoint_log.csv")
     elif status_type == "update":
         save_path = os.path.join(get_checkpoint_dir(),
                                  "model_update_%i.html" % n_seen)
+        log_path = os.path.join(get_checkpoint_dir(),
+                                "model_update_log.csv")
 
     if append_name is not None:
         split = save_path.split("_")
         save_path = "_".join(
             split[:-1] + [append_name] + split[-1:])
-    if not _in_nosetest():
-        # Don't dump if testing!
-        # Only enable user defined keys
-        nan_test = [(k, True) for k, r_v in results_dict.items()
-                    for v in r_v if np.isnan(v)]
-        if nan_check and len(nan_test) > 0:
-            nan_keys = set([tup[0] for tup in nan_test])
-            raise ValueError("Found NaN values in the following keys ",
-                             "%s, exiting training" % nan_keys)
-        show_keys = [k for k in results_dict.keys()
-                     if "_auto" not in k]
-        _write_results_as_html(results_dict, save_path,
-                               default_show=show_keys)
-        if status_type == "epoch":
-            _cleanup_monitors("checkpoint", append_name)
-        elif status_type == "update":
-            _cleanup_monitors("update", append_name)
+        split = log_path.split("_")
+        log_path = "_".join(
+            split[:-1] + [append_name] + split[-1:])
+    return save_path, log_path
+
+
+def _render_monitor_html(results_dict, save_path, status_type, append_name):
+    show_keys = [k for k in results_dict.keys()
+                 if "_auto" not in str(k)]
+    _write_results_as_html(results_dict, save_path,
+                           default_show=show_keys)
+    if status_type == "epoch":
+        _cleanup_monitors("checkpoint", append_name)
+    elif status_type == "update":
+        _cleanup_monitors("update", append_name)
+
+
+def _flush_monitor_html():
+    """
+    Log values appended since the last monitor call, such as the timing of
+    the final status call, and write html monitors skipped by the render
+    rate limit
+    """
+    if _in_nosetest():
+        return
+    for log_path, (results_dict, lengths) in list(_logged_lengths.items()):
+        _log_new_results(results_dict, log_path)
+        # Continued training reads the logged steps back from the log
+        del _logged_lengths[log_path]
+    for log_path in list(_pending_html_renders.keys()):
+        results_dict, status_type, append_name = (
+            _pending_html_renders.pop(log_path))
+        # Named for the results as they are now, not at the skipped call
+        n_seen = max([len(l) for l in results_dict.values()])
+        save_path, _ = _monitor_paths(n_seen, status_type, append_name)
+        _last_html_render_times[log_path] = time.time()
+        _render_monitor_html(results_dict, save_path, status_type,
+                             append_name)
 
 
 def checkpoint_status_func(checkpoint_dict, epoch_results,
                            append_name=None, nan_check=True):
     """ Saves a checkpoint dict """
-    checkpoint_dict["previous_epoch_results"] = epoch_results
-    nan_test = [(k, True) for k, e_v in epoch_results.items()
-                for v in e_v if np.isnan(v)]
-    if nan_check and len(nan_test) > 0:
-        nan_keys = set([tup[0] for tup in nan_test])
+    # Plain dict, a defaultdict would pickle a reference to _MetricArray
+    checkpoint_dict["previous_epoch_results"] = dict(epoch_results)
+    nan_keys = _find_nan_keys(epoch_results) if nan_check else set()
+    if len(nan_keys) > 0:
         raise ValueError("Found NaN values in the following keys ",
                          "%s, exiting training without saving" % nan_keys)
 
@@ -391,9 +892,17 @@ def checkpoint_status_func(checkpoint_dict, epoch_results,
             split[:-1] + [append_name] + split[-1:])
     if not _in_nosetest():
         # Don't dump if testing!
+        checkpoint_start = time.time()
         save_checkpoint(save_path, checkpoint_dict)
         _cleanup_checkpoints(append_name)
+        epoch_results["checkpoint_time_s_auto"].append(
+            time.time() - checkpoint_start)
+    html_start = time.time()
     monitor_status_func(epoch_results, append_name=append_name)
+    if not _in_nosetest():
+        # Logged with the next status call
+        epoch_results["html_write_time_s_auto"].append(
+            time.time() - html_start)
 
 
 def early_stopping_status_func(valid_cost, valid_cost_name, checkpoint_dict,
@@ -416,10 +925,9 @@ def early_stopping_status_func(valid_cost, valid_cost_name, checkpoint_dict,
     status_func can then be fed to iterate_function for training with early
     stopping.
     """
-    # Quick trick to avoid 0 length list
-    old = min(epoch_results[valid_cost_name] + [np.inf])
+    old = _metric_min(epoch_results[valid_cost_name])
     epoch_results[valid_cost_name].append(valid_cost)
-    new = min(epoch_results[valid_cost_name])
+    new = _metric_min(epoch_results[valid_cost_name])
     if new < old:
         print("Saving checkpoint based on validation score")
         checkpoint_status_func(checkpoint_dict, epoch_results,
@@ -469,6 +977,101 @@ def make_minibatch(arg, slice_or_indices_list):
         return [arg[slice_or_indices_list, :]]
 
 
+def make_index_minibatch(arg, slice_or_indices_list):
+    """ Returns [start, stop, indices] for the minibatch samples in arg
+        or [start, stop, indices, mask] mask of ones if 3D
+
+    For use with functions compiled using shared_dataset_givens - pass the
+    dataset as the minibatch arg and only the indices are sent each call.
+    Slices (with step 1) are sent as int32 start and stop with empty
+    indices, so the shared dataset is sliced rather than gathered.
+    """
+    if len(arg.shape) == 3:
+        n_samples = arg.shape[1]
+    else:
+        n_samples = arg.shape[0]
+    if type(slice_or_indices_list) is slice:
+        start, stop, step = slice_or_indices_list.indices(n_samples)
+    else:
+        step = None
+    if step == 1:
+        indices = np.zeros((0,), dtype="int32")
+        minibatch_size = max(stop - start, 0)
+    else:
+        if step is None:
+            indices = np.asarray(slice_or_indices_list, dtype="int32")
+        else:
+            indices = np.arange(start, stop, step, dtype="int32")
+        start = stop = 0
+        minibatch_size = len(indices)
+    r = [np.int32(start), np.int32(stop), indices]
+    if len(arg.shape) == 3:
+        r += [np.ones((arg.shape[0], minibatch_size),
+                      dtype=theano.config.floatX)]
+    return r
+
+
+def gen_chunk_shuffle_function(chunk_size, n_buffer_chunks=4):
+    """
+    Returns a function to shuffle indices with mostly sequential reads
+
+    For use as the shuffle_function of iterate_function with out of core
+    data, such as an EArray wrapped by add_memory_swapper (chunk_size should
+    match its chunks, see memory_swapper_stats). The order of the chunks is
+    shuffled, then samples are shuffled within buffers of n_buffer_chunks
+    consecutive chunks in that order - so each minibatch only touches a few
+    chunks, and each chunk is read once per epoch.
+
+    Example:
+    shuffle_function = gen_chunk_shuffle_function(
+        memory_swapper_stats(X)["chunk_size"], n_buffer_chunks=4)
+    """
+    def chunk_shuffle(indices, random_state):
+        indices = np.asarray(indices)
+        chunk_ids = indices // chunk_size
+        chunk_order = np.unique(chunk_ids)
+        random_state.shuffle(chunk_order)
+        # Rank of each sample's chunk in the shuffled chunk order
+        chunk_rank = np.empty(chunk_order.max() + 1, dtype="int64")
+        chunk_rank[chunk_order] = np.arange(len(chunk_order))
+        buffer_ids = chunk_rank[chunk_ids] // n_buffer_chunks
+        # Random tie breaking shuffles samples within each buffer
+        noise = random_state.rand(len(indices))
+        return indices[np.lexsort((noise, buffer_ids))]
+    return chunk_shuffle
+
+
+def gen_make_chunked_minibatch(chunk_size):
+    """
+    Returns a function that makes minibatches using one read per chunk
+
+    For use with list_of_minibatch_functions on out of core data, along with
+    gen_chunk_shuffle_function. Shuffled indices within each chunk are read
+    as a single slice, then put back in the requested order.
+    """
+    def make_chunked_minibatch(arg, slice_or_indices_list):
+        if (type(slice_or_indices_list) is slice or
+                len(arg.shape) == 3):
+            return make_minibatch(arg, slice_or_indices_list)
+        indices = np.asarray(slice_or_indices_list)
+        order = np.argsort(indices, kind="mergesort")
+        sorted_indices = indices[order]
+        chunk_ids = sorted_indices // chunk_size
+        bounds = np.flatnonzero(np.diff(chunk_ids)) + 1
+        bounds = np.concatenate(([0], bounds, [len(sorted_indices)]))
+        pieces = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            lower = sorted_indices[start]
+            upper = sorted_indices[stop - 1] + 1
+            block = arg[lower:upper]
+            pieces.append(block[sorted_indices[start:stop] - lower])
+        sorted_minibatch = np.concatenate(pieces, axis=0)
+        minibatch = np.empty_like(sorted_minibatch)
+        minibatch[order] = sorted_minibatch
+        return [minibatch]
+    return make_chunked_minibatch
+
+
 def make_embedding_minibatch(arg, slice_type):
     if type(slice_type) is not slice:
         raise ValueError("Text formatters for list of list can only use "
@@ -522,6 +1125,268 @@ def gen_make_list_one_hot_minibatch(n_targets):
     return make_list_one_hot_minibatch
 
 
+def _contiguous_to_slices(minibatch_indices):
+    """ Replace contiguous runs of indices with slices to avoid copies """
+    return [slice(mi[0], mi[-1] + 1, 1)
+            if np.all(np.diff(mi) == 1)
+            else mi
+            for mi in minibatch_indices]
+
+
+def _make_minibatch_args(list_of_minibatch_args, mi,
+                         list_of_minibatch_functions,
+                         list_of_preprocessing_functions=None,
+                         phase_times=None):
+    """ Build the flat argument list for one minibatch
+
+    If phase_times is a dict of lists, the time spent in minibatch and
+    preprocessing functions is appended under "minibatch" and "preprocess"
+    """
+    minibatch_args = []
+    minibatch_time = 0.
+    preprocess_time = 0.
+    for n, arg in enumerate(list_of_minibatch_args):
+        if list_of_preprocessing_functions is not None:
+            t0 = time.time()
+            r = list_of_minibatch_functions[n](arg, mi)
+            t1 = time.time()
+            minibatch_args += [list_of_preprocessing_functions[n](*r)]
+            minibatch_time += t1 - t0
+            preprocess_time += time.time() - t1
+        else:
+            # list of minibatch_functions can't always be the right size
+            # (enc-dec with mask coming from mb func)
+            t0 = time.time()
+            r = list_of_minibatch_functions[n](arg, mi)
+            minibatch_time += time.time() - t0
+            # support embeddings
+            if type(r[0]) is list:
+                minibatch_args += r[0]
+                minibatch_args += r[1:]
+            else:
+                minibatch_args += r
+    if phase_times is not None:
+        phase_times["minibatch"].append(minibatch_time)
+        if list_of_preprocessing_functions is not None:
+            phase_times["preprocess"].append(preprocess_time)
+    return minibatch_args
+
+
+def _summarize_phase_times(phase_times):
+    """ p50, p95 and max wall clock time for each timed phase """
+    summary = {}
+    for phase, times in phase_times.items():
+        times = np.asarray(times)
+        p50, p95 = np.percentile(times, [50, 95])
+        summary["%s_time_p50_s_auto" % phase] = p50
+        summary["%s_time_p95_s_auto" % phase] = p95
+        summary["%s_time_max_s_auto" % phase] = times.max()
+    return summary
+
+
+def _finish_profile(profiler):
+    """ Stop a minibatch profiler, saving and printing cProfile stats """
+    profiler.disable()
+    if not hasattr(profiler, "dump_stats"):
+        # Custom profilers handle their own output
+        return
+    if not _in_nosetest():
+        save_path = os.path.join(get_checkpoint_dir(),
+                                 "minibatch_profile.prof")
+        print("Saving minibatch profile to %s" % save_path)
+        profiler.dump_stats(save_path)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+
+def _layer_name_from_key(key):
+    """ Strip dagbldr parameter and scan suffixes to get the layer name """
+    while key.startswith("grad_of_"):
+        key = key[len("grad_of_"):]
+    for suffix_re in _LAYER_SUFFIX_RES:
+        key = suffix_re.sub("", key)
+    return key
+
+
+def _set_theano_profile_flags(profile, profile_memory):
+    """ Set theano profile flags by hand, returns the previous values
+
+    theano.change_flags is missing from older theano versions.
+    """
+    old_flags = (theano.config.profile, theano.config.profile_memory)
+    theano.config.profile = profile
+    theano.config.profile_memory = profile_memory
+    return old_flags
+
+
+def _make_theano_profiled_function(func):
+    """
+    Copy a compiled theano function with op level profiling enabled
+
+    The copy shares memory (including shared variable updates) with func,
+    so calls can be swapped between the two during training. Memory
+    profiling forces the python Stack VM, so times are only comparable
+    within the profiled function.
+    """
+    if hasattr(inspect, "getfullargspec"):
+        copy_args = inspect.getfullargspec(func.copy).args
+    else:
+        copy_args = inspect.getargspec(func.copy).args
+    if "share_memory" not in copy_args or "profile" not in copy_args:
+        raise ValueError("Layer profiling needs a theano version where "
+                         "Function.copy takes share_memory and profile "
+                         "arguments, found theano %s" % theano.__version__)
+    profile = theano.compile.profiling.ProfileStats(
+        atexit_print=False, message="dagbldr layer profile")
+    old_flags = _set_theano_profile_flags(True, True)
+    try:
+        profiled_func = func.copy(share_memory=True, profile=profile)
+    finally:
+        _set_theano_profile_flags(*old_flags)
+    return profiled_func
+
+
+def _call_theano_profiled_function(profiled_func, args):
+    # Theano checks the profile flags at call time for the Stack VM
+    old_flags = _set_theano_profile_flags(True, True)
+    try:
+        return profiled_func(*args)
+    finally:
+        _set_theano_profile_flags(*old_flags)
+
+
+def theano_layer_profile(profiled_func, graph):
+    """
+    Attribute op times of a profiled theano function to dagbldr layers
+
+    Function inputs are matched to shared variables in graph and labeled
+    by layer name (name + '_W' -> name), scan ops by their scan name
+    (name + '_gru_recurrent_scan' -> name). Labels are propagated forward
+    through the graph - an op takes the label of a parameter input if it
+    has one, otherwise that of its most recently computed labeled input.
+    Ops with no labeled input are reported as "(unattributed)".
+
+    Parameters
+    ----------
+    profiled_func : compiled theano function
+        Function compiled or copied with a theano ProfileStats as profile,
+        see _make_theano_profiled_function.
+
+    graph : OrderedDict
+        The graph used to build profiled_func.
+
+    Returns
+    -------
+    layer_profile : list of dict
+        One dict per layer, sorted by time_s with the most expensive layer
+        first. Keys are layer, time_s, time_per_call_s, time_fraction,
+        n_ops, output_bytes and param_bytes. output_bytes is the memory of
+        op outputs from the last call.
+    """
+    profile = profiled_func.profile
+    fgraph = profiled_func.maker.fgraph
+    # Copied functions clone shared variables but keep their containers
+    container_to_key = {}
+    param_bytes = defaultdict(int)
+    for k, v in graph.items():
+        if isinstance(v, theano.compile.SharedVariable):
+            container_to_key[id(v.container)] = k
+            layer = _layer_name_from_key(k)
+            param_bytes[layer] += v.get_value(borrow=True).nbytes
+
+    # variable -> (strength, order, layer)
+    # strength 2 means derived only from parameters of that layer
+    labels = {}
+    for fgraph_inp, maker_inp in zip(fgraph.inputs,
+                                     profiled_func.maker.inputs):
+        container = getattr(maker_inp.variable, "container", None)
+        if id(container) in container_to_key:
+            key = container_to_key[id(container)]
+            labels[fgraph_inp] = (2, -1, _layer_name_from_key(key))
+
+    apply_time = defaultdict(float)
+    for k, t in profile.apply_time.items():
+        # Keyed by (fgraph, node) in some theano versions
+        if isinstance(k, tuple):
+            k = k[1]
+        apply_time[k] += t
+
+    unattributed = "(unattributed)"
+    layer_stats = defaultdict(lambda: defaultdict(float))
+    for order, node in enumerate(fgraph.toposort()):
+        op_name = getattr(node.op, "name", None)
+        input_labels = [labels[i] for i in node.inputs if i in labels]
+        if type(node.op).__name__ == "Scan" and op_name is not None:
+            label = (1, order, _layer_name_from_key(op_name))
+        elif len(input_labels) > 0:
+            strength, _, layer = max(input_labels, key=lambda x: x[:2])
+            for i in node.inputs:
+                if isinstance(i, theano.Constant):
+                    continue
+                if labels.get(i, (0, 0, None))[::2] != (2, layer):
+                    strength = 1
+            label = (strength, order, layer)
+        else:
+            label = None
+        if label is not None:
+            for out in node.outputs:
+                labels[out] = label
+            layer = label[2]
+        else:
+            layer = unattributed
+        stats = layer_stats[layer]
+        stats["time_s"] += apply_time.get(node, 0.)
+        stats["n_ops"] += 1
+        for out in node.outputs:
+            shape = profile.variable_shape.get(out, None)
+            if shape is not None and hasattr(out.type, "dtype"):
+                stats["output_bytes"] += np.dtype(out.type.dtype).itemsize * \
+                    int(np.prod(shape))
+
+    total_time = sum([s["time_s"] for s in layer_stats.values()])
+    n_calls = max(profile.fct_callcount, 1)
+    layer_profile = []
+    for layer in set(layer_stats.keys()) | set(param_bytes.keys()):
+        stats = layer_stats[layer]
+        layer_profile.append({
+            "layer": layer,
+            "time_s": stats["time_s"],
+            "time_per_call_s": stats["time_s"] / n_calls,
+            "time_fraction": stats["time_s"] / max(total_time, 1E-12),
+            "n_ops": int(stats["n_ops"]),
+            "output_bytes": int(stats["output_bytes"]),
+            "param_bytes": int(param_bytes[layer])})
+    layer_profile = sorted(layer_profile, key=lambda x: x["time_s"],
+                           reverse=True)
+    return layer_profile
+
+
+def _format_layer_profile(layer_profile, n_calls):
+    lines = ["Layer profile over %i calls" % n_calls,
+             "%-40s %10s %8s %12s %6s %12s %12s" % (
+                 "layer", "time_s", "time_%", "per_call_ms", "ops",
+                 "output_MB", "param_MB")]
+    for l in layer_profile:
+        lines.append("%-40s %10.4f %8.2f %12.4f %6i %12.3f %12.3f" % (
+            l["layer"], l["time_s"], 100 * l["time_fraction"],
+            1000 * l["time_per_call_s"], l["n_ops"],
+            l["output_bytes"] / 1E6, l["param_bytes"] / 1E6))
+    return "\n".join(lines) + "\n"
+
+
+def _finish_theano_profile(profiled_func, graph):
+    """ Print and save the per layer report for a profiled function """
+    layer_profile = theano_layer_profile(profiled_func, graph)
+    report = _format_layer_profile(layer_profile,
+                                   profiled_func.profile.fct_callcount)
+    print(report)
+    if not _in_nosetest():
+        save_path = os.path.join(get_checkpoint_dir(), "layer_profile.txt")
+        print("Saving layer profile to %s" % save_path)
+        with open(save_path, "w") as f:
+            f.write(report)
+    return layer_profile
+
+
 def _iterate_function(func, list_of_minibatch_args, minibatch_size,
                       indices=None, list_of_non_minibatch_args=None,
                       list_of_minibatch_functions=[make_minibatch],
@@ -531,8 +1396,12 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
                       n_epoch_status=1,
                       epoch_status_func=default_status_func,
                       n_minibatch_status=.1,
+                      minibatch_status_func=monitor_status_func,
                       previous_epoch_results=None,
                       shuffle=False, random_state=None,
+                      shuffle_function=None,
+                      profile_minibatches=None, profiler=None,
+                      theano_profile_minibatches=None, graph=None,
                       verbose=False):
     """
     Minibatch arguments should come first.
@@ -554,9 +1423,41 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
 
     n_minibatch_status
 
+    minibatch_status_func is called as monitor_status_func every
+    n_minibatch_status minibatches. None disables minibatch monitoring.
+
     shuffle and random_state are used to determine if minibatches are run
     in sequence or selected randomly each epoch.
 
+    If shuffle is True and shuffle_function is given, the samples are
+    reordered each epoch by shuffle_function(indices, random_state) and
+    minibatches are run in that order, rather than shuffling the order of
+    fixed minibatches. See gen_chunk_shuffle_function.
+
+    Wall clock time per minibatch is recorded for each phase - building
+    minibatches ("minibatch"), preprocessing functions ("preprocess"),
+    calling func ("function") and per minibatch monitoring ("monitor") -
+    and summarized as p50, p95 and max into epoch_results keys such as
+    function_time_p95_s_auto. Total time spent in epoch_status_func is
+    stored as epoch_status_time_s_auto at status points. With
+    early_stopping_trainer its parts are also stored separately, as
+    valid_time_s_auto, checkpoint_time_s_auto and html_write_time_s_auto
+    (the monitor_status_func call writing the csv log and html monitor).
+    Keys appended after a status call are logged with the next one.
+
+    profile_minibatches is an optional (start, stop) pair of minibatch
+    counts, counted across epochs in this call. Minibatches in that window
+    are profiled with profiler, a cProfile.Profile by default - any object
+    with enable() and disable() methods, such as a sampling profiler, works.
+    cProfile stats are printed and saved as minibatch_profile.prof in the
+    checkpoint directory.
+
+    theano_profile_minibatches is a (start, stop) window in the same units,
+    where func is swapped for a copy compiled with theano's op profiler. Op
+    times and memory are attributed to the layers in graph (required) by
+    theano_layer_profile, and the sorted report is printed and saved as
+    layer_profile.txt in the checkpoint directory.
+
     By far the craziest function in this library.
 
     Example validation function:
@@ -583,10 +1484,7 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
                                  shuffle=True,
                                  random_state=random_state)
     """
-    if previous_epoch_results is None:
-        epoch_results = defaultdict(list)
-    else:
-        epoch_results = previous_epoch_results
+    epoch_results = _new_results_dict(previous_epoch_results)
 
     # Input checking and setup
     if shuffle:
@@ -621,12 +1519,7 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
     minibatch_indices = [indices[i:i + minibatch_size]
                          for i in np.arange(0, len(indices), minibatch_size)]
     # Check for contiguous chunks to avoid unnecessary copies
-    minibatch_indices = [slice(mi[0], mi[-1] + 1, 1)
-                         if np.all(np.abs(np.array(mi) -
-                                          np.arange(mi[0], mi[-1] + 1, 1))
-                                   < 1E-8)
-                         else mi
-                         for mi in minibatch_indices]
+    minibatch_indices = _contiguous_to_slices(minibatch_indices)
 
     if n_epoch_status <= 0:
         raise ValueError("n_epoch_status must be > 0")
@@ -675,38 +1568,64 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
     if not _in_nosetest():
         _archive_dagbldr()
     if len(epoch_results.keys()) != 0:
-        last_update_count = epoch_results[
-            "total_number_of_updates_auto"][-1]
-        last_epoch_count = epoch_results["total_number_of_epochs_auto"][-1]
+        # _MetricArray stores float64, the counters are ints
+        last_update_count = int(epoch_results[
+            "total_number_of_updates_auto"][-1])
+        last_epoch_count = int(
+            epoch_results["total_number_of_epochs_auto"][-1])
     else:
         last_update_count = 0
         last_epoch_count = 0
+    if profile_minibatches is not None:
+        profile_start, profile_stop = profile_minibatches
+        assert profile_stop > profile_start
+        if profiler is None:
+            profiler = cProfile.Profile()
+    if theano_profile_minibatches is not None:
+        if graph is None:
+            raise ValueError("graph must be provided to attribute "
+                             "theano_profile_minibatches to layers")
+        theano_profile_start, theano_profile_stop = theano_profile_minibatches
+        assert theano_profile_stop > theano_profile_start
+        profiled_func = _make_theano_profiled_function(func)
     for e in range(n_epochs):
         epoch_start = time.time()
-        results = defaultdict(list)
-        if shuffle:
+        results = _new_results_dict()
+        phase_times = defaultdict(list)
+        if shuffle and shuffle_function is not None:
+            epoch_indices = shuffle_function(indices, random_state)
+            minibatch_indices = _contiguous_to_slices(
+                [epoch_indices[i:i + minibatch_size]
+                 for i in np.arange(0, len(epoch_indices), minibatch_size)])
+        elif shuffle:
             random_state.shuffle(minibatch_indices)
         for minibatch_count, mi in enumerate(minibatch_indices):
-            minibatch_args = []
-            for n, arg in enumerate(list_of_minibatch_args):
-                if list_of_preprocessing_functions is not None:
-                    minibatch_args += [list_of_preprocessing_functions[n](
-                        *list_of_minibatch_functions[n](arg, mi))]
-                else:
-                    # list of minibatch_functions can't always be the right size
-                    # (enc-dec with mask coming from mb func)
-                    r = list_of_minibatch_functions[n](arg, mi)
-                    # support embeddings
-                    if type(r[0]) is list:
-                        minibatch_args += r[0]
-                        minibatch_args += r[1:]
-                    else:
-                        minibatch_args += r
+            profile_count = e * len(minibatch_indices) + minibatch_count
+            if profile_minibatches is not None:
+                if profile_count == profile_start:
+                    print("Starting minibatch profile")
+                    profiler.enable()
+                elif profile_count == profile_stop:
+                    _finish_profile(profiler)
+            minibatch_args = _make_minibatch_args(
+                list_of_minibatch_args, mi, list_of_minibatch_functions,
+                list_of_preprocessing_functions, phase_times=phase_times)
             if list_of_non_minibatch_args is not None:
                 all_args = minibatch_args + list_of_non_minibatch_args
             else:
                 all_args = minibatch_args
-            minibatch_results = func(*all_args)
+            function_start = time.time()
+            if (theano_profile_minibatches is not None and
+                    theano_profile_start <= profile_count <
+                    theano_profile_stop):
+                minibatch_results = _call_theano_profiled_function(
+                    profiled_func, all_args)
+            else:
+                minibatch_results = func(*all_args)
+            phase_times["function"].append(time.time() - function_start)
+            if (theano_profile_minibatches is not None and
+                    profile_count == theano_profile_stop - 1):
+                _finish_theano_profile(profiled_func, graph)
             if type(minibatch_results) is not list:
                 minibatch_results = [minibatch_results]
             for n, k in enumerate(minibatch_results):
@@ -716,13 +1635,16 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
                         minibatch_results[n])
                 else:
                     results[n].append(minibatch_results[n])
-            if minibatch_count % n_minibatch_status == 0:
+            if (minibatch_status_func is not None and
+                    minibatch_count % n_minibatch_status == 0):
+                monitor_start = time.time()
                 print("minibatch %i/%i" % (minibatch_count,
                                            len(minibatch_indices) - 1))
-                monitor_status_func(results, status_type="update",
-                                    print_output=verbose)
+                minibatch_status_func(results, status_type="update",
+                                      print_output=verbose)
+                phase_times["monitor"].append(time.time() - monitor_start)
         epoch_stop = time.time()
-        output = {r: np.mean(results[r]) for r in results.keys()}
+        output = {r: np.mean(results[r].values) for r in results.keys()}
         output["minibatch_size_auto"] = minibatch_size
         output["minibatch_count_auto"] = len(minibatch_indices)
         output["start_time_s_auto"] = global_start
@@ -736,16 +1658,99 @@ def _iterate_function(func, list_of_minibatch_args, minibatch_size,
         output["total_number_of_updates_auto"] = (
             e + 1) * (minibatch_count + 1) + last_update_count
         output["total_number_of_epochs_auto"] = e + 1 + last_epoch_count
+        output.update(_summarize_phase_times(phase_times))
         for k in output.keys():
             epoch_results[k].append(output[k])
         if e in status_points:
             if epoch_status_func is not None:
                 epoch_number = e
                 status_number = np.searchsorted(status_points, e)
+                status_start = time.time()
                 epoch_status_func(status_number, epoch_number, epoch_results)
+                epoch_results["epoch_status_time_s_auto"].append(
+                    time.time() - status_start)
+    if profile_minibatches is not None:
+        total_count = n_epochs * len(minibatch_indices)
+        if profile_start < total_count <= profile_stop:
+            # Window ran past the last minibatch
+            _finish_profile(profiler)
+    if theano_profile_minibatches is not None:
+        total_count = n_epochs * len(minibatch_indices)
+        if theano_profile_start < total_count < theano_profile_stop:
+            _finish_theano_profile(profiled_func, graph)
+    _flush_monitor_html()
     return epoch_results
 
 
+def _evaluate_function(func, list_of_minibatch_args, minibatch_size,
+                       indices=None, list_of_non_minibatch_args=None,
+                       list_of_minibatch_functions=[make_minibatch],
+                       list_of_preprocessing_functions=None,
+                       list_of_output_names=None,
+                       drop_partial_minibatch=False):
+    """
+    Evaluation only counterpart to _iterate_function.
+
+    Runs func once over indices in order, including a short final minibatch
+    unless drop_partial_minibatch is True. There is no monitoring, printing
+    or file I/O. Each output of func is assumed to be a mean over its
+    minibatch, so results are combined as a mean weighted by minibatch
+    length - the returned values are exact over all of indices.
+
+    Returns a dictionary of output name (or position) -> float
+    """
+    if indices is None:
+        try:
+            shape = list_of_minibatch_args[0].shape
+            if len(shape) == 3:
+                n_samples = shape[1]
+            else:
+                n_samples = shape[0]
+        except AttributeError:
+            n_samples = len(list_of_minibatch_args[0])
+        indices = np.arange(0, n_samples)
+
+    if drop_partial_minibatch and len(indices) % minibatch_size != 0:
+        indices = even_slice(indices,
+                             len(indices) - len(indices) % minibatch_size)
+    if len(indices) == 0:
+        raise ValueError("No samples to evaluate!")
+    minibatch_indices = [indices[i:i + minibatch_size]
+                         for i in np.arange(0, len(indices), minibatch_size)]
+    minibatch_lengths = [len(mi) for mi in minibatch_indices]
+    minibatch_indices = _contiguous_to_slices(minibatch_indices)
+
+    if len(list_of_minibatch_functions) == 1:
+        list_of_minibatch_functions = list_of_minibatch_functions * len(
+            list_of_minibatch_args)
+    if list_of_preprocessing_functions is not None and len(
+      list_of_preprocessing_functions) == 1:
+        list_of_preprocessing_functions = list_of_preprocessing_functions * len(
+            list_of_minibatch_args)
+
+    totals = None
+    for mi, length in zip(minibatch_indices, minibatch_lengths):
+        minibatch_args = _make_minibatch_args(
+            list_of_minibatch_args, mi, list_of_minibatch_functions,
+            list_of_preprocessing_functions)
+        if list_of_non_minibatch_args is not None:
+            minibatch_args = minibatch_args + list_of_non_minibatch_args
+        minibatch_results = func(*minibatch_args)
+        if type(minibatch_results) is not list:
+            minibatch_results = [minibatch_results]
+        weighted = [length * np.mean(r) for r in minibatch_results]
+        if totals is None:
+            totals = weighted
+        else:
+            totals = [t + w for t, w in zip(totals, weighted)]
+    n_evaluated = float(sum(minibatch_lengths))
+    if list_of_output_names is None:
+        list_of_output_names = list(range(len(totals)))
+    assert len(list_of_output_names) == len(totals)
+    return {k: float(t / n_evaluated)
+            for k, t in zip(list_of_output_names, totals)}
+
+
 def early_stopping_trainer(fit_function, cost_function,
                            checkpoint_dict,
                            list_of_minibatch_args,
@@ -758,25 +1763,49 @@ def early_stopping_trainer(fit_function, cost_function,
                            n_epochs=100, n_epoch_status=1,
                            n_minibatch_status=.1, previous_epoch_results=None,
                            shuffle=False, random_state=None,
+                           shuffle_function=None,
+                           valid_minibatch_size=None,
+                           drop_partial_valid_minibatch=False,
+                           profile_minibatches=None, profiler=None,
+                           theano_profile_minibatches=None, graph=None,
                            verbose=False):
     """
     cost_function should have 1 output
     cost_function_output_name sthould be a string
     fit_function can be any fit function
     fit_function_names should be a list of names to map to fit_function outputs
+
+    Validation runs through _evaluate_function, in minibatches of
+    valid_minibatch_size (defaults to minibatch_size). Since no gradients are
+    computed this can usually be much larger than minibatch_size. The final
+    short minibatch is kept unless drop_partial_valid_minibatch is True,
+    which is needed for graphs with a fixed minibatch size such as
+    add_embedding_datasets_to_graph.
+
+    shuffle, random_state and shuffle_function are passed to
+    _iterate_function for training minibatches.
+
+    profile_minibatches and profiler are passed to _iterate_function to
+    profile a window of training minibatches with cProfile, and
+    theano_profile_minibatches and graph to get a per layer theano op
+    profile of fit_function over a window.
     """
+    if valid_minibatch_size is None:
+        valid_minibatch_size = minibatch_size
+
     def status_func(status_number, epoch_number, epoch_results):
-        valid_results = _iterate_function(
+        valid_start = time.time()
+        valid_results = _evaluate_function(
             cost_function, list_of_minibatch_args,
-            minibatch_size,
+            valid_minibatch_size,
             list_of_non_minibatch_args=list_of_non_minibatch_args,
             indices=valid_indices,
-            epoch_status_func=None,
             list_of_minibatch_functions=list_of_minibatch_functions,
-            list_of_output_names=[cost_function_output_name], n_epochs=1,
-            verbose=verbose)
+            list_of_output_names=[cost_function_output_name],
+            drop_partial_minibatch=drop_partial_valid_minibatch)
+        epoch_results["valid_time_s_auto"].append(time.time() - valid_start)
         early_stopping_status_func(
-            valid_results[cost_function_output_name][-1],
+            valid_results[cost_function_output_name],
             cost_function_output_name,
             checkpoint_dict, epoch_results)
 
@@ -787,5 +1816,10 @@ def early_stopping_trainer(fit_function, cost_function,
         list_of_output_names=fit_function_output_names,
         previous_epoch_results=previous_epoch_results,
         epoch_status_func=status_func, n_epoch_status=n_epoch_status,
-        n_epochs=n_epochs, verbose=verbose)
+        n_epochs=n_epochs, shuffle=shuffle, random_state=random_state,
+        shuffle_function=shuffle_function,
+        profile_minibatches=profile_minibatches,
+        profiler=profiler,
+        theano_profile_minibatches=theano_profile_minibatches, graph=graph,
+        verbose=verbose)
     return epoch_results
@@ -3,13 +3,22 @@
 import numpy as np
 import theano
 from theano import tensor
+from theano.ifelse import ifelse
 from theano.scan_module.scan_utils import infer_shape
 from theano.gof.fg import MissingInputError
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 from collections import OrderedDict
 
 TAG_ID = "_dagbldr_"
 DATASETS_ID = "__datasets__"
 RANDOM_ID = "__random__"
+RNG_ID = "__rng__"
+INFERENCE_ID = "__inference__"
+MODE_ID = "__mode__"
+LAYERS_ID = "__layers__"
+QUANTIZED_ID = "__quantized__"
+SPECIAL_IDS = (DATASETS_ID, RANDOM_ID, RNG_ID, INFERENCE_ID, MODE_ID,
+               LAYERS_ID, QUANTIZED_ID)
 
 
 def safe_zip(*args):
@@ -176,6 +185,145 @@ def add_random_to_graph(list_of_random, list_of_shapes, list_of_names,
     return random_added
 
 
+def fetch_random_stream_from_graph(graph, random_state=None):
+    """
+    Return the MRG_RandomStreams shared by every stochastic node in graph
+
+    The stream is created and seeded from random_state on first use, so
+    all layers draw from one generator instead of building one each.
+    """
+    assert type(graph) is OrderedDict
+    if RNG_ID not in graph.keys():
+        if random_state is None:
+            raise ValueError("random_state must be provided the first time "
+                             "a random stream is requested from the graph!")
+        theano_seed = random_state.randint(-2147462579, 2147462579)
+        # Super edge case...
+        if theano_seed == 0:
+            print("WARNING: prior layer got 0 seed. Reseeding...")
+            theano_seed = random_state.randint(-2**32, 2**32)
+        graph[RNG_ID] = MRG_RandomStreams(seed=theano_seed)
+    return graph[RNG_ID]
+
+
+def add_layer_to_graph(layer_type, name, dict_of_inputs, list_of_outputs,
+                       dict_of_params, graph, **options):
+    """
+    Record a layer so the graph can be exported, see export_graph
+
+    dict_of_inputs maps an input role ("inputs", "mask", ...) to a list of
+    expressions, dict_of_params maps a parameter role to its graph name.
+    options must be JSON serializable.
+    """
+    assert type(graph) is OrderedDict
+    if LAYERS_ID not in graph.keys():
+        graph[LAYERS_ID] = []
+    layer = {"type": layer_type, "name": name,
+             "inputs": OrderedDict((k, list(v))
+                                   for k, v in dict_of_inputs.items()),
+             "outputs": list(list_of_outputs),
+             "params": OrderedDict(dict_of_params),
+             "options": options}
+    graph[LAYERS_ID].append(layer)
+    return layer
+
+
+def set_graph_mode(graph, mode):
+    """
+    Set the build mode of graph, either "train" or "inference"
+
+    Layers added while in inference mode skip dropout and return means
+    instead of samples, so no random number generation is built at all.
+    """
+    assert type(graph) is OrderedDict
+    if mode not in ("train", "inference"):
+        raise ValueError("Unknown graph mode %s, must be train "
+                         "or inference" % mode)
+    graph[MODE_ID] = mode
+
+
+def get_graph_mode(graph):
+    """ Return the build mode of graph, train if it was never set """
+    if MODE_ID not in graph.keys():
+        return "train"
+    return graph[MODE_ID]
+
+
+def add_inference_replacements_to_graph(list_of_train, list_of_inference,
+                                        graph):
+    """
+    Register train time expressions and their deterministic replacements
+
+    Used by dropout (undropped input) and sample layers (distribution
+    mean), see make_inference_outputs.
+    """
+    assert type(graph) is OrderedDict
+    if INFERENCE_ID not in graph.keys():
+        graph[INFERENCE_ID] = []
+    pairs = list(safe_zip(list_of_train, list_of_inference))
+    graph[INFERENCE_ID] += pairs
+    return pairs
+
+
+def make_inference_outputs(list_of_outputs, graph, givens=None):
+    """
+    Clone list_of_outputs with every registered train expression replaced
+
+    Functions compiled from the returned outputs contain no RNG ops or
+    random state updates. givens are applied first and take precedence,
+    which allows intermediate inputs such as a sample fed to a decoder.
+    """
+    if givens is None:
+        givens = OrderedDict()
+    replace = OrderedDict(givens)
+    if INFERENCE_ID in graph.keys():
+        # Leaves such as quantized parameters go first, so every
+        # expression registered before them is cleaned of them too
+        pairs = [p for p in graph[INFERENCE_ID] if p[0].owner is None]
+        pairs += [p for p in graph[INFERENCE_ID] if p[0].owner is not None]
+        for train, inference in pairs:
+            if train in replace:
+                continue
+            # Replacements are not rewritten by clone, so clean each one
+            # against everything registered before it
+            if len(replace) > 0:
+                inference = theano.clone(inference, replace=replace)
+            if inference.dtype != train.dtype:
+                inference = tensor.cast(inference, train.dtype)
+            replace[train] = inference
+    if len(replace) == 0:
+        return list_of_outputs
+    return theano.clone(list_of_outputs, replace=replace)
+
+
+def compile_inference_function(list_of_inputs, list_of_outputs, graph,
+                               **kwargs):
+    """
+    theano.function over the inference version of list_of_outputs
+
+    Inputs the pruned outputs no longer depend on (dropout switches,
+    noise) are dropped, the remaining ones keep their order. kwargs are
+    passed to theano.function.
+
+    Returns
+    -------
+    func : theano function
+    list_of_used_inputs : list of theano variables accepted by func
+    """
+    # Fresh inputs cut the graph at intermediate inputs
+    placeholders = [inp.type() for inp in list_of_inputs]
+    for inp, placeholder in zip(list_of_inputs, placeholders):
+        placeholder.name = inp.name
+    givens = OrderedDict(zip(list_of_inputs, placeholders))
+    outputs = make_inference_outputs(list_of_outputs, graph, givens=givens)
+    used = theano.gof.graph.inputs(outputs)
+    keep = [n for n, p in enumerate(placeholders) if p in used]
+    list_of_used_inputs = [list_of_inputs[n] for n in keep]
+    func = theano.function([placeholders[n] for n in keep], outputs,
+                           **kwargs)
+    return func, list_of_used_inputs
+
+
 def add_embedding_datasets_to_graph(list_of_embedding_vectors, list_of_masks,
                                     base_name, graph, strict=True):
     assert type(list_of_masks) is list
@@ -236,6 +384,60 @@ def add_datasets_to_graph(list_of_datasets, list_of_names, graph, strict=True,
     return datasets_added
 
 
+def shared_dataset_givens(list_of_syms, list_of_datasets):
+    """
+    Load datasets once into shared variables, indexed per minibatch
+
+    Compile functions with givens=givens and index_syms as the only data
+    inputs, then use make_index_minibatch so each call only passes a start
+    and stop (for slices) or integer indices instead of copying a sliced
+    minibatch. Slices are taken as views of the shared data, only index
+    lists (such as from a shuffle_function) gather rows. 3D datasets are
+    indexed along axis 1, the same as make_minibatch.
+
+    The shared variables are not added to the graph, so they are not
+    treated as parameters.
+
+    Parameters
+    ----------
+    list_of_syms : list of theano variables
+        Symbolic inputs, usually from add_datasets_to_graph.
+
+    list_of_datasets : list of numpy arrays
+        Full datasets for each symbolic input. They are cast to the dtype
+        of the matching symbol.
+
+    Returns
+    -------
+    index_syms : list of theano variables
+        [start iscalar, stop iscalar, indices ivector]. Indices are used if
+        non-empty, otherwise start:stop.
+
+    givens : OrderedDict
+        Replacements from each symbol to its indexed shared dataset.
+    """
+    start_sym = tensor.iscalar()
+    stop_sym = tensor.iscalar()
+    index_sym = tensor.ivector()
+    use_slice = tensor.eq(index_sym.shape[0], 0)
+    givens = OrderedDict()
+    for sym, dataset in safe_zip(list_of_syms, list_of_datasets):
+        if sym.ndim != len(dataset.shape):
+            raise ValueError("dataset for %s has ndim %i, expected %i" % (
+                sym.name, len(dataset.shape), sym.ndim))
+        shared_dataset = as_shared(np.asarray(dataset, dtype=sym.dtype))
+        # Lazy ifelse runs one branch, the other would select no rows anyway
+        if sym.ndim == 3:
+            givens[sym] = ifelse(use_slice,
+                                 shared_dataset[:, start_sym:stop_sym],
+                                 shared_dataset[:, index_sym])
+        else:
+            givens[sym] = ifelse(use_slice,
+                                 shared_dataset[start_sym:stop_sym],
+                                 shared_dataset[index_sym])
+    return [start_sym, stop_sym, index_sym], givens
+
+
 def tag_expression(expression, name, shape):
     expression.name = make_shapename(name, shape)
 
@@ -276,15 +478,21 @@ def alt_shape_of_variables(inputs, outputs, input_shapes):
     output_dims = list(*infer_shape(cloned_outputs, cloned_inputs,
                                     [input_shapes[k] for k in inputs]))
 
+    numeric_input_dims = [dim for kept_idx in kept_input
+                          for dim in cloned_shapes[fgraph.inputs[kept_idx]]]
+    # Dimensions known to be constant (e.g. a size 1 random axis) cannot be
+    # function inputs
+    not_constant = [n for n, d in enumerate(input_dims)
+                    if not isinstance(d, theano.gof.Constant)]
+    input_dims = [input_dims[n] for n in not_constant]
+    numeric_input_dims = [numeric_input_dims[n] for n in not_constant]
+
     try:
         compute_shapes = theano.function(input_dims,
                                          output_dims,
                                          mode=theano.Mode(optimizer=None),
                                          on_unused_input="ignore")
 
-        numeric_input_dims = [dim for kept_idx in kept_input
-                              for dim in cloned_shapes[fgraph.inputs[kept_idx]]]
-
         numeric_output_dims = compute_shapes(*numeric_input_dims)
     except MissingInputError:
         # need to add fake datasets and masks to input args for ?? reasons
@@ -299,8 +507,6 @@ def alt_shape_of_variables(inputs, outputs, input_shapes):
             mode=theano.Mode(optimizer=None),
             on_unused_input="ignore")
 
-        numeric_input_dims = [dim for kept_idx in kept_input
-                              for dim in cloned_shapes[fgraph.inputs[kept_idx]]]
         fake_numeric_data = [np.ones(
             cloned_shapes[fgraph.inputs[i]]).astype(fgraph.inputs[i].dtype)
             for i in dataset_and_mask_indices]
@@ -332,10 +538,7 @@ def calc_expected_dims(graph, expression):
     else:
         # Assume anything not a random value or dataset is shared
         # Use short-circuit AND to avoid key-error if no random values in graph
-        all_shared = [s for s in graph.values()
-                      if s != graph[DATASETS_ID] and (
-                          RANDOM_ID not in graph.keys()
-                          or s != graph[RANDOM_ID])]
+        all_shared = [s for k, s in graph.items() if k not in SPECIAL_IDS]
         #  == may not be good comparison in all cases
         all_random = [r for r in graph.values()
                       if (RANDOM_ID in graph.keys() and r == graph[RANDOM_ID])]
@@ -347,8 +550,13 @@ def calc_expected_dims(graph, expression):
         shared_shapes = [s.get_value().shape for s in all_shared]
         random_shapes = [expression_shape(r) for r in all_random]
         all_input_shapes = dataset_shapes + shared_shapes + random_shapes
-        # Fake length of 2
-        fake_shapes = [(2,) + s[1:] for s in all_input_shapes]
+        # Fake length of 2 for datasets and random values, unless the
+        # leading axis is broadcastable. Shared values (such as recurrent
+        # h0) keep their real shape
+        fake_shapes = [tuple(s) if (inp.broadcastable[:1] == (True,) or
+                                    inp in all_shared)
+                       else (2,) + tuple(s[1:])
+                       for inp, s in zip(all_inputs, all_input_shapes)]
         all_outputs = [expression]
         fake_dict = dict(zip(all_inputs, fake_shapes))
         calc_shapes = alt_shape_of_variables(all_inputs, all_outputs, fake_dict)
@@ -375,6 +583,9 @@ def get_params_and_grads(graph, cost):
         if k == RANDOM_ID:
             # skip random
             continue
+        if k in SPECIAL_IDS:
+            # skip random stream, inference replacements and mode
+            continue
         print("Computing grad w.r.t %s" % k)
         grad = tensor.grad(cost, p)
         params.append(p)
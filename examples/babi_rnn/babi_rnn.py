@@ -19,7 +19,7 @@ from dagbldr.datasets import fetch_babi
 from dagbldr.utils import make_embedding_minibatch, make_minibatch
 from dagbldr.utils import add_embedding_datasets_to_graph, add_datasets_to_graph
 from dagbldr.utils import early_stopping_trainer
-from dagbldr.utils import get_params_and_grads
+from dagbldr.utils import get_params_and_grads, compile_inference_function
 from dagbldr.nodes import gru_recurrent_layer, softmax_layer, embedding_layer
 from dagbldr.nodes import categorical_crossentropy
 from dagbldr.optimizers import adam
@@ -39,6 +39,7 @@ graph = OrderedDict()
 minibatch_size = 32
 n_emb = 50
 n_hid = 100
+recurrent_dropout_prob = 0.25
 X_story_mb, X_story_mask = make_embedding_minibatch(
     X_story, slice(0, minibatch_size))
 X_query_mb, X_query_mask = make_embedding_minibatch(
@@ -57,12 +58,14 @@ l1_story = embedding_layer(X_story_syms, vocab_size, n_emb, graph, 'l1_story',
                            random_state)
 masked_story = X_story_mask_sym.dimshuffle(0, 1, 'x') * l1_story
 h_story = gru_recurrent_layer([masked_story], X_story_mask_sym, n_hid, graph,
-                              'story_rec', random_state)
+                              'story_rec', random_state,
+                              recurrent_dropout_prob=recurrent_dropout_prob)
 
 l1_query = embedding_layer(X_query_syms, vocab_size, n_emb, graph, 'l1_query',
                            random_state)
 h_query = gru_recurrent_layer([l1_query], X_query_mask_sym, n_hid, graph,
-                              'query_rec', random_state)
+                              'query_rec', random_state,
+                              recurrent_dropout_prob=recurrent_dropout_prob)
 y_pred = softmax_layer([h_query[-1], h_story[-1]], graph, 'y_pred',
                        y_answer.shape[1], random_state)
 cost = categorical_crossentropy(y_pred, y_sym).mean()
@@ -79,8 +82,10 @@ print("Compiling cost...")
 cost_function = theano.function(X_story_syms + [X_story_mask_sym] + X_query_syms
                                 + [X_query_mask_sym, y_sym], [cost])
 print("Compiling predict...")
-predict_function = theano.function(X_story_syms + [X_story_mask_sym] +
-                                   X_query_syms + [X_query_mask_sym], [y_pred])
+# No dropout masks or RNG in the compiled prediction graph
+predict_function, _ = compile_inference_function(
+    X_story_syms + [X_story_mask_sym] + X_query_syms + [X_query_mask_sym],
+    [y_pred], graph)
 
 
 def accuracy(*args):
@@ -99,4 +104,5 @@ epoch_results = early_stopping_trainer(
                                  make_embedding_minibatch,
                                  make_minibatch],
     fit_function_output_names=["cost"],
-    cost_function_output_name="valid_cost", n_epochs=20)
+    cost_function_output_name="valid_cost", n_epochs=20,
+    drop_partial_valid_minibatch=True)
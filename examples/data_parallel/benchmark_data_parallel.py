@@ -0,0 +1,63 @@
+# Run with OMP_NUM_THREADS=1 so BLAS doesn't compete with the workers
+from __future__ import print_function
+from collections import OrderedDict
+import multiprocessing
+import time
+import numpy as np
+import theano
+
+from dagbldr.datasets import fetch_binarized_mnist
+from dagbldr.optimizers import sgd
+from dagbldr.utils import add_datasets_to_graph, get_params_and_grads
+from dagbldr.utils import convert_to_one_hot, data_parallel_trainer
+from dagbldr.nodes import relu_layer, softmax_layer
+from dagbldr.nodes import categorical_crossentropy
+
+
+mnist = fetch_binarized_mnist()
+train_indices = mnist["train_indices"]
+X = mnist["data"]
+y = mnist["target"]
+n_targets = 10
+y = convert_to_one_hot(y, n_targets)
+
+graph = OrderedDict()
+X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], graph)
+random_state = np.random.RandomState(1999)
+
+minibatch_size = 100
+n_hid = 512
+
+l1 = relu_layer([X_sym], graph, 'l1', n_hid, random_state)
+l2 = relu_layer([l1], graph, 'l2', n_hid, random_state)
+y_pred = softmax_layer([l2], graph, 'y_pred',  n_targets, random_state)
+cost = categorical_crossentropy(y_pred, y_sym).mean()
+
+params, grads = get_params_and_grads(graph, cost)
+learning_rate = 0.01
+opt = sgd(params)
+updates = opt.updates(params, grads, learning_rate)
+
+fit_function = theano.function([X_sym, y_sym], [cost], updates=updates)
+cost_function = theano.function([X_sym, y_sym], [cost])
+initial_values = [p.get_value() for p in params]
+
+n_cores = multiprocessing.cpu_count()
+worker_counts = [2 ** i for i in range(int(np.log2(n_cores)) + 1)]
+for sync_mode in ["average", "hogwild"]:
+    for n_workers in worker_counts:
+        for p, v in zip(params, initial_values):
+            p.set_value(v.copy())
+        start = time.time()
+        epoch_results = data_parallel_trainer(
+            fit_function, [X, y], minibatch_size, train_indices,
+            n_workers=n_workers, sync_mode=sync_mode, sync_every=10,
+            fit_function_output_names=["cost"], n_epochs=1,
+            epoch_status_func=None,
+            shuffle=True, random_state=random_state)
+        elapsed = time.time() - start
+        n_samples = n_workers * epoch_results["number_of_samples_auto"][-1]
+        valid_cost = cost_function(X[mnist["valid_indices"]],
+                                   y[mnist["valid_indices"]])[0]
+        print("%s %i workers: %.1f samples/sec, valid cost %.4f" % (
+            sync_mode, n_workers, n_samples / elapsed, valid_cost))
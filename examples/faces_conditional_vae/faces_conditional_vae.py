@@ -35,7 +35,8 @@ n_enc_layer = [200, 200, 200]
 n_dec_layer = [200, 200]
 width = 48
 height = 48
-n_input = width * height
+# Decode to PCA coefficients, see fetch_fer n_pca_components
+n_input = pca_tf.shape[0]
 
 # q(y_pred | x)
 y_l1_enc = softplus_layer([X_sym], graph, 'y_l1_enc', n_enc_layer[0],
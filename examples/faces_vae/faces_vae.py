@@ -31,7 +31,8 @@ n_enc_layer = [600, 600]
 n_dec_layer = [600, 600]
 width = 48
 height = 48
-n_input = width * height
+# Decode to PCA coefficients, see fetch_fer n_pca_components
+n_input = pca_tf.shape[0]
 
 # encode path aka q
 l1_enc = softplus_layer([X_sym], graph, 'l1_enc', n_enc_layer[0], random_state)
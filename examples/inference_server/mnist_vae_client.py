@@ -0,0 +1,50 @@
+# Load test a server started with
+# python serve_checkpoint.py vae.pkl encode_function decode_function
+from __future__ import print_function
+import argparse
+import threading
+import time
+import numpy as np
+from dagbldr.datasets import fetch_binarized_mnist
+from dagbldr.utils import InferenceClient
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--port", "-p", action="store", default=6006, type=int)
+parser.add_argument("--n_clients", "-n", action="store", default=16,
+                    type=int)
+parser.add_argument("--n_requests", "-r", help="Requests per client",
+                    action="store", default=100, type=int)
+args = parser.parse_args()
+
+mnist = fetch_binarized_mnist()
+X = mnist["data"][mnist["valid_indices"]]
+address = ("127.0.0.1", args.port)
+
+
+def run_client(seed):
+    random_state = np.random.RandomState(seed)
+    with InferenceClient(address) as client:
+        for i in range(args.n_requests):
+            idx = random_state.randint(0, len(X), random_state.randint(1, 5))
+            mu, log_sig = client("encode_function", X[idx])
+            # No noise at test time
+            out, = client("decode_function", mu + np.exp(log_sig))
+
+threads = [threading.Thread(target=run_client, args=(n,))
+           for n in range(args.n_clients)]
+start = time.time()
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+elapsed = time.time() - start
+print("%i requests in %.2fs" % (2 * args.n_clients * args.n_requests,
+                                elapsed))
+with InferenceClient(address) as client:
+    for name, stats in sorted(client.stats().items()):
+        print("%s: %i requests in %i batches, max queue depth %i, "
+              "p50 %.2fms, p99 %.2fms" % (
+                  name, stats["n_requests"], stats["n_batches"],
+                  stats["max_queue_depth"], 1000 * stats["latency_p50"],
+                  1000 * stats["latency_p99"]))
+        print("batch sizes %s" % sorted(stats["batch_sizes"].items()))
@@ -0,0 +1,38 @@
+from __future__ import print_function
+import argparse
+import os
+from dagbldr.utils import serve_checkpoint
+
+parser = argparse.ArgumentParser()
+parser.add_argument("saved_functions_file",
+                    help="Saved pickle file from training")
+parser.add_argument("function_names", nargs="+",
+                    help="Functions to serve, e.g. encode_function")
+parser.add_argument("--port", "-p", help="TCP port on localhost",
+                    action="store", default=6006, type=int)
+parser.add_argument("--unix_socket", "-u", help="Serve on a unix socket "
+                    "path instead of TCP", action="store", default=None)
+parser.add_argument("--max_batch_size", "-b", action="store", default=100,
+                    type=int)
+parser.add_argument("--max_latency", "-l", help="Seconds to wait while "
+                    "filling a batch", action="store", default=0.005,
+                    type=float)
+
+args = parser.parse_args()
+if not os.path.exists(args.saved_functions_file):
+    raise ValueError("Please provide a valid path for saved pickle file!")
+
+if args.unix_socket is not None:
+    address = args.unix_socket
+else:
+    address = ("127.0.0.1", args.port)
+server = serve_checkpoint(args.saved_functions_file, args.function_names,
+                          address=address,
+                          max_batch_size=args.max_batch_size,
+                          max_latency=args.max_latency)
+print("Serving %s on %s" % (args.function_names, server.address))
+try:
+    server.thread.join()
+except KeyboardInterrupt:
+    print(server.stats())
+    server.shutdown()
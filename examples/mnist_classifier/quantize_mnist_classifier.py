@@ -0,0 +1,95 @@
+# Accuracy and speed of int8 weights for a trained mnist_classifier.py
+# int8 weights only save space, about 4x on disk and in memory. Neither
+# theano nor numpy has an int8 matrix product, so int8 is slower, not faster
+from __future__ import print_function
+from collections import OrderedDict
+import argparse
+import tempfile
+import shutil
+import time
+import os
+import numpy as np
+import theano
+
+from dagbldr.datasets import fetch_binarized_mnist
+from dagbldr.utils import add_datasets_to_graph, load_checkpoint
+from dagbldr.utils import compile_inference_function, quantize_graph_params
+from dagbldr.utils import export_graph, load_inference_model
+from dagbldr.nodes import relu_layer, softmax_layer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("saved_functions_file",
+                    help="Saved pickle file from mnist_classifier.py")
+args = parser.parse_args()
+if not os.path.exists(args.saved_functions_file):
+    raise ValueError("Please provide a valid path for saved pickle file!")
+
+
+def best_time(func, args, n_repeats=10):
+    times = []
+    for i in range(n_repeats):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def export_size(export_dir):
+    return os.path.getsize(os.path.join(export_dir, "weights.npz"))
+
+
+mnist = fetch_binarized_mnist()
+valid_indices = mnist["valid_indices"]
+X = mnist["data"].astype(theano.config.floatX)
+X_valid = X[valid_indices]
+y_valid = mnist["target"][valid_indices]
+
+# Same architecture as mnist_classifier.py, so parameter names match
+graph = OrderedDict()
+X_sym = add_datasets_to_graph([X], ["X"], graph)
+random_state = np.random.RandomState(1999)
+n_hid = 512
+n_targets = 10
+l1 = relu_layer([X_sym], graph, 'l1', n_hid, random_state)
+l2 = relu_layer([l1], graph, 'l2', n_hid, random_state)
+y_pred = softmax_layer([l2], graph, 'y_pred', n_targets, random_state)
+
+checkpoint_dict = load_checkpoint(args.saved_functions_file)
+for i in checkpoint_dict["predict_function"].maker.inputs:
+    v = i.variable
+    if isinstance(v, theano.compile.SharedVariable) and v.name in graph:
+        graph[v.name].set_value(v.get_value())
+
+export_dir = tempfile.mkdtemp()
+try:
+    results = OrderedDict()
+    float_dir = os.path.join(export_dir, "float")
+    int8_dir = os.path.join(export_dir, "int8")
+    float_function, _ = compile_inference_function([X_sym], [y_pred], graph)
+    export_graph([X_sym], [y_pred], graph, float_dir)
+    quantize_graph_params(graph)
+    int8_function, _ = compile_inference_function([X_sym], [y_pred], graph)
+    export_graph([X_sym], [y_pred], graph, int8_dir)
+    results["theano float32"] = (float_function, None)
+    results["theano int8"] = (int8_function, None)
+    results["numpy float32"] = (load_inference_model(float_dir),
+                                export_size(float_dir))
+    results["numpy int8"] = (load_inference_model(int8_dir),
+                             export_size(int8_dir))
+
+    reference = float_function(X_valid)[0].argmax(axis=1)
+    for name, (func, size) in results.items():
+        pred = func(X_valid)[0].argmax(axis=1)
+        error = np.mean(pred != y_valid)
+        agreement = np.mean(pred == reference)
+        print("%s: valid error %.4f, agreement with float32 %.4f" % (
+            name, error, agreement))
+        if size is not None:
+            print("    weights on disk %.2f MB" % (size / 1E6))
+        for batch_size in [1, 100, 1000]:
+            t = best_time(func, [X_valid[:batch_size]])
+            print("    batch %4i: %.3fms" % (batch_size, 1000 * t))
+    print("int8 weights are about 4x smaller on disk and in memory, but "
+          "inference is slower than float32, not faster")
+finally:
+    shutil.rmtree(export_dir)
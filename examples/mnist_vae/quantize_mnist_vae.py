@@ -0,0 +1,112 @@
+# Reconstruction quality and speed of int8 weights for a trained mnist_vae.py
+# int8 weights only save space, about 4x on disk and in memory. Neither
+# theano nor numpy has an int8 matrix product, so int8 is slower, not faster
+from __future__ import print_function
+from collections import OrderedDict
+import argparse
+import tempfile
+import shutil
+import time
+import os
+import numpy as np
+import theano
+
+from dagbldr.datasets import fetch_binarized_mnist
+from dagbldr.utils import add_datasets_to_graph, load_checkpoint
+from dagbldr.utils import compile_inference_function, quantize_graph_params
+from dagbldr.utils import export_graph, load_inference_model
+from dagbldr.nodes import softplus_layer, linear_layer, sigmoid_layer
+from dagbldr.nodes import gaussian_log_sample_layer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("saved_functions_file",
+                    help="Saved pickle file from mnist_vae.py")
+args = parser.parse_args()
+if not os.path.exists(args.saved_functions_file):
+    raise ValueError("Please provide a valid path for saved pickle file!")
+
+
+def best_time(func, args, n_repeats=10):
+    times = []
+    for i in range(n_repeats):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def export_size(export_dir):
+    return os.path.getsize(os.path.join(export_dir, "weights.npz"))
+
+
+def reconstruction_nll(X, X_rec):
+    X_rec = np.clip(X_rec, 1E-6, 1 - 1E-6)
+    nll = -(X * np.log(X_rec) + (1 - X) * np.log(1 - X_rec))
+    return nll.sum(axis=1).mean()
+
+
+mnist = fetch_binarized_mnist()
+valid_indices = mnist["valid_indices"]
+X = mnist["data"].astype(theano.config.floatX)
+X_valid = X[valid_indices]
+
+# Same architecture as mnist_vae.py, so parameter names match
+graph = OrderedDict()
+X_sym = add_datasets_to_graph([X], ["X"], graph)
+random_state = np.random.RandomState(1999)
+n_code = 100
+n_enc_layer = [200, 200]
+n_dec_layer = [200, 200]
+n_input = 28 * 28
+l1_enc = softplus_layer([X_sym], graph, 'l1_enc', n_enc_layer[0], random_state)
+l2_enc = softplus_layer([l1_enc], graph, 'l2_enc', n_enc_layer[1],
+                        random_state)
+code_mu = linear_layer([l2_enc], graph, 'code_mu', n_code, random_state)
+code_log_sigma = linear_layer([l2_enc], graph, 'code_log_sigma', n_code,
+                              random_state)
+samp = gaussian_log_sample_layer([code_mu], [code_log_sigma], graph, 'samp',
+                                 random_state)
+l1_dec = softplus_layer([samp], graph, 'l1_dec', n_dec_layer[0], random_state)
+l2_dec = softplus_layer([l1_dec], graph, 'l2_dec', n_dec_layer[1],
+                        random_state)
+out = sigmoid_layer([l2_dec], graph, 'out', n_input, random_state)
+
+checkpoint_dict = load_checkpoint(args.saved_functions_file)
+for i in checkpoint_dict["cost_function"].maker.inputs:
+    v = i.variable
+    if isinstance(v, theano.compile.SharedVariable) and v.name in graph:
+        graph[v.name].set_value(v.get_value())
+
+# Deterministic reconstruction through the code mean
+export_dir = tempfile.mkdtemp()
+try:
+    results = OrderedDict()
+    float_dir = os.path.join(export_dir, "float")
+    int8_dir = os.path.join(export_dir, "int8")
+    float_function, _ = compile_inference_function([X_sym], [out], graph)
+    export_graph([X_sym], [out], graph, float_dir)
+    quantize_graph_params(graph)
+    int8_function, _ = compile_inference_function([X_sym], [out], graph)
+    export_graph([X_sym], [out], graph, int8_dir)
+    results["theano float32"] = (float_function, None)
+    results["theano int8"] = (int8_function, None)
+    results["numpy float32"] = (load_inference_model(float_dir),
+                                export_size(float_dir))
+    results["numpy int8"] = (load_inference_model(int8_dir),
+                             export_size(int8_dir))
+
+    reference = float_function(X_valid)[0]
+    for name, (func, size) in results.items():
+        X_rec = func(X_valid)[0]
+        print("%s: valid reconstruction nll %.4f, max abs diff from "
+              "float32 %.4f" % (name, reconstruction_nll(X_valid, X_rec),
+                                np.abs(X_rec - reference).max()))
+        if size is not None:
+            print("    weights on disk %.2f MB" % (size / 1E6))
+        for batch_size in [1, 100, 1000]:
+            t = best_time(func, [X_valid[:batch_size]])
+            print("    batch %4i: %.3fms" % (batch_size, 1000 * t))
+    print("int8 weights are about 4x smaller on disk and in memory, but "
+          "inference is slower than float32, not faster")
+finally:
+    shutil.rmtree(export_dir)
@@ -0,0 +1,62 @@
+# Compare latency of the compiled Theano inference function and the exported
+# NumPy runtime on the mnist_classifier architecture
+from __future__ import print_function
+from collections import OrderedDict
+import tempfile
+import shutil
+import time
+import numpy as np
+import theano
+
+from dagbldr.datasets import fetch_binarized_mnist
+from dagbldr.utils import add_datasets_to_graph, compile_inference_function
+from dagbldr.utils import export_graph, load_inference_model
+from dagbldr.nodes import relu_layer, softmax_layer
+
+
+def best_time(func, args, n_repeats=20):
+    times = []
+    for i in range(n_repeats):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+mnist = fetch_binarized_mnist()
+X = mnist["data"].astype(theano.config.floatX)
+
+graph = OrderedDict()
+X_sym = add_datasets_to_graph([X], ["X"], graph)
+random_state = np.random.RandomState(1999)
+
+n_hid = 512
+n_targets = 10
+l1 = relu_layer([X_sym], graph, 'l1', n_hid, random_state)
+l2 = relu_layer([l1], graph, 'l2', n_hid, random_state)
+y_pred = softmax_layer([l2], graph, 'y_pred', n_targets, random_state)
+
+export_dir = tempfile.mkdtemp()
+try:
+    export_graph([X_sym], [y_pred], graph, export_dir)
+
+    start = time.time()
+    predict_function, _ = compile_inference_function([X_sym], [y_pred], graph)
+    theano_cold = time.time() - start
+    start = time.time()
+    model = load_inference_model(export_dir)
+    numpy_cold = time.time() - start
+    print("cold start: theano %.3fs, numpy %.3fs" % (theano_cold,
+                                                      numpy_cold))
+
+    for batch_size in [1, 10, 100, 1000]:
+        X_batch = X[:batch_size]
+        theano_res = predict_function(X_batch)[0]
+        numpy_res = model(X_batch)[0]
+        max_diff = np.abs(theano_res - numpy_res).max()
+        theano_time = best_time(predict_function, [X_batch])
+        numpy_time = best_time(model, [X_batch])
+        print("batch %4i: theano %.3fms, numpy %.3fms, max diff %.2E" % (
+            batch_size, 1000 * theano_time, 1000 * numpy_time, max_diff))
+finally:
+    shutil.rmtree(export_dir)
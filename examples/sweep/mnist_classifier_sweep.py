@@ -0,0 +1,69 @@
+# Run with OMP_NUM_THREADS=1 so BLAS doesn't compete with the trials
+from __future__ import print_function
+from collections import OrderedDict
+import numpy as np
+import theano
+
+from dagbldr.datasets import fetch_binarized_mnist
+from dagbldr.optimizers import adam
+from dagbldr.utils import add_datasets_to_graph, get_params_and_grads
+from dagbldr.utils import convert_to_one_hot, early_stopping_trainer
+from dagbldr.utils import sweep_runner, make_param_grid
+from dagbldr.nodes import relu_layer, softmax_layer
+from dagbldr.nodes import categorical_crossentropy
+
+
+def trial_function(params, mnist, report):
+    train_indices = mnist["train_indices"]
+    valid_indices = mnist["valid_indices"]
+    X = mnist["data"]
+    n_targets = 10
+    y = convert_to_one_hot(mnist["target"], n_targets)
+
+    graph = OrderedDict()
+    X_sym, y_sym = add_datasets_to_graph([X, y], ["X", "y"], graph)
+    random_state = np.random.RandomState(1999)
+
+    n_hid = params["n_hid"]
+    l1 = relu_layer([X_sym], graph, 'l1', n_hid, random_state)
+    l2 = relu_layer([l1], graph, 'l2', n_hid, random_state)
+    y_pred = softmax_layer([l2], graph, 'y_pred',  n_targets, random_state)
+    cost = categorical_crossentropy(y_pred, y_sym).mean()
+
+    params_, grads = get_params_and_grads(graph, cost)
+    opt = adam(params_)
+    updates = opt.updates(params_, grads, params["learning_rate"])
+
+    fit_function = theano.function([X_sym, y_sym], [cost], updates=updates)
+    cost_function = theano.function([X_sym, y_sym], [cost])
+    checkpoint_dict = {"fit_function": fit_function,
+                       "cost_function": cost_function}
+
+    epoch_results = None
+    for e in range(20):
+        epoch_results = early_stopping_trainer(
+            fit_function, cost_function, checkpoint_dict, [X, y],
+            params["minibatch_size"], train_indices, valid_indices,
+            fit_function_output_names=["cost"],
+            cost_function_output_name="valid_cost",
+            n_epochs=1, previous_epoch_results=epoch_results,
+            shuffle=True, random_state=random_state)
+        # Stops this trial if it is worse than the median of the others
+        report(epoch_results)
+    return min(epoch_results["valid_cost"])
+
+
+mnist = fetch_binarized_mnist()
+list_of_params = make_param_grid({"learning_rate": [0.002, 0.0002, 0.00002],
+                                  "n_hid": [128, 512],
+                                  "minibatch_size": [50, 100]})
+sweep_results = sweep_runner(trial_function, list_of_params, dataset=mnist)
+for r in sorted(sweep_results,
+                key=lambda x: min(x["history"]) if len(x["history"]) > 0
+                else np.inf):
+    status = "stopped early" if r["stopped_early"] else "finished"
+    if r["error"] is not None:
+        status = "failed"
+    best = min(r["history"]) if len(r["history"]) > 0 else np.nan
+    print("%s: best valid_cost %f, %s, checkpoints in %s" % (
+        r["params"], best, status, r["checkpoint_dir"]))